@@ -1,33 +1,136 @@
+import json
 import os
-import uuid
-from flask import Flask, request, jsonify
+import tempfile
+import time
+from flask import Flask, Request, Response, g, request, jsonify
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from image_analyzer import analyze_image
-from music_recommender import get_music_recommendations
-from spotify_client import SpotifyClient
+from image_analyzer import COLOR_MODES, DEFAULT_VISION_PROFILE, VISION_PROFILES, get_analyzer, vision_usage
+from spotify_client import SpotifyClient, SPOTIFY_API_URL, SPOTIFY_ACCOUNTS_URL
+from cache import (build_analysis_cache, build_last_recommendations_cache, build_near_duplicate_index,
+                   build_recommendation_cache, build_search_cache)
+from diagnostics import SpotifyDiagnostics
+from logs import bind_request_id, configure_logging, get_logger
+from metrics import ERRORS, HTTP_REQUEST_SECONDS, REGISTRY, component_collector
+from pipeline import AnalyzePipeline, StageTimeoutError
+from track_catalog import TrackCatalog
 import base64
 
 # Load environment variables
 load_dotenv()
 
+# Structured logs go through a queue to stdout
+configure_logging()
+log = get_logger(__name__)
+
+# Uploads up to this size stay in memory; larger ones spool to a temp file
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', 4 * 1024 * 1024))
+
+class SpooledUploadRequest(Request):
+    """Request that buffers uploaded files in memory up to UPLOAD_SPOOL_THRESHOLD"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='rb+')
+
 app = Flask(__name__)
+app.request_class = SpooledUploadRequest
 CORS(app)  # Enable CORS for all routes
 
-# Configure upload folder
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
 
 # Initialize Spotify client
 spotify_client = SpotifyClient(
     client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET')
+    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
+    pool_size=int(os.getenv('SPOTIFY_POOL_SIZE', 10)),
+    connect_timeout=float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', 3.05)),
+    read_timeout=float(os.getenv('SPOTIFY_READ_TIMEOUT', 10)),
+    genre_ttl=float(os.getenv('SPOTIFY_GENRE_TTL', 86400)),
+    search_cache=build_search_cache(),
+    rate_limit=float(os.getenv('SPOTIFY_RATE_LIMIT', 10)),
+    rate_burst=int(os.getenv('SPOTIFY_RATE_BURST', 20)),
+    max_retries=int(os.getenv('SPOTIFY_MAX_RETRIES', 3)),
+    breaker_threshold=int(os.getenv('SPOTIFY_BREAKER_THRESHOLD', 5)),
+    breaker_reset=float(os.getenv('SPOTIFY_BREAKER_RESET', 30)),
+    api_url=os.getenv('SPOTIFY_API_URL', SPOTIFY_API_URL),
+    accounts_url=os.getenv('SPOTIFY_ACCOUNTS_URL', SPOTIFY_ACCOUNTS_URL),
+    search_fanout=int(os.getenv('SPOTIFY_SEARCH_FANOUT', 4)),
+    search_budget=float(os.getenv('SPOTIFY_SEARCH_BUDGET', 1.5))
 )
 
+# Load the genre seed catalog once; it is refreshed in the background afterwards
+spotify_client.load_genre_seeds()
+
+# Spotify connectivity probes run off the request path
+spotify_diagnostics = SpotifyDiagnostics(spotify_client)
+diagnostics_interval = float(os.getenv('SPOTIFY_DIAGNOSTICS_INTERVAL', 0))
+if diagnostics_interval > 0:
+    spotify_diagnostics.start(diagnostics_interval)
+
+# Cache of analyze_image results keyed by a hash of the uploaded bytes
+analysis_cache = build_analysis_cache()
+
+# Perceptual hashes of analyzed images, so re-encoded or resized
+# re-uploads reuse the cached analysis
+near_duplicate_index = build_near_duplicate_index()
+
+# Tracks shared by every image that maps to the same quantized mood
+recommendation_cache = build_recommendation_cache()
+
+# Last recommendations per image, sent first when an image is streamed again
+last_recommendations = build_last_recommendations_cache()
+
+# Optional local track catalog for Spotify-free recommendations
+track_catalog = None
+if os.getenv('TRACK_CATALOG_DIR'):
+    track_catalog = TrackCatalog(os.getenv('TRACK_CATALOG_DIR'))
+
+# Concurrent analyze pipeline with per-stage timeouts and a total deadline
+analyze_pipeline = AnalyzePipeline(
+    spotify_client,
+    analysis_cache,
+    max_workers=int(os.getenv('PIPELINE_WORKERS', 8)),
+    stage_timeouts={
+        "vision": float(os.getenv('PIPELINE_VISION_TIMEOUT', 15)),
+        "local": float(os.getenv('PIPELINE_LOCAL_TIMEOUT', 10)),
+        "recommend": float(os.getenv('PIPELINE_RECOMMEND_TIMEOUT', 15)),
+    },
+    total_deadline=float(os.getenv('PIPELINE_DEADLINE', 25)),
+    color_mode=os.getenv('COLOR_MODE', 'vision'),
+    track_catalog=track_catalog,
+    near_duplicate_index=near_duplicate_index,
+    vision_profile=os.getenv('VISION_PROFILE', DEFAULT_VISION_PROFILE),
+    recommendation_cache=recommendation_cache,
+    last_recommendations=last_recommendations
+)
+
+# Cache, Spotify scheduler and Vision usage counters are read at scrape time
+REGISTRY.register_collector(component_collector(analysis_cache, spotify_client, near_duplicate_index, vision_usage,
+                                                recommendation_cache, last_recommendations))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Not reset on teardown: streamed bodies are generated after it, and the
+    # next request on this thread sets its own id
+    g.request_id = bind_request_id(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        observe = HTTP_REQUEST_SECONDS.labels(route, request.method, str(response.status_code)).observe
+        if response.is_streamed:
+            # This runs before a streamed body is generated, so time it until
+            # the server closes the response after sending the last chunk
+            response.call_on_close(lambda: observe(time.perf_counter() - started))
+        else:
+            observe(time.perf_counter() - started)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "ok"})
@@ -44,69 +147,169 @@ def analyze():
     if file.filename == '':
         return jsonify({"error": "No image selected"}), 400
     
-    # Save file with unique name to prevent conflicts
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-    file.save(filepath)
+    # Optional per-request overrides of where dominant colors come from
+    # and which Vision annotations are paid for
+    color_mode = request.form.get('color_mode') or None
+    if color_mode is not None and color_mode not in COLOR_MODES:
+        return jsonify({"error": f"color_mode must be one of {', '.join(COLOR_MODES)}"}), 400
+    vision_profile = request.form.get('vision_profile') or None
+    if vision_profile is not None and vision_profile not in VISION_PROFILES:
+        return jsonify({"error": f"vision_profile must be one of {', '.join(VISION_PROFILES)}"}), 400
     
     try:
-        # Analyze the image
-        image_features = analyze_image(filepath)
-        
-        # Get music recommendations based on image features
-        recommendations = get_music_recommendations(image_features, spotify_client)
-        
-        # Clean up the uploaded file
-        os.remove(filepath)
+        # Vision, local decoding and the genre catalog run concurrently;
+        # repeat uploads are served from the analysis cache
+        result = analyze_pipeline.run(
+            file.read(),
+            debug=app.debug,
+            color_mode=color_mode,
+            vision_profile=vision_profile
+        )
         
+        response = {"success": True}
+        response.update(result)
+        return jsonify(response)
+    
+    except StageTimeoutError as e:
         return jsonify({
-            "success": True,
-            "image_features": image_features,
-            "recommendations": recommendations
-        })
+            "success": False,
+            "error": str(e)
+        }), 504
     
     except Exception as e:
-        # Ensure we always return valid JSON, even for errors
-        import traceback
-        traceback.print_exc()  # Print the full error to console
+        ERRORS.labels("api", "analyze").inc()
+        log.exception("api.analyze_failed")
         
+        # Ensure we always return valid JSON, even for errors
         # Return a proper JSON error response
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """
+    Streaming /api/analyze: image features are sent as soon as they are ready,
+    then recommendations. Events are NDJSON lines, or Server-Sent Events when
+    the client accepts text/event-stream. See AnalyzePipeline.stream.
+    """
+    if 'image' not in request.files:
+        return jsonify({"error": "No image provided"}), 400
+    
+    file = request.files['image']
+    if file.filename == '':
+        return jsonify({"error": "No image selected"}), 400
+    
+    color_mode = request.form.get('color_mode') or None
+    if color_mode is not None and color_mode not in COLOR_MODES:
+        return jsonify({"error": f"color_mode must be one of {', '.join(COLOR_MODES)}"}), 400
+    vision_profile = request.form.get('vision_profile') or None
+    if vision_profile is not None and vision_profile not in VISION_PROFILES:
+        return jsonify({"error": f"vision_profile must be one of {', '.join(VISION_PROFILES)}"}), 400
+    
+    # Read everything from the request before the response starts streaming
+    events = analyze_pipeline.stream(file.read(), debug=app.debug, color_mode=color_mode,
+                                     vision_profile=vision_profile)
+    
+    if request.accept_mimetypes.best == 'text/event-stream':
+        mimetype = 'text/event-stream'
+        body = (f"event: {event['event']}\ndata: {json.dumps(event)}\n\n" for event in events)
+    else:
+        mimetype = 'application/x-ndjson'
+        body = (json.dumps(event) + "\n" for event in events)
+    
+    # Stop proxies from buffering the stream until it ends
+    return Response(body, mimetype=mimetype, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Maximum number of images accepted by /api/analyze/batch
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', 32))
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    files = [file for file in request.files.getlist('images') if file.filename != '']
+    if not files:
+        return jsonify({"error": "No images provided"}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({"error": f"At most {BATCH_MAX_IMAGES} images per batch"}), 400
+    
+    color_mode = request.form.get('color_mode') or None
+    if color_mode is not None and color_mode not in COLOR_MODES:
+        return jsonify({"error": f"color_mode must be one of {', '.join(COLOR_MODES)}"}), 400
+    vision_profile = request.form.get('vision_profile') or None
+    if vision_profile is not None and vision_profile not in VISION_PROFILES:
+        return jsonify({"error": f"vision_profile must be one of {', '.join(VISION_PROFILES)}"}), 400
+    
+    try:
+        result = analyze_pipeline.run_batch(
+            [file.read() for file in files],
+            debug=app.debug,
+            color_mode=color_mode,
+            vision_profile=vision_profile
+        )
+        
+        response = {"success": True}
+        response.update(result)
+        return jsonify(response)
+    
+    except StageTimeoutError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 504
+    
+    except Exception as e:
+        ERRORS.labels("api", "analyze_batch").inc()
+        log.exception("api.analyze_batch_failed")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    """Report hit/miss counters for the image analysis, recommendation and Spotify search caches"""
+    return jsonify({
+        "analysis": analysis_cache.stats(),
+        "near_duplicates": near_duplicate_index.stats() if near_duplicate_index is not None else None,
+        "recommendations": recommendation_cache.stats() if recommendation_cache is not None else None,
+        "last_recommendations": last_recommendations.stats() if last_recommendations is not None else None,
+        "search": spotify_client.search_cache.stats()
+    })
+
+@app.route('/api/pool-stats', methods=['GET'])
+def pool_stats():
+    """Report connection pool usage and rate limiting counters of the shared Spotify client"""
+    return jsonify({
+        "spotify": spotify_client.pool_stats(),
+        "spotify_scheduler": spotify_client.scheduler_stats()
+    })
+
+@app.route('/api/vision-stats', methods=['GET'])
+def vision_stats():
+    """Report calls, billable units and latency of Vision annotation per profile"""
+    return jsonify({
+        "default_profile": analyze_pipeline.vision_profile,
+        "profiles": vision_usage.stats()
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Stage latency histograms, Spotify call latency, error counts and cache ratios in Prometheus text format"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/test-spotify', methods=['GET'])
 def test_spotify():
-    """Test endpoint to verify Spotify API connection"""
+    """Report the last Spotify diagnostics run, or run the probes with ?refresh=true"""
     try:
-        # Get a token
-        token = spotify_client._ensure_token()
-        
-        # Try to get available genres
-        genres = spotify_client.debug_list_genres()
+        result = spotify_diagnostics.last_result()
+        if result is None or request.args.get('refresh', '').lower() in ('1', 'true'):
+            result = spotify_diagnostics.run()
         
-        # Try to get a simple recommendation
-        try:
-            tracks = spotify_client.get_recommendations(seed_genres="pop", limit=2)
-            track_names = [t.get('name', 'Unknown') for t in tracks]
-        except Exception as e:
-            track_names = []
-            print(f"Error getting tracks: {e}")
-        
-        return jsonify({
-            "status": "ok",
-            "token_obtained": bool(token),
-            "genres_count": len(genres),
-            "sample_genres": genres[:5] if genres else [],
-            "recommendations_working": len(track_names) > 0,
-            "sample_tracks": track_names
-        })
+        return jsonify(result)
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("api.spotify_diagnostics_failed")
         return jsonify({"status": "error", "error": str(e)}), 500
 
 @app.route('/api/test-spotify-token', methods=['GET'])
@@ -149,9 +352,10 @@ def test_spotify_token():
         })
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log.exception("api.spotify_token_test_failed")
         return jsonify({"status": "error", "error": str(e)}), 500
 
 if __name__ == '__main__':
+    # Open the Vision channel before the first request arrives
+    get_analyzer().warm_up()
     app.run(debug=os.getenv('FLASK_DEBUG', 'False') == 'True', host='0.0.0.0', port=int(os.getenv('PORT', 5000))) 
\ No newline at end of file
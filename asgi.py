@@ -0,0 +1,262 @@
+"""
+ASGI entry point serving /api/analyze with the asyncio pipeline.
+
+The Flask app holds a worker (or thread) for the whole Vision and Spotify
+round trip; here those calls are awaited, so one process keeps hundreds of
+analyze requests in flight. Run it with:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+It reads the same environment variables as app.py.
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+from async_pipeline import AsyncAnalyzePipeline
+from async_spotify_client import AsyncSpotifyClient
+from cache import build_analysis_cache, build_near_duplicate_index, build_recommendation_cache, build_search_cache
+from image_analyzer import COLOR_MODES, DEFAULT_VISION_PROFILE, VISION_PROFILES, vision_usage
+from logs import bind_request_id, configure_logging, get_logger
+from metrics import ERRORS, HTTP_REQUEST_SECONDS, REGISTRY, component_collector
+from pipeline import StageTimeoutError
+from spotify_client import SPOTIFY_API_URL, SPOTIFY_ACCOUNTS_URL
+from track_catalog import TrackCatalog
+
+# Load environment variables
+load_dotenv()
+
+# Structured logs go through a queue to stdout
+configure_logging()
+log = get_logger(__name__)
+
+DEBUG = os.getenv('FLASK_DEBUG', 'False') == 'True'
+
+# Same upload limit as the Flask app
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+
+class RequestTooLarge(Exception):
+    """Raised while reading a request body that exceeds MAX_CONTENT_LENGTH."""
+
+def limit_body(request: Request, max_length: int) -> Request:
+    """
+    Wrap a request so reading more than max_length body bytes raises RequestTooLarge.
+
+    Content-Length is only a claim, and chunked uploads don't send one, so the
+    limit is enforced on the bytes actually received before form() buffers them.
+    """
+    receive = request.receive
+    received = 0
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_length:
+                raise RequestTooLarge()
+        return message
+
+    return Request(request.scope, limited_receive)
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    # Clients are created inside the event loop they will run on
+    spotify_client = AsyncSpotifyClient(
+        client_id=os.getenv('SPOTIFY_CLIENT_ID'),
+        client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
+        max_connections=int(os.getenv('SPOTIFY_MAX_CONNECTIONS', 100)),
+        connect_timeout=float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', 3.05)),
+        read_timeout=float(os.getenv('SPOTIFY_READ_TIMEOUT', 10)),
+        genre_ttl=float(os.getenv('SPOTIFY_GENRE_TTL', 86400)),
+        search_cache=build_search_cache(),
+        rate_limit=float(os.getenv('SPOTIFY_RATE_LIMIT', 10)),
+        rate_burst=int(os.getenv('SPOTIFY_RATE_BURST', 20)),
+        max_retries=int(os.getenv('SPOTIFY_MAX_RETRIES', 3)),
+        breaker_threshold=int(os.getenv('SPOTIFY_BREAKER_THRESHOLD', 5)),
+        breaker_reset=float(os.getenv('SPOTIFY_BREAKER_RESET', 30)),
+        api_url=os.getenv('SPOTIFY_API_URL', SPOTIFY_API_URL),
+        accounts_url=os.getenv('SPOTIFY_ACCOUNTS_URL', SPOTIFY_ACCOUNTS_URL),
+        search_fanout=int(os.getenv('SPOTIFY_SEARCH_FANOUT', 4)),
+        search_budget=float(os.getenv('SPOTIFY_SEARCH_BUDGET', 1.5))
+    )
+    await spotify_client.load_genre_seeds()
+
+    track_catalog = None
+    if os.getenv('TRACK_CATALOG_DIR'):
+        track_catalog = TrackCatalog(os.getenv('TRACK_CATALOG_DIR'))
+
+    near_duplicate_index = build_near_duplicate_index()
+    recommendation_cache = build_recommendation_cache()
+
+    app.state.spotify_client = spotify_client
+    analysis_cache = build_analysis_cache()
+    REGISTRY.register_collector(component_collector(analysis_cache, spotify_client, near_duplicate_index,
+                                                    vision_usage, recommendation_cache))
+    app.state.analyze_pipeline = AsyncAnalyzePipeline(
+        spotify_client,
+        analysis_cache,
+        stage_timeouts={
+            "vision": float(os.getenv('PIPELINE_VISION_TIMEOUT', 15)),
+            "local": float(os.getenv('PIPELINE_LOCAL_TIMEOUT', 10)),
+            "recommend": float(os.getenv('PIPELINE_RECOMMEND_TIMEOUT', 15)),
+        },
+        total_deadline=float(os.getenv('PIPELINE_DEADLINE', 25)),
+        color_mode=os.getenv('COLOR_MODE', 'vision'),
+        track_catalog=track_catalog,
+        near_duplicate_index=near_duplicate_index,
+        vision_profile=os.getenv('VISION_PROFILE', DEFAULT_VISION_PROFILE),
+        recommendation_cache=recommendation_cache
+    )
+    try:
+        yield
+    finally:
+        await spotify_client.aclose()
+
+async def health_check(request: Request):
+    return JSONResponse({"status": "ok"})
+
+async def analyze(request: Request):
+    content_length = request.headers.get('content-length')
+    if content_length is not None:
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            return JSONResponse({"error": "Invalid Content-Length"}, status_code=400)
+        if content_length > MAX_CONTENT_LENGTH:
+            return JSONResponse({"error": "Image too large"}, status_code=413)
+
+    try:
+        form = await limit_body(request, MAX_CONTENT_LENGTH).form()
+    except RequestTooLarge:
+        return JSONResponse({"error": "Image too large"}, status_code=413)
+    file = form.get('image')
+
+    # Check if image is present in request
+    if file is None or isinstance(file, str):
+        return JSONResponse({"error": "No image provided"}, status_code=400)
+    if not file.filename:
+        return JSONResponse({"error": "No image selected"}, status_code=400)
+
+    color_mode = form.get('color_mode') or None
+    if color_mode is not None and color_mode not in COLOR_MODES:
+        return JSONResponse({"error": f"color_mode must be one of {', '.join(COLOR_MODES)}"}, status_code=400)
+    vision_profile = form.get('vision_profile') or None
+    if vision_profile is not None and vision_profile not in VISION_PROFILES:
+        return JSONResponse({"error": f"vision_profile must be one of {', '.join(VISION_PROFILES)}"}, status_code=400)
+
+    try:
+        result = await request.app.state.analyze_pipeline.run(
+            await file.read(),
+            debug=DEBUG,
+            color_mode=color_mode,
+            vision_profile=vision_profile
+        )
+
+        response = {"success": True}
+        response.update(result)
+        return JSONResponse(response)
+
+    except StageTimeoutError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=504)
+
+    except Exception as e:
+        ERRORS.labels("api", "analyze").inc()
+        log.exception("api.analyze_failed")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+async def pool_stats(request: Request):
+    """Report request and rate limiting counters of the async Spotify client"""
+    spotify_client = request.app.state.spotify_client
+    return JSONResponse({
+        "spotify": spotify_client.pool_stats(),
+        "spotify_scheduler": spotify_client.scheduler_stats()
+    })
+
+async def vision_stats(request: Request):
+    """Report calls, billable units and latency of Vision annotation per profile"""
+    return JSONResponse({
+        "default_profile": request.app.state.analyze_pipeline.vision_profile,
+        "profiles": vision_usage.stats()
+    })
+
+async def metrics(request: Request):
+    """Stage latency histograms, Spotify call latency, error counts and cache ratios in Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+class RequestMetricsMiddleware:
+    """
+    Record the duration of each HTTP request by route, method and status.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(route.path if route is not None else "unmatched", scope["method"],
+                                        str(status["code"])).observe(time.perf_counter() - started)
+
+class RequestIdMiddleware:
+    """
+    Bind a request id for log correlation (the caller's X-Request-ID if it is
+    well formed) and return it in the X-Request-ID response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"x-request-id"), None)
+        # Each request runs in its own task, so the id doesn't leak into other requests
+        request_id = bind_request_id(incoming)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+app = Starlette(
+    debug=DEBUG,
+    routes=[
+        Route('/api/health', health_check, methods=['GET']),
+        Route('/api/analyze', analyze, methods=['POST']),
+        Route('/api/pool-stats', pool_stats, methods=['GET']),
+        Route('/api/vision-stats', vision_stats, methods=['GET']),
+        Route('/api/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(RequestIdMiddleware),
+        Middleware(RequestMetricsMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,214 @@
+import asyncio
+import time
+from typing import Dict, Any, Optional, Tuple
+from async_spotify_client import AsyncSpotifyClient
+from cache import RecommendationCache, TieredCache, content_hash
+from hash_index import HammingIndex
+from image_analyzer import (COLOR_MODES, DEFAULT_VISION_PROFILE, VISION_PROFILES, analysis_variant,
+                            annotate_image_content_async, empty_annotations, get_local_features)
+from metrics import ERRORS, STAGE_SECONDS
+from music_recommender import finalize_recommendations, mood_for_genres, recommend_from_catalog
+from pipeline import StageTimeoutError, lookup_near_duplicate
+from track_catalog import TrackCatalog
+from logs import get_logger
+
+log = get_logger(__name__)
+
+class AsyncAnalyzePipeline:
+    """
+    asyncio version of AnalyzePipeline for the ASGI app.
+
+    The Vision and Spotify calls are awaited on the event loop instead of
+    holding a thread each, so one process can keep hundreds of runs in
+    flight. The local PIL work, and the analysis cache when it has a SQLite
+    tier, still need a thread and run via to_thread.
+    Stage timeouts, the total deadline, caching (including near-duplicate
+    hits) and the result format are the same as AnalyzePipeline's.
+    """
+
+    def __init__(self, spotify_client: AsyncSpotifyClient, analysis_cache: TieredCache,
+                 stage_timeouts: Optional[Dict[str, float]] = None,
+                 total_deadline: float = 25, color_mode: str = 'vision',
+                 track_catalog: Optional[TrackCatalog] = None,
+                 near_duplicate_index: Optional[HammingIndex] = None,
+                 vision_profile: str = DEFAULT_VISION_PROFILE,
+                 recommendation_cache: Optional[RecommendationCache] = None):
+        """
+        Initialize the pipeline.
+
+        Args:
+            spotify_client: AsyncSpotifyClient instance
+            analysis_cache: Cache of image features keyed by content hash
+            stage_timeouts: Seconds allowed per stage (vision, local, recommend)
+            total_deadline: Seconds allowed for the whole run
+            color_mode: Default source of dominant colors, one of COLOR_MODES
+            track_catalog: Optional local catalog tried before Spotify search
+            near_duplicate_index: Optional perceptual hash index for near-duplicate cache hits
+            vision_profile: Default set of Vision annotations, one of VISION_PROFILES
+            recommendation_cache: Optional cache of tracks shared by images with the same quantized mood
+        """
+        self.spotify_client = spotify_client
+        self.analysis_cache = analysis_cache
+        self.stage_timeouts = {
+            "vision": 15,
+            "local": 10,
+            "recommend": 15,
+        }
+        self.stage_timeouts.update(stage_timeouts or {})
+        self.total_deadline = total_deadline
+        self.color_mode = color_mode
+        self.track_catalog = track_catalog
+        self.near_duplicate_index = near_duplicate_index
+        self.vision_profile = vision_profile
+        self.recommendation_cache = recommendation_cache
+        # The event loop only keeps weak references to tasks nobody awaits
+        self._background_tasks = set()
+
+    async def run(self, content: bytes, debug: bool = False, color_mode: Optional[str] = None,
+                  vision_profile: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Analyze an uploaded image and recommend music for it.
+
+        Args:
+            content: Encoded image bytes
+            debug: Include per-stage timings in the result
+            color_mode: Source of dominant colors for this run, defaults to the pipeline's
+            vision_profile: Vision annotations for this run, defaults to the pipeline's
+
+        Returns:
+            Dictionary with image_features, recommendations and, in debug mode, timings
+        """
+        color_mode = color_mode or self.color_mode
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode: {color_mode}")
+        vision_profile = vision_profile or self.vision_profile
+        if vision_profile not in VISION_PROFILES:
+            raise ValueError(f"Unknown Vision profile: {vision_profile}")
+        variant = analysis_variant(color_mode, vision_profile)
+
+        started = time.perf_counter()
+        deadline = started + self.total_deadline
+        timings = {}
+
+        image_hash = content_hash(content)
+        perceptual_hash, image_features = await self._cached_features(content, image_hash, variant, timings)
+
+        if image_features is None:
+            local_colors = color_mode != 'vision'
+
+            # Start the genre catalog load alongside the image stages
+            genres = asyncio.ensure_future(self._timed(timings, "genres", started,
+                                                       self.spotify_client.get_available_genre_seeds()))
+            self._background_tasks.add(genres)
+            genres.add_done_callback(self._background_tasks.discard)
+            local = self._wait(self._timed(timings, "local", started,
+                                           asyncio.to_thread(get_local_features, content, local_colors)),
+                               "local", deadline)
+            if color_mode == 'local_only':
+                image_features = empty_annotations()
+                image_features.update(await local)
+            else:
+                vision = self._wait(self._timed(timings, "vision", started,
+                                                annotate_image_content_async(content, not local_colors,
+                                                                             vision_profile)),
+                                    "vision", deadline)
+                image_features, local_features = await asyncio.gather(vision, local)
+                image_features.update(local_features)
+            await self._cache_set(f"{image_hash}:{variant}", image_features)
+            if perceptual_hash is not None:
+                self.near_duplicate_index.add(perceptual_hash, image_hash)
+
+        recommendations = await self._wait(self._timed(timings, "recommend", started,
+                                                       self._recommend(image_features)),
+                                           "recommend", deadline)
+
+        result = {
+            "image_features": image_features,
+            "recommendations": recommendations
+        }
+        if debug:
+            timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            result["timings"] = dict(timings)
+        return result
+
+    async def _cached_features(self, content: bytes, image_hash: str, variant: str,
+                               timings: Dict[str, Any]) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+        """
+        Async equivalent of AnalyzePipeline._cached_features.
+        """
+        cache_key = f"{image_hash}:{variant}"
+        image_features = await self._cache_get(cache_key)
+        timings["cache"] = {"hit": image_features is not None}
+        if image_features is not None or self.near_duplicate_index is None:
+            return None, image_features
+
+        # Hashing decodes the image, so it stays off the event loop
+        perceptual_hash, image_features, distance, _ = await asyncio.to_thread(
+            lookup_near_duplicate, self.near_duplicate_index, self.analysis_cache, content, variant)
+        if image_features is not None:
+            timings["cache"] = {"hit": True, "near_duplicate_distance": distance}
+            await self._cache_set(cache_key, image_features)
+        return perceptual_hash, image_features
+
+    async def _cache_get(self, key: str) -> Optional[Any]:
+        # A SQLite tier means blocking disk I/O, which would stall every request on the loop
+        if self.analysis_cache.disk is None:
+            return self.analysis_cache.get(key)
+        return await asyncio.to_thread(self.analysis_cache.get, key)
+
+    async def _cache_set(self, key: str, value: Any):
+        if self.analysis_cache.disk is None:
+            self.analysis_cache.set(key, value)
+        else:
+            await asyncio.to_thread(self.analysis_cache.set, key, value)
+
+    async def _recommend(self, image_features: Dict[str, Any]):
+        """
+        Async equivalent of get_music_recommendations.
+        """
+        try:
+            with STAGE_SECONDS.labels("genre_fetch").time():
+                available_genres = await self.spotify_client.get_available_genre_seeds()
+        except Exception as e:
+            ERRORS.labels("recommender", "genres").inc()
+            log.warning("recommend.genres_unavailable", error=str(e))
+            available_genres = frozenset()
+
+        mood = mood_for_genres(image_features, available_genres)
+        cache = self.recommendation_cache
+        tracks = cache.lookup(mood) if cache is not None else None
+        if tracks is None:
+            query_mood = cache.pool_mood(mood) if cache is not None else mood
+            tracks = recommend_from_catalog(query_mood, self.track_catalog)
+            if not tracks:
+                with STAGE_SECONDS.labels("search").time():
+                    tracks = await self.spotify_client.get_recommendations_via_search(**query_mood['params'])
+            if cache is not None:
+                tracks = cache.store(mood, tracks)
+        return finalize_recommendations(tracks, mood, image_features)
+
+    async def _wait(self, awaitable, stage: str, deadline: float):
+        """
+        Await a stage, bounded by its own timeout and the total deadline.
+        """
+        timeout = min(self.stage_timeouts[stage], max(deadline - time.perf_counter(), 0))
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            ERRORS.labels("pipeline", f"{stage}_timeout").inc()
+            log.warning("pipeline.stage_timeout", stage=stage, timeout=timeout)
+            raise StageTimeoutError(stage, timeout)
+
+    @staticmethod
+    async def _timed(timings: Dict[str, Any], stage: str, started: float, awaitable):
+        """
+        Await a stage and record when it started and how long it took.
+        """
+        stage_start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            timings[stage] = {
+                "start_ms": round((stage_start - started) * 1000, 1),
+                "duration_ms": round((time.perf_counter() - stage_start) * 1000, 1)
+            }
@@ -0,0 +1,555 @@
+import asyncio
+import base64
+import time
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+import httpx
+from cache import LRUCache, StaleWhileRevalidateCache
+from rate_limit import TokenBucket, CircuitBreaker, CircuitOpenError, backoff_delay, parse_retry_after
+from metrics import ERRORS, SPOTIFY_REQUEST_SECONDS, spotify_endpoint
+from spotify_client import SpotifyClient, SPOTIFY_API_URL, SPOTIFY_ACCOUNTS_URL, rank_search_results
+from track_store import Track, TrackStore, track_chunks
+from logs import get_logger
+
+log = get_logger(__name__)
+
+class AsyncSpotifyClient:
+    """
+    asyncio counterpart of SpotifyClient built on httpx.
+
+    It has the same public surface (search_tracks, get_recommendations_via_search,
+    get_available_genre_seeds, ...) as coroutines, and the same search cache,
+    rate limiting, retry and circuit breaker behaviour. One instance serves any
+    number of concurrent requests on the event loop it is used from.
+    """
+
+    def __init__(self, client_id: str, client_secret: str, max_connections: int = 100,
+                 connect_timeout: float = 3.05, read_timeout: float = 10,
+                 genre_ttl: float = 86400, search_cache: Optional[StaleWhileRevalidateCache] = None,
+                 rate_limit: float = 10, rate_burst: int = 20, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_cap: float = 8,
+                 breaker_threshold: int = 5, breaker_reset: float = 30,
+                 api_url: str = SPOTIFY_API_URL, accounts_url: str = SPOTIFY_ACCOUNTS_URL,
+                 track_store: Optional[TrackStore] = None, search_fanout: int = 4,
+                 search_budget: float = 1.5):
+        """
+        Initialize the client. The HTTP connection pool is opened on first use.
+
+        Args:
+            client_id: Spotify API client ID
+            client_secret: Spotify API client secret
+            max_connections: Maximum number of concurrent connections
+            connect_timeout: Seconds to wait for a connection to be established
+            read_timeout: Seconds to wait for a response once connected
+            genre_ttl: Seconds before the cached genre seed catalog is refreshed
+            search_cache: Cache for search results, in-process with a 1 hour TTL by default
+            rate_limit: Requests per second allowed across all tasks
+            rate_burst: Requests that may be sent at once before rate_limit applies
+            max_retries: Retries for 429, 5xx and connection errors
+            backoff_base: Scale of the jittered exponential backoff in seconds
+            backoff_cap: Longest wait between retries; a longer Retry-After opens the circuit instead
+            breaker_threshold: Consecutive failures that open the circuit breaker
+            breaker_reset: Seconds the circuit stays open before a trial request
+            api_url: Base URL of the Web API
+            accounts_url: Base URL of the accounts service that issues tokens
+            track_store: Store of parsed tracks by id, created per client by default
+            search_fanout: Most searches run for one set of recommendation params
+            search_budget: Seconds to wait for searches beyond the best-matching one
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_url = api_url.rstrip("/")
+        self.accounts_url = accounts_url.rstrip("/")
+        self.token = None
+        self.token_expiry = 0
+        self._token_lock = asyncio.Lock()
+        self._token_refresh: Optional[asyncio.Task] = None
+        self._refresh_margin = 300  # Refresh in the background 5 minutes before expiry
+
+        self.genre_ttl = genre_ttl
+        self._genre_seeds = frozenset()
+        self._genre_fetched_at = 0
+        self._genre_attempted_at = 0
+        self._genre_retry_interval = 60
+        self._genre_lock = asyncio.Lock()
+        self._genre_refresh: Optional[asyncio.Task] = None
+
+        self.search_cache = search_cache or StaleWhileRevalidateCache(
+            LRUCache(max_entries=2048), ttl=3600, stale_ttl=86400)
+        self.track_store = track_store or TrackStore()
+        self.search_fanout = max(search_fanout, 1)
+        self.search_budget = search_budget
+        # Searches dropped past the budget keep running; hold them until they finish
+        self._background_searches = set()
+
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._http = None
+        self._requests_total = 0
+        self._requests_in_flight = 0
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._throttled = 0
+        self._retried = 0
+        self._short_circuited = 0
+        self._rate_limit_wait = 0.0
+        self._searches_dropped = 0
+
+    # Pure helpers are shared with the sync client so both build identical queries
+    build_search_queries = SpotifyClient.build_search_queries
+    _search_cache_key = staticmethod(SpotifyClient._search_cache_key)
+    _store_tracks = SpotifyClient._store_tracks
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """
+        Return the pooled HTTP client, creating it on first use.
+        """
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections)
+            )
+        return self._http
+
+    async def aclose(self):
+        """
+        Stop the token refresh task and close the connection pool.
+        """
+        if self._token_refresh is not None:
+            self._token_refresh.cancel()
+            self._token_refresh = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _request(self, method: str, url: str, use_breaker: bool = True, **kwargs) -> httpx.Response:
+        """
+        Send an HTTP request, with the same rate limiting, retries and circuit
+        breaker as SpotifyClient._request.
+
+        Args:
+            method: HTTP method (GET, POST, etc.)
+            url: Full request URL
+            use_breaker: Whether to ask the circuit breaker before sending; off for a
+                token refresh made on behalf of a request it already let through
+            **kwargs: Extra arguments passed to httpx (headers, params, data, json)
+
+        Returns:
+            The HTTP response (the last one if retries ran out)
+
+        Raises:
+            CircuitOpenError: If the circuit breaker is open
+        """
+        http = self.http
+
+        attempt = 0
+        while True:
+            trial = self.breaker.acquire() if use_breaker else False
+            if trial is None:
+                self._short_circuited += 1
+                raise CircuitOpenError(self.breaker.retry_in())
+
+            try:
+                await self._wait_for_rate_limit()
+
+                try:
+                    response = await self._send(http, method, url, **kwargs)
+                except httpx.HTTPError as e:
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries or not isinstance(e, httpx.TransportError):
+                        raise
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                else:
+                    # The token was revoked or expired early: refresh once and retry,
+                    # without asking the breaker again (this may be its trial request)
+                    headers = kwargs.get("headers") or {}
+                    authorization = headers.get("Authorization", "")
+                    if response.status_code == 401 and authorization.startswith("Bearer "):
+                        self._invalidate_token(authorization[len("Bearer "):])
+                        token = await self._ensure_token(use_breaker=False)
+                        kwargs["headers"] = dict(headers, Authorization=f"Bearer {token}")
+                        await self._wait_for_rate_limit()
+                        response = await self._send(http, method, url, **kwargs)
+
+                    if response.status_code != 429 and response.status_code < 500:
+                        self.breaker.record_success()
+                        return response
+
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if response.status_code == 429:
+                        self._throttled += 1
+                        if retry_after is not None and retry_after > self.backoff_cap:
+                            self.breaker.record_failure(open_for=retry_after)
+                            return response
+
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries:
+                        return response
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap, retry_after)
+            finally:
+                # Also reached on cancellation (a pipeline stage timing out), which
+                # would otherwise leave the trial in flight and the circuit shut for good
+                if trial:
+                    self.breaker.release_trial()
+
+            attempt += 1
+            self._retried += 1
+            await asyncio.sleep(delay)
+
+    async def _wait_for_rate_limit(self):
+        """
+        Take a token from the shared rate limiter, counting the time spent waiting.
+        """
+        waited = self.rate_limiter.reserve()
+        if waited:
+            self._rate_limit_wait += waited
+            await asyncio.sleep(waited)
+
+    async def _send(self, http: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a single HTTP request, tracking pool usage and latency.
+        """
+        self._requests_total += 1
+        self._requests_in_flight += 1
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await http.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            SPOTIFY_REQUEST_SECONDS.labels(spotify_endpoint(url), status).observe(time.perf_counter() - started)
+            self._requests_in_flight -= 1
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """
+        Report request counters for this client.
+        """
+        return {
+            "requests_total": self._requests_total,
+            "requests_in_flight": self._requests_in_flight,
+            "max_connections": self.max_connections
+        }
+
+    def scheduler_stats(self) -> Dict[str, Any]:
+        """
+        Report rate limiting, retry and circuit breaker counters, as SpotifyClient does.
+        """
+        return {
+            "throttled": self._throttled,
+            "retried": self._retried,
+            "short_circuited": self._short_circuited,
+            "searches_dropped": self._searches_dropped,
+            "rate_limit_wait_seconds": round(self._rate_limit_wait, 3),
+            "circuit": self.breaker.stats()
+        }
+
+    def circuit_open(self) -> bool:
+        """
+        Whether calls to Spotify are currently being short-circuited.
+        """
+        return self.breaker.state == "open"
+
+    async def _get_auth_token(self, use_breaker: bool = True) -> str:
+        """
+        Get a new auth token from Spotify using client credentials flow.
+        """
+        token, expiry = await self._fetch_token(use_breaker)
+        self.token_expiry = expiry
+        self.token = token
+
+        self._start_background_refresh()
+
+        return self.token
+
+    async def _fetch_token(self, use_breaker: bool = True) -> Tuple[str, float]:
+        """
+        Request a new token from the accounts service without storing it.
+
+        Returns:
+            The bearer token and the time it expires
+        """
+        auth_base64 = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode("utf-8")).decode("utf-8")
+        response = await self._request(
+            "POST",
+            f"{self.accounts_url}/token",
+            use_breaker=use_breaker,
+            headers={
+                "Authorization": f"Basic {auth_base64}",
+                "Content-Type": "application/x-www-form-urlencoded"
+            },
+            data={"grant_type": "client_credentials"}
+        )
+        response.raise_for_status()
+
+        json_result = response.json()
+        return json_result["access_token"], time.time() + json_result["expires_in"]
+
+    async def _ensure_token(self, use_breaker: bool = True) -> str:
+        """
+        Ensure we have a valid token, refreshing if necessary.
+
+        A background task renews the token inside the refresh margin, as
+        SpotifyClient's refresh thread does. Only if that hasn't happened
+        within a minute of expiry does a request renew it, and then only one
+        task does while the others keep using the current token.
+        """
+        token = self.token
+        now = time.time()
+        if token is not None and now < self.token_expiry - 60:
+            # Restarts the refresh task if aclose() stopped it
+            self._start_background_refresh()
+            return token
+
+        if token is not None and now < self.token_expiry and self._token_lock.locked():
+            return token
+
+        async with self._token_lock:
+            if self.token is None or time.time() >= self.token_expiry - 60:
+                try:
+                    return await self._get_auth_token(use_breaker)
+                except Exception as e:
+                    if self.token is None or time.time() >= self.token_expiry:
+                        raise
+                    log.warning("spotify.token_refresh_failed", error=str(e))
+            return self.token
+
+    def _start_background_refresh(self):
+        """
+        Start the task that renews the token before it expires, so requests
+        never have to wait on the token endpoint.
+        """
+        if self._token_refresh is None or self._token_refresh.done():
+            self._token_refresh = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        """
+        Sleep until the refresh margin before expiry, then renew the token.
+        """
+        while True:
+            delay = self.token_expiry - self._refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 1))
+
+            if time.time() < self.token_expiry - self._refresh_margin:
+                continue
+
+            # Not under _token_lock, which requests wait on when they need a token now
+            try:
+                token, expiry = await self._fetch_token()
+            except Exception as e:
+                log.warning("spotify.token_refresh_failed", background=True, error=str(e))
+                await asyncio.sleep(5)
+                continue
+
+            # A request may have stored a newer token meanwhile
+            if expiry > self.token_expiry:
+                self.token_expiry = expiry
+                self.token = token
+
+    def _invalidate_token(self, token: str):
+        """
+        Forget a token the API rejected, unless another task already replaced it.
+        """
+        if self.token == token:
+            self.token = None
+            self.token_expiry = 0
+
+    async def search_tracks(self, query: str, limit: int = 10) -> List[Track]:
+        """
+        Search for tracks on Spotify, serving repeated queries from the search cache.
+
+        Args:
+            query: Search query string
+            limit: Maximum number of results to return
+
+        Returns:
+            List of tracks
+        """
+        async def load():
+            response = await self._search(query, limit)
+            response.raise_for_status()
+            return self._store_tracks(response.json().get("tracks", {}).get("items", []))
+
+        track_ids = await self.search_cache.get_or_load_async(self._search_cache_key(query, limit), load)
+        return await self.get_tracks(track_ids)
+
+    async def get_tracks(self, track_ids: List[str]) -> List[Track]:
+        """
+        Resolve track ids through the track store, fetching the missing ones
+        from GET /v1/tracks in concurrent batches of TRACKS_PER_REQUEST.
+
+        Args:
+            track_ids: Spotify track ids
+
+        Returns:
+            Tracks in the order of track_ids, skipping ids Spotify doesn't know
+        """
+        found, missing = self.track_store.get_many(track_ids)
+        if missing:
+            token = await self._ensure_token()
+
+            async def fetch(chunk: List[str]) -> List[Track]:
+                response = await self._request("GET", f"{self.api_url}/tracks",
+                                               headers={"Authorization": f"Bearer {token}"},
+                                               params={"ids": ",".join(chunk)})
+                response.raise_for_status()
+                return [track for track in map(Track.from_api, response.json().get("tracks", []))
+                        if track is not None]
+
+            for tracks in await asyncio.gather(*(fetch(chunk) for chunk in track_chunks(missing))):
+                self.track_store.put_many(tracks)
+                found.update((track.id, track) for track in tracks)
+
+        return [found[track_id] for track_id in track_ids if track_id in found]
+
+    async def get_recommendations_via_search(self, **params) -> List[Track]:
+        """
+        Search for tracks matching recommendation params, fanning out and
+        merging the searches as SpotifyClient does.
+        """
+        limit = params.get('limit', 10)
+        queries = self.build_search_queries(**params)
+        searches = [(query, limit) for query, _ in queries]
+        results = await self.search_all(searches, required=searches[:1])
+        return rank_search_results(
+            [(weight, results[search]) for (_, weight), search in zip(queries, searches) if search in results],
+            limit)
+
+    async def search_all(self, searches: Iterable[Tuple[str, int]],
+                         required: Iterable[Tuple[str, int]] = ()) -> Dict[Tuple[str, int], List[Track]]:
+        """
+        Run recommendation searches concurrently, waiting for those in required
+        however long they take and for the rest up to search_budget seconds,
+        as SpotifyClient.search_all does.
+        """
+        searches = list(dict.fromkeys(searches))
+        if len(searches) == 1:
+            return {searches[0]: await self.search_for_recommendations(*searches[0])}
+
+        tasks = {search: asyncio.ensure_future(self.search_for_recommendations(*search)) for search in searches}
+        for task in tasks.values():
+            self._background_searches.add(task)
+            task.add_done_callback(self._background_searches.discard)
+        await asyncio.wait(tasks.values(), timeout=self.search_budget)
+        pending = [tasks[search] for search in required if not tasks[search].done()]
+        if pending:
+            await asyncio.wait(pending)
+
+        results = {search: task.result() for search, task in tasks.items() if task.done()}
+        dropped = len(tasks) - len(results)
+        if dropped:
+            self._searches_dropped += dropped
+            log.debug("spotify.searches_dropped", dropped=dropped, searches=len(tasks), budget=self.search_budget)
+        return results
+
+    async def search_for_recommendations(self, search_query: str, limit: int = 10) -> List[Track]:
+        """
+        Run a recommendation search query, returning no tracks instead of raising on API errors.
+        Results share the search cache with search_tracks; empty results are not cached.
+
+        Args:
+            search_query: Query built by build_search_queries
+            limit: Maximum number of results to return
+
+        Returns:
+            List of tracks
+        """
+        async def load():
+            try:
+                response = await self._search(search_query, limit)
+                response.raise_for_status()
+                return self._store_tracks(response.json().get("tracks", {}).get("items", []))
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                log.warning("spotify.search_failed", query=search_query, error=str(e))
+                return []
+
+        try:
+            track_ids = await self.search_cache.get_or_load_async(
+                self._search_cache_key(search_query, limit), load, cacheable=bool)
+            return await self.get_tracks(track_ids)
+        except CircuitOpenError as e:
+            ERRORS.labels("spotify", "circuit_open").inc()
+            log.warning("spotify.search_skipped", query=search_query, reason=str(e))
+            return []
+        except Exception as e:
+            ERRORS.labels("spotify", "search").inc()
+            log.warning("spotify.tracks_failed", query=search_query, error=str(e))
+            return []
+
+    async def _search(self, query: str, limit: int) -> httpx.Response:
+        token = await self._ensure_token()
+        return await self._request(
+            "GET",
+            f"{self.api_url}/search",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"q": query, "type": "track", "limit": limit}
+        )
+
+    async def get_available_genre_seeds(self) -> frozenset:
+        """
+        Get the set of available genre seeds from Spotify.
+
+        Loaded once, then served from memory and refreshed in a background
+        task when older than genre_ttl, like SpotifyClient does.
+
+        Returns:
+            frozenset: Available genre seeds
+        """
+        if self._genre_fetched_at == 0 and self._genre_attempted_at == 0:
+            # First use: nothing to serve yet, so load now
+            async with self._genre_lock:
+                if self._genre_attempted_at == 0:
+                    await self._fetch_genre_seeds()
+        elif self._genre_seeds_stale() and (self._genre_refresh is None or self._genre_refresh.done()):
+            # Assigned before the task first runs, so other requests in the same
+            # tick see it; the reference also keeps the task from being collected
+            self._genre_refresh = asyncio.ensure_future(self._refresh_genre_seeds())
+
+        return self._genre_seeds
+
+    async def _refresh_genre_seeds(self):
+        """
+        Background refresh for get_available_genre_seeds, skipped if a load
+        finished while it waited for the lock.
+        """
+        async with self._genre_lock:
+            if self._genre_seeds_stale():
+                await self._fetch_genre_seeds()
+
+    async def load_genre_seeds(self) -> frozenset:
+        """
+        Fetch the genre seed catalog now, keeping the previous copy on failure.
+
+        Returns:
+            frozenset: Available genre seeds
+        """
+        async with self._genre_lock:
+            await self._fetch_genre_seeds()
+        return self._genre_seeds
+
+    async def _fetch_genre_seeds(self):
+        """
+        Fetch genre seeds from Spotify into the cached catalog. Caller holds _genre_lock.
+        """
+        self._genre_attempted_at = time.time()
+        try:
+            token = await self._ensure_token()
+            response = await self._request(
+                "GET",
+                f"{self.api_url}/recommendations/available-genre-seeds",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+            response.raise_for_status()
+            self._genre_seeds = frozenset(response.json().get("genres", []))
+            self._genre_fetched_at = time.time()
+        except Exception as e:
+            log.warning("spotify.genre_refresh_failed", cached=len(self._genre_seeds), error=str(e))
+
+    _genre_seeds_stale = SpotifyClient._genre_seeds_stale
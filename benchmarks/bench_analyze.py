@@ -0,0 +1,189 @@
+"""
+End-to-end benchmark of /api/analyze with both upstreams replaced by local
+stand-ins: a gRPC Vision annotator (benchmarks/stub_vision.py) and the
+Spotify stub (benchmarks/stub_spotify.py), each with configurable latency
+and failure rates. Nothing leaves the machine, so runs are repeatable and
+need no credentials.
+
+The server is driven at each concurrency level in turn, and the report
+gives throughput, p50/p95/p99 latency, failed requests, and the Vision
+RPCs and Spotify API calls the server made per request (read from the
+stubs' counters). By default the analysis, near-duplicate, mood and
+search caches are disabled so every request goes through the whole pipeline;
+--warm-caches keeps them, as for repeat uploads. Run from the repository
+root:
+
+    python -m benchmarks.bench_analyze [--servers sync,async] [--concurrency 1,8,32]
+        [--requests 200] [--vision-latency 0.3] [--spotify-latency 0.2]
+        [--vision-error-rate 0] [--spotify-error-rate 0] [--spotify-throttle-rate 0]
+        [--save results.json] [--compare baseline.json --tolerance 0.2] [image ...]
+
+Without image arguments the images in uploads/ are used. With --compare,
+the run is checked against a result file saved earlier with --save and
+the exit status is 1 if throughput dropped, latency grew or more
+outbound calls were made by more than the tolerance.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+from typing import Dict, Any, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.load_async import drive, server_env, start_server, wait_until_healthy
+from benchmarks.stub_spotify import StubSpotifyServer
+from benchmarks.stub_vision import StubVisionServer
+
+# Result fields checked by --compare, and whether larger values are better
+CHECKED_FIELDS = {
+    "throughput": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "vision_calls": False,
+    "spotify_calls": False,
+}
+
+def benchmark_env(spotify: StubSpotifyServer, vision: StubVisionServer, args) -> Dict[str, str]:
+    env = server_env(spotify)
+    env.update({
+        "VISION_API_ENDPOINT": vision.endpoint,
+        "VISION_API_INSECURE": "True",
+        "COLOR_MODE": args.color_mode,
+        "VISION_PROFILE": args.vision_profile,
+        "FLASK_DEBUG": "False",
+    })
+    if args.warm_caches:
+        env.update({"SEARCH_CACHE_TTL": "3600", "SEARCH_CACHE_STALE_TTL": "86400"})
+    else:
+        env.update({"ANALYSIS_CACHE_TTL": "0", "NEAR_DUPLICATE_DISTANCE": "-1", "MOOD_CACHE_SIZE": "0"})
+        # Shared on-disk tiers would carry results over between runs
+        for name in ("ANALYSIS_CACHE_DB", "SEARCH_CACHE_DB"):
+            env.pop(name, None)
+    return env
+
+def run_server(kind: str, port: int, images: List[bytes], spotify: StubSpotifyServer,
+               vision: StubVisionServer, env: Dict[str, str], args) -> List[Dict[str, Any]]:
+    process = start_server(kind, port, args.sync_workers, env)
+    results = []
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        asyncio.run(wait_until_healthy(base_url))
+        # Token, genre catalog and Vision channel, once per worker at most
+        warm_up = max(len(images), args.sync_workers if kind == "sync" else 1)
+        asyncio.run(drive(base_url, images, warm_up, warm_up, warm_up=False))
+
+        for concurrency in args.concurrency:
+            vision_before, spotify_before = vision.rpcs, spotify.requests
+            result = asyncio.run(drive(base_url, images, args.requests, concurrency, warm_up=False))
+            result.update({
+                "server": kind,
+                "concurrency": concurrency,
+                "vision_calls": (vision.rpcs - vision_before) / args.requests,
+                "spotify_calls": (spotify.requests - spotify_before) / args.requests,
+            })
+            results.append(result)
+            print(f"{kind:<6} {concurrency:>5} {result['throughput']:>8.1f} {result['p50_ms']:>8.0f} "
+                  f"{result['p95_ms']:>8.0f} {result['p99_ms']:>8.0f} {result['errors']:>7} "
+                  f"{result['vision_calls']:>9.2f} {result['spotify_calls']:>10.2f}")
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Describe every checked field that got worse than the baseline by more than tolerance
+    """
+    previous = {(result["server"], result["concurrency"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["server"], result["concurrency"]))
+        if before is None:
+            continue
+        label = f"{result['server']} at concurrency {result['concurrency']}"
+        for field, higher_is_better in CHECKED_FIELDS.items():
+            old, new = before.get(field), result.get(field)
+            if old is None or new is None or old != old or new != new:
+                continue
+            worse = new < old * (1 - tolerance) if higher_is_better else new > old * (1 + tolerance)
+            if worse:
+                regressions.append(f"{label}: {field} {old:.2f} -> {new:.2f}")
+        # Any new failures count, however few
+        if result["errors"] > before["errors"] * (1 + tolerance):
+            regressions.append(f"{label}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", help="Images to upload (default: uploads/*)")
+    parser.add_argument("--servers", default="sync,async")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--sync-workers", type=int, default=4, help="gunicorn sync workers")
+    parser.add_argument("--color-mode", default="vision", choices=["vision", "local", "local_only"])
+    parser.add_argument("--vision-profile", default="standard")
+    parser.add_argument("--vision-latency", type=float, default=0.3, help="Stub Vision response delay in seconds")
+    parser.add_argument("--vision-error-rate", type=float, default=0.0)
+    parser.add_argument("--spotify-latency", type=float, default=0.2, help="Stub Spotify response delay in seconds")
+    parser.add_argument("--spotify-error-rate", type=float, default=0.0, help="Fraction of Spotify calls failed with 503")
+    parser.add_argument("--spotify-throttle-rate", type=float, default=0.0, help="Fraction of Spotify calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with stub 429s")
+    parser.add_argument("--warm-caches", action="store_true", help="Keep the analysis, mood and search caches enabled")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Check the results against a JSON file written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression for --compare")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+
+    paths = args.images or sorted(glob.glob(os.path.join(ROOT, "uploads", "*")))
+    images = [open(path, "rb").read() for path in paths]
+    if not images:
+        parser.error("no images given and uploads/ is empty")
+
+    spotify = StubSpotifyServer(latency=args.spotify_latency, error_rate=args.spotify_error_rate,
+                                throttle_rate=args.spotify_throttle_rate, retry_after=args.retry_after).start()
+    vision = StubVisionServer(latency=args.vision_latency, error_rate=args.vision_error_rate).start()
+    env = benchmark_env(spotify, vision, args)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("images", "save", "compare")}
+    config["images"] = len(images)
+    print(f"{len(images)} images, {args.requests} requests per level, color mode {args.color_mode}, "
+          f"Vision {args.vision_latency * 1000:.0f} ms / {args.vision_error_rate:.0%} errors, "
+          f"Spotify {args.spotify_latency * 1000:.0f} ms / {args.spotify_error_rate:.0%} errors / "
+          f"{args.spotify_throttle_rate:.0%} 429s, caches {'on' if args.warm_caches else 'off'}")
+    print(f"{'server':<6} {'conc':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+          f"{'vision/req':>9} {'spotify/req':>10}")
+
+    results = []
+    try:
+        for port, kind in enumerate(args.servers.split(","), start=8921):
+            results += run_server(kind, port, images, spotify, vision, env, args)
+    finally:
+        vision.stop()
+        spotify.shutdown()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        changed = sorted(key for key in config if baseline["config"].get(key) != config[key])
+        if changed:
+            print(f"\nwarning: settings differ from the baseline: {', '.join(changed)}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nno regressions beyond {args.tolerance:.0%} against {args.compare}")
+
+if __name__ == "__main__":
+    main()
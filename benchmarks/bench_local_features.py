@@ -0,0 +1,132 @@
+"""
+Benchmark local image statistics: full-resolution decode with a Python
+histogram sum (the original get_local_features) against the downsampled,
+NumPy-vectorized local_features engine.
+
+Each implementation runs in a fresh child process so peak RSS is measured
+independently. Run from the repository root:
+
+    python -m benchmarks.bench_local_features [--repeat 5] [image ...]
+
+Without image arguments, synthetic 12MP and 24MP JPEGs are generated along
+with the photos in uploads/.
+"""
+import argparse
+import glob
+import io
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from local_features import extract_local_features
+
+def legacy_local_features(content: bytes) -> Dict[str, Any]:
+    """The implementation local_features replaced, kept verbatim as the baseline"""
+    image_obj = Image.open(io.BytesIO(content))
+    width, height = image_obj.size
+    gray_image = image_obj.convert('L')
+    histogram = gray_image.histogram()
+    pixels = sum(histogram)
+    brightness = sum(i * histogram[i] for i in range(256)) / pixels
+    return {"width": width, "height": height, "brightness": brightness / 255}
+
+IMPLEMENTATIONS = {
+    "legacy": legacy_local_features,
+    "engine": extract_local_features,
+}
+
+def synthetic_jpeg(width: int, height: int) -> bytes:
+    """Build a photo-like JPEG (gradients plus noise) of the given size"""
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = np.clip(x + rng.normal(0, 12, (height, width)), 0, 255)
+    pixels[..., 1] = np.clip(y + rng.normal(0, 12, (height, width)), 0, 255)
+    pixels[..., 2] = np.clip((x + y) / 2, 0, 255)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process in KiB"""
+    # VmHWM starts fresh after exec, unlike ru_maxrss which keeps the
+    # high-water mark of the parent that spawned us
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _worker(name: str, content: bytes, repeat: int, queue):
+    func = IMPLEMENTATIONS[name]
+    baseline_rss = peak_rss_kb()
+
+    durations = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(content)
+        durations.append((time.perf_counter() - started) * 1000)
+
+    queue.put({
+        "median_ms": statistics.median(durations),
+        "min_ms": min(durations),
+        "peak_rss_delta_mb": (peak_rss_kb() - baseline_rss) / 1024,
+        "brightness": result["brightness"],
+    })
+
+def measure(name: str, content: bytes, repeat: int) -> Dict[str, Any]:
+    """Run one implementation in a fresh process and collect its measurements"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_worker, args=(name, content, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def load_corpus(paths: List[str]) -> Dict[str, bytes]:
+    corpus = {}
+    if paths:
+        for path in paths:
+            with open(path, 'rb') as f:
+                corpus[os.path.basename(path)] = f.read()
+        return corpus
+
+    corpus["synthetic-4000x3000.jpg"] = synthetic_jpeg(4000, 3000)
+    corpus["synthetic-6000x4000.jpg"] = synthetic_jpeg(6000, 4000)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in sorted(glob.glob(os.path.join(root, 'uploads', '*')))[:1]:
+        with open(path, 'rb') as f:
+            corpus[os.path.basename(path)] = f.read()
+    return corpus
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('images', nargs='*', help='JPEG files to benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per implementation and image')
+    args = parser.parse_args()
+
+    print(f"{'image':<28} {'impl':<8} {'size':>8} {'median ms':>10} {'min ms':>8} {'peak RSS MB':>12} {'brightness':>11}")
+    for image_name, content in load_corpus(args.images).items():
+        for name in IMPLEMENTATIONS:
+            result = measure(name, content, args.repeat)
+            print(f"{image_name[:28]:<28} {name:<8} {len(content) / 1e6:>6.1f}MB "
+                  f"{result['median_ms']:>10.1f} {result['min_ms']:>8.1f} "
+                  f"{result['peak_rss_delta_mb']:>12.1f} {result['brightness']:>11.4f}")
+
+if __name__ == '__main__':
+    main()
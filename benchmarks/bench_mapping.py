@@ -0,0 +1,145 @@
+"""
+Microbenchmark the feature-to-audio mapping: the original if/elif hue chain
+and nested label loop against the compiled MoodMappingEngine, both per image
+and batched with score_batch. Run from the repository root:
+
+    python -m benchmarks.bench_mapping [--images 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mapping_engine import ENGINE
+
+LABEL_VOCABULARY = [
+    'Sky', 'Cloud', 'Beach', 'Sunset', 'Water', 'Mountain', 'Tree', 'Forest',
+    'Person', 'Smile', 'Food', 'Dish', 'City', 'Skyscraper', 'Night', 'Party',
+    'Concert', 'Animal', 'Dog', 'Nature', 'Plant', 'Building', 'Car', 'Road',
+]
+
+def legacy_map_features(image_features: Dict[str, Any]) -> Dict[str, Any]:
+    """The mapping part of the original get_music_recommendations, kept as the baseline"""
+    colors = image_features.get('dominant_colors', [])
+    labels = image_features.get('labels', [])
+    emotions = image_features.get('emotions', {})
+    brightness = image_features.get('brightness', 0.5)
+
+    energy = brightness
+    valence = 0.5
+    if emotions:
+        joy_level = emotions.get('joy', 0)
+        sadness_level = emotions.get('sorrow', 0)
+        valence = 0.5 + (joy_level * 0.1) - (sadness_level * 0.1)
+        valence = max(0.0, min(1.0, valence))
+
+    tempo = 0
+    genres = []
+    if colors:
+        main_color = colors[0]
+        hue = main_color.get('hsv', {}).get('h', 0)
+        saturation = main_color.get('hsv', {}).get('s', 0)
+        value = main_color.get('hsv', {}).get('v', 0)
+        if 0 <= hue < 0.05 or hue >= 0.95:
+            genres.extend(['rock', 'metal', 'punk'])
+            tempo += 150
+        elif 0.05 <= hue < 0.17:
+            genres.extend(['pop', 'reggae', 'latin'])
+            tempo += 110
+        elif 0.17 <= hue < 0.33:
+            genres.extend(['pop', 'dance', 'happy'])
+            tempo += 120
+        elif 0.33 <= hue < 0.5:
+            genres.extend(['chill', 'ambient', 'acoustic'])
+            tempo += 95
+        elif 0.5 <= hue < 0.66:
+            genres.extend(['jazz', 'blues', 'r-n-b'])
+            tempo += 85
+        elif 0.66 <= hue < 0.83:
+            genres.extend(['electronic', 'edm', 'synth'])
+            tempo += 130
+        else:
+            genres.extend(['pop', 'dance', 'disco'])
+            tempo += 120
+        if saturation > 0.7:
+            intensity_genres = ['electronic', 'rock', 'metal', 'edm']
+            genres = [g for g in genres if g in intensity_genres] or genres
+        energy = value
+
+    genre_mappings = {
+        'beach': ['reggae', 'surf rock', 'tropical house'],
+        'mountain': ['folk', 'ambient', 'acoustic'],
+        'city': ['hip hop', 'r&b', 'electronic'],
+        'forest': ['folk', 'acoustic', 'ambient'],
+        'night': ['electronic', 'chill', 'lo-fi'],
+        'sunset': ['indie', 'chill', 'ambient'],
+        'concert': ['rock', 'live', 'pop'],
+        'party': ['dance', 'pop', 'hip hop'],
+        'nature': ['acoustic', 'folk', 'ambient'],
+        'food': ['jazz', 'lounge', 'bossa nova'],
+        'person': ['pop', 'r&b', 'soul'],
+        'animal': ['folk', 'classical', 'world'],
+        'water': ['ambient', 'chill', 'electronic'],
+        'sky': ['ambient', 'classical', 'post-rock'],
+    }
+    for label in labels:
+        description = label.get('description', '').lower()
+        for key, mapped_genres in genre_mappings.items():
+            if key in description:
+                genres.extend(mapped_genres)
+
+    unique_genres = list(set(genres))[:5]
+    if not unique_genres:
+        unique_genres = ['pop', 'rock', 'electronic']
+
+    return {'energy': energy, 'valence': valence, 'tempo': tempo, 'genres': unique_genres}
+
+def synthetic_features(count: int) -> List[Dict[str, Any]]:
+    rng = random.Random(0)
+    features_list = []
+    for _ in range(count):
+        features_list.append({
+            "dominant_colors": [{"hsv": {"h": rng.random(), "s": rng.random(), "v": rng.random()}}],
+            "labels": [{"description": rng.choice(LABEL_VOCABULARY), "score": 0.9} for _ in range(10)],
+            "emotions": {"joy": rng.randint(0, 5), "sorrow": rng.randint(0, 5), "anger": 0, "surprise": 0},
+            "brightness": rng.random(),
+        })
+    return features_list
+
+def check_equivalence(features_list: List[Dict[str, Any]]):
+    """Targets must match exactly; genres may differ only in set ordering and truncation"""
+    batch = ENGINE.score_batch(features_list)
+    for i, image_features in enumerate(features_list):
+        legacy = legacy_map_features(image_features)
+        engine = ENGINE.map_features(image_features)
+        for key in ('energy', 'valence', 'tempo'):
+            assert legacy[key] == engine[key], (key, legacy, engine)
+            assert abs(legacy[key] - batch[key][i]) < 1e-9, (key, legacy, batch[key][i])
+
+def bench(label: str, func, count: int, repeat: int = 5):
+    """Report the best of several runs to keep scheduler noise out"""
+    elapsed = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - started)
+    print(f"{label:<28} {elapsed * 1000:>9.1f} ms total {elapsed / count * 1e6:>8.2f} us/image")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', type=int, default=20000, help='Number of synthetic feature dicts')
+    args = parser.parse_args()
+
+    features_list = synthetic_features(args.images)
+    check_equivalence(features_list[:1000])
+
+    bench("legacy (per image)", lambda: [legacy_map_features(f) for f in features_list], args.images)
+    bench("engine.map_features", lambda: [ENGINE.map_features(f) for f in features_list], args.images)
+    bench("engine.score_batch", lambda: ENGINE.score_batch(features_list), args.images)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Measure how well the perceptual hash finds re-uploads of the same photo,
+and how fast the hamming index answers lookups as it grows.
+
+Precision/recall: distinct source images (crops of the given photos plus
+generated scenes) are hashed into an index. Each is then "re-uploaded" as
+re-encoded, resized, EXIF-stripped and slightly edited copies, which
+should match their source, and unrelated held-out images are looked up,
+which should not match anything.
+
+Lookup latency: the index is filled with random 64-bit hashes, then
+queried with near copies of stored hashes and with random hashes. A
+numpy linear scan is timed alongside as the baseline and to check that
+the index returns the same matches. Run from the repository root:
+
+    python -m benchmarks.bench_near_duplicate [--sources 200] [--sizes 10000,100000,1000000]
+        [--distance 6] [image ...]
+
+Without image arguments the photos in uploads/ are used.
+"""
+import argparse
+import glob
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageOps
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from hash_index import HammingIndex, hamming_distance
+from local_features import difference_hash
+
+def encode(image: Image.Image, format: str = "JPEG", **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+def generated_scene(rng: random.Random) -> Image.Image:
+    """A smooth random colour field with a few shapes, standing in for an unrelated photo"""
+    grid = np.array([[rng.choice(range(256)) for _ in range(3)] for _ in range(16)], dtype=np.uint8)
+    image = Image.fromarray(grid.reshape(4, 4, 3)).resize((640, 480), Image.Resampling.BICUBIC)
+    pixels = np.asarray(image).copy()
+    for _ in range(rng.randint(1, 4)):
+        x, y = rng.randrange(560), rng.randrange(400)
+        pixels[y:y + rng.randint(20, 80), x:x + rng.randint(20, 80)] = [rng.randrange(256) for _ in range(3)]
+    return Image.fromarray(pixels)
+
+def source_images(photos, count: int, rng: random.Random):
+    """Crops at random positions and scales of the given photos, plus generated scenes"""
+    images = []
+    for index in range(count):
+        if photos and index % 2 == 0:
+            photo = photos[index // 2 % len(photos)]
+            width, height = photo.size
+            side = int(min(width, height) * rng.uniform(0.3, 0.8))
+            x, y = rng.randrange(width - side + 1), rng.randrange(height - side + 1)
+            images.append(photo.crop((x, y, x + side, y + side)).resize((800, 800)))
+        else:
+            images.append(generated_scene(rng))
+    return images
+
+def reuploads(image: Image.Image, rng: random.Random):
+    """What a phone or a messaging app does to a photo before it's uploaded again"""
+    width, height = image.size
+    scale = rng.uniform(0.3, 0.8)
+    return {
+        "reencode": encode(image, quality=rng.randint(40, 80)),
+        "resize": encode(image.resize((int(width * scale), int(height * scale)))),
+        "png": encode(image, format="PNG"),
+        "exif_rotated": encode(image.rotate(-90, expand=True), exif=_orientation_exif(8)),
+        "brighter": encode(ImageEnhance.Brightness(image).enhance(1.1)),
+        "crop_2pct": encode(image.crop((width // 50, height // 50, width - width // 50, height - height // 50))),
+    }
+
+def _orientation_exif(orientation: int) -> bytes:
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    return exif.tobytes()
+
+def precision_recall(photos, count: int, distance: int, rng: random.Random):
+    sources = source_images(photos, count, rng)
+    held_out = source_images(photos, count, random.Random(rng.random()))
+
+    source_hashes = [difference_hash(encode(image, quality=95)) for image in sources]
+    variants = [(index, kind, difference_hash(content))
+                for index, image in enumerate(sources)
+                for kind, content in reuploads(image, rng).items()]
+    negatives = [difference_hash(encode(image, quality=95)) for image in held_out]
+
+    print(f"{len(sources)} sources, {len(variants)} re-uploads, {len(negatives)} unrelated images")
+    print(f"{'distance':>8} {'recall':>7} {'precision':>9} {'false matches':>14}")
+    for threshold in range(0, 13, 2):
+        index = HammingIndex(max_distance=threshold, max_entries=len(sources))
+        for position, value in enumerate(source_hashes):
+            index.add(value, position)
+
+        true_matches = wrong_matches = 0
+        for source, _, value in variants:
+            match = index.nearest(value)
+            if match is not None:
+                if match[0] == source:
+                    true_matches += 1
+                else:
+                    wrong_matches += 1
+        false_matches = sum(1 for value in negatives if index.nearest(value) is not None)
+
+        matches = true_matches + wrong_matches + false_matches
+        marker = "  <- configured" if threshold == distance else ""
+        print(f"{threshold:>8} {true_matches / len(variants):>7.1%} "
+              f"{true_matches / matches if matches else 1.0:>9.1%} {false_matches:>14}{marker}")
+
+    print("\nrecall per re-upload kind at the configured distance:")
+    for kind in reuploads(sources[0], rng):
+        distances = [hamming_distance(value, source_hashes[source])
+                     for source, variant_kind, value in variants if variant_kind == kind]
+        within = sum(1 for d in distances if d <= distance)
+        print(f"  {kind:<14} {within / len(distances):>6.1%}  median distance {int(np.median(distances))}")
+
+def lookup_latency(sizes, distance: int, queries: int, rng: np.random.Generator):
+    print(f"\n{'entries':>9} {'bands':>5} {'build s':>8} {'index us':>9} {'scan us':>9} {'candidates':>11} {'agree':>6}")
+    for size in sizes:
+        stored = rng.integers(0, 2 ** 63, size=size, dtype=np.uint64) * 2 + rng.integers(0, 2, size=size, dtype=np.uint64)
+
+        index = HammingIndex(max_distance=distance, max_entries=size)
+        started = time.perf_counter()
+        for position, value in enumerate(stored.tolist()):
+            index.add(value, position)
+        build_s = time.perf_counter() - started
+
+        # Half the queries are stored hashes with up to `distance` bits flipped
+        probes = []
+        for value in rng.choice(stored, size=queries // 2).tolist():
+            for bit in rng.choice(64, size=rng.integers(0, distance + 1), replace=False).tolist():
+                value ^= 1 << bit
+            probes.append(value)
+        probes += rng.integers(0, 2 ** 63, size=queries - len(probes), dtype=np.uint64).tolist()
+
+        started = time.perf_counter()
+        index_results = [index.nearest(value) for value in probes]
+        index_us = (time.perf_counter() - started) / len(probes) * 1e6
+
+        # Popcount over the whole array per query: the linear-scan baseline
+        scan_sample = probes[:max(len(probes) // 20, 10)]
+        started = time.perf_counter()
+        scan_results = []
+        for value in scan_sample:
+            xor = stored ^ np.uint64(value)
+            counts = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            best = int(counts.argmin())
+            scan_results.append(int(counts[best]) if counts[best] <= distance else None)
+        scan_us = (time.perf_counter() - started) / len(scan_sample) * 1e6
+
+        agree = all((result[1] if result else None) == expected
+                    for result, expected in zip(index_results, scan_results))
+        print(f"{size:>9} {index.bands:>5} {build_s:>8.1f} {index_us:>9.1f} {scan_us:>9.0f} "
+              f"{index.stats()['avg_candidates']:>11.1f} {'yes' if agree else 'NO':>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark near-duplicate detection")
+    parser.add_argument("images", nargs="*", help="Photos to crop sources from (default: uploads/*)")
+    parser.add_argument("--sources", type=int, default=200)
+    parser.add_argument("--distance", type=int, default=6, help="Configured NEAR_DUPLICATE_DISTANCE")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Index sizes for the latency run")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    paths = args.images or sorted(glob.glob(os.path.join(ROOT, "uploads", "*")))
+    # uploads/ can hold the same photo several times
+    contents = list(dict.fromkeys(open(path, "rb").read() for path in paths))[:10]
+    photos = [ImageOps.exif_transpose(Image.open(io.BytesIO(content))).convert("RGB") for content in contents]
+
+    precision_recall(photos, args.sources, args.distance, random.Random(args.seed))
+    lookup_latency([int(size) for size in args.sizes.split(",")], args.distance, args.queries,
+                   np.random.default_rng(args.seed))
+
+if __name__ == "__main__":
+    main()
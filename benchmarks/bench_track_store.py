@@ -0,0 +1,77 @@
+"""
+Compare the memory and serialization cost of cached tracks kept as the
+nested dicts the old _parse_track built against Track objects in the
+track store. Run from the repository root:
+
+    python -m benchmarks.bench_track_store [--tracks 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from track_store import Track
+
+def api_track(index: int) -> dict:
+    """A search result item shaped like Spotify's, with two artists and three album images"""
+    return {
+        "id": f"{index:022d}",
+        "name": f"Some Song Title {index}",
+        "artists": [{"name": f"Artist {index % 500}", "id": f"artist{index % 500:016d}"},
+                    {"name": "Featured Artist", "id": "featured00000000000000"}],
+        "album": {
+            "name": f"Album {index % 2000}",
+            "id": f"album{index % 2000:017d}",
+            "images": [{"url": f"https://i.scdn.co/image/{index:040x}", "width": w, "height": w}
+                       for w in (640, 300, 64)]
+        },
+        "preview_url": f"https://p.scdn.co/mp3-preview/{index:040x}",
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{index:022d}"},
+        "popularity": index % 100,
+        "explicit": False,
+        "duration_ms": 180000 + index
+    }
+
+def measure(label: str, build, count: int):
+    """Report retained memory per track for whatever build() returns"""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    print(f"{label:<26} {retained / count:>8.0f} bytes/track")
+    return kept
+
+def bench(label: str, func, count: int, repeat: int = 5):
+    """Report the best of several runs to keep scheduler noise out"""
+    elapsed = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - started)
+    print(f"{label:<26} {elapsed / count * 1e6:>8.2f} us/track")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=20000, help='Number of synthetic tracks')
+    args = parser.parse_args()
+
+    # Payloads are built as JSON text first so string sharing with the
+    # generator doesn't flatter either side
+    payloads = [json.loads(json.dumps(api_track(i))) for i in range(args.tracks)]
+
+    print("memory retained by the cache")
+    dicts = measure("dict (to_dict form)", lambda: [Track.from_api(p).to_dict() for p in payloads], args.tracks)
+    tracks = measure("Track (__slots__)", lambda: [Track.from_api(p) for p in payloads], args.tracks)
+
+    print("cost per track")
+    bench("cached dict -> json", lambda: [json.dumps(dict(d)) for d in dicts], args.tracks)
+    bench("Track.to_dict -> json", lambda: [json.dumps(t.to_dict()) for t in tracks], args.tracks)
+    bench("Track.from_api", lambda: [Track.from_api(p) for p in payloads], args.tracks)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Load test /api/analyze on the sync (gunicorn + Flask) and async (uvicorn +
+Starlette) servers against a local stub Spotify API, at the same client
+concurrency, and compare throughput and latency.
+
+Vision is skipped with COLOR_MODE=local_only, and the search and mood
+recommendation caches are disabled, so every request makes a real
+(stubbed) Spotify search round trip.
+Image features are cached after the warm-up pass, as they would be for
+repeat uploads. Run from the repository root:
+
+    python -m benchmarks.load_async [--concurrency 200] [--requests 1000]
+        [--sync-workers 4] [--latency 0.2] [image ...]
+
+Without image arguments the photos in uploads/ are used.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_spotify import StubSpotifyServer
+
+def server_env(stub: StubSpotifyServer) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "SPOTIFY_CLIENT_ID": "stub",
+        "SPOTIFY_CLIENT_SECRET": "stub",
+        "SPOTIFY_API_URL": f"{stub.base_url}/v1",
+        "SPOTIFY_ACCOUNTS_URL": f"{stub.base_url}/api",
+        "SPOTIFY_RATE_LIMIT": "1000000",
+        "SPOTIFY_RATE_BURST": "1000000",
+        "SPOTIFY_POOL_SIZE": "1000",
+        "SPOTIFY_MAX_CONNECTIONS": "1000",
+        "SEARCH_CACHE_TTL": "0",
+        "SEARCH_CACHE_STALE_TTL": "0",
+        "MOOD_CACHE_SIZE": "0",
+        "COLOR_MODE": "local_only",
+        "PIPELINE_DEADLINE": "120",
+        "PIPELINE_RECOMMEND_TIMEOUT": "120",
+        "PIPELINE_LOCAL_TIMEOUT": "120",
+    })
+    return env
+
+def start_server(kind: str, port: int, sync_workers: int, env: Dict[str, str]) -> subprocess.Popen:
+    if kind == "sync":
+        command = [sys.executable, "-m", "gunicorn", "app:app", "--workers", str(sync_workers),
+                   "--bind", f"127.0.0.1:{port}", "--timeout", "300", "--log-level", "warning"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port),
+                   "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def wait_until_healthy(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{base_url}/api/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{base_url} did not become healthy")
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[max(int(len(sorted_values) * fraction) - 1, 0)] if sorted_values else float("nan")
+
+async def drive(base_url: str, images: List[bytes], total: int, concurrency: int,
+                warm_up: bool = True) -> Dict[str, Any]:
+    """Send `total` analyze requests, at most `concurrency` at a time"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        async def one(index: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(f"{base_url}/api/analyze",
+                                                 files={"image": ("image.jpg", images[index % len(images)], "image/jpeg")})
+                    ok = response.status_code == 200 and response.json().get("success")
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        # Warm-up: token, genre catalog, and one analysis per image
+        if warm_up:
+            for index in range(len(images)):
+                await one(index)
+            latencies.clear()
+            errors = 0
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput": (total - errors) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else float("nan"),
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", help="Images to upload (default: uploads/*)")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--sync-workers", type=int, default=4, help="gunicorn sync workers")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub Spotify response delay in seconds")
+    parser.add_argument("--servers", default="sync,async")
+    args = parser.parse_args()
+
+    paths = args.images or sorted(glob.glob(os.path.join(ROOT, "uploads", "*")))
+    images = [open(path, "rb").read() for path in paths]
+    if not images:
+        parser.error("no images given and uploads/ is empty")
+
+    stub = StubSpotifyServer(latency=args.latency).start()
+    env = server_env(stub)
+
+    print(f"{len(images)} images, {args.requests} requests at concurrency {args.concurrency}, "
+          f"stub Spotify latency {args.latency * 1000:.0f} ms")
+    print(f"{'server':<28} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+    for port, kind in enumerate(args.servers.split(","), start=8911):
+        process = start_server(kind, port, args.sync_workers, env)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_until_healthy(base_url))
+            result = asyncio.run(drive(base_url, images, args.requests, args.concurrency))
+        finally:
+            process.terminate()
+            process.wait()
+        label = f"sync ({args.sync_workers} gunicorn workers)" if kind == "sync" else "async (1 uvicorn worker)"
+        print(f"{label:<28} {result['throughput']:>8.1f} {result['p50_ms']:>9.0f} "
+              f"{result['p95_ms']:>9.0f} {result['errors']:>7}")
+
+if __name__ == "__main__":
+    main()
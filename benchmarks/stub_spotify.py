@@ -0,0 +1,151 @@
+"""
+Local stand-in for the Spotify accounts and Web API endpoints the app uses,
+answering after a configurable delay. A configurable fraction of API calls
+can be failed with 503 or throttled with 429 and a Retry-After header.
+Point a client at it with SPOTIFY_API_URL=http://host:port/v1 and
+SPOTIFY_ACCOUNTS_URL=http://host:port/api.
+
+    python -m benchmarks.stub_spotify [--port 8901] [--latency 0.2]
+        [--error-rate 0] [--throttle-rate 0] [--retry-after 1]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+GENRES = ["acoustic", "ambient", "blues", "chill", "dance", "disco", "edm", "electronic",
+          "folk", "happy", "jazz", "latin", "metal", "pop", "punk", "r-n-b", "reggae", "rock"]
+
+def stub_track_id(query: str, index: int) -> str:
+    return f"stub{zlib.crc32(f'{query}:{index}'.encode()):018d}"
+
+def stub_track(track_id: str, name: str) -> dict:
+    return {
+        "id": track_id,
+        "name": name,
+        "artists": [{"name": "Stub Artist", "id": "stubartist"}],
+        "album": {"name": "Stub Album", "id": "stubalbum", "images": []},
+        "preview_url": None,
+        "external_urls": {"spotify": "https://open.spotify.com/"},
+        "popularity": 50,
+        "explicit": False,
+        "duration_ms": 180000
+    }
+
+class StubSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/api/token":
+            self._reply(200, {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        outcome = self.server.record(url.path)
+        time.sleep(self.server.latency)
+        if outcome == "throttled":
+            self._reply(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                        {"Retry-After": str(self.server.retry_after)})
+        elif outcome == "failed":
+            self._reply(503, {"error": {"status": 503, "message": "Service unavailable"}})
+        elif url.path == "/v1/recommendations/available-genre-seeds":
+            self._reply(200, {"genres": GENRES})
+        elif url.path == "/v1/search":
+            query = parse_qs(url.query)
+            q = query.get("q", [""])[0]
+            limit = int(query.get("limit", ["10"])[0])
+            self._reply(200, {"tracks": {"items": [stub_track(stub_track_id(q, i), f"{q.title()} #{i + 1}")
+                                                   for i in range(limit)]}})
+        elif url.path == "/v1/tracks":
+            ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+            self._reply(200, {"tracks": [stub_track(track_id, f"Track {track_id}") for track_id in ids[:50]]})
+        else:
+            self._reply(404, {"error": "not found"})
+
+class StubSpotifyServer(ThreadingHTTPServer):
+    """
+    Counts API calls in `requests`, per path in `calls`, and the injected
+    failures in `failed` and `throttled`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.2, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: int = 1):
+        super().__init__(("127.0.0.1", port), StubSpotifyHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.calls = {}
+        self.failed = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def record(self, path: str) -> str:
+        """Count an API call and decide whether it succeeds, fails or is throttled"""
+        with self._lock:
+            self.requests += 1
+            self.calls[path] = self.calls.get(path, 0) + 1
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                self.throttled += 1
+                return "throttled"
+            if roll < self.throttle_rate + self.error_rate:
+                self.failed += 1
+                return "failed"
+            return "ok"
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.calls = {}
+            self.failed = 0
+            self.throttled = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> 'StubSpotifyServer':
+        threading.Thread(target=self.serve_forever, name="stub-spotify", daemon=True).start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stub Spotify API")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before each API response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API calls failed with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of API calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+
+    server = StubSpotifyServer(args.port, args.latency, args.error_rate, args.throttle_rate, args.retry_after)
+    print(f"Stub Spotify API on {server.base_url} ({args.latency * 1000:.0f} ms latency, "
+          f"{args.error_rate:.0%} errors, {args.throttle_rate:.0%} throttled)")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
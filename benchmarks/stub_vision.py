@@ -0,0 +1,122 @@
+"""
+Local stand-in for the Google Cloud Vision annotator, answering
+BatchAnnotateImages over plaintext gRPC after a configurable delay, and
+failing a configurable fraction of calls with UNAVAILABLE. Labels, faces,
+text and colors are derived from a checksum of each image, so the same
+upload always gets the same annotations. Point the app at it with
+VISION_API_ENDPOINT=host:port and VISION_API_INSECURE=True.
+
+    python -m benchmarks.stub_vision [--port 8902] [--latency 0.3] [--error-rate 0]
+"""
+import argparse
+import random
+import threading
+import time
+import zlib
+from concurrent import futures
+
+import grpc
+from google.cloud import vision
+
+SERVICE = "google.cloud.vision.v1.ImageAnnotator"
+
+LABELS = ["Sky", "Cloud", "Beach", "Sunset", "Tree", "Forest", "Mountain", "Water", "City", "Night",
+          "Flower", "Snow", "Person", "Smile", "Dog", "Food", "Party", "Road"]
+
+COLORS = [(230, 120, 40), (40, 90, 200), (30, 150, 60), (200, 200, 210), (20, 20, 30), (240, 200, 60)]
+
+def stub_annotations(content: bytes, features) -> vision.AnnotateImageResponse:
+    """Deterministic annotations for the requested feature types"""
+    rng = random.Random(zlib.crc32(content))
+    response = vision.AnnotateImageResponse()
+    for feature in features:
+        if feature.type_ == vision.Feature.Type.LABEL_DETECTION:
+            count = min(feature.max_results or 10, len(LABELS))
+            response.label_annotations = [
+                vision.EntityAnnotation(description=label, score=round(0.95 - 0.05 * rank, 2))
+                for rank, label in enumerate(rng.sample(LABELS, count))
+            ]
+        elif feature.type_ == vision.Feature.Type.FACE_DETECTION:
+            response.face_annotations = [
+                vision.FaceAnnotation(joy_likelihood=rng.randint(1, 5), sorrow_likelihood=rng.randint(1, 5),
+                                      anger_likelihood=rng.randint(1, 3), surprise_likelihood=rng.randint(1, 3))
+                for _ in range(rng.randint(0, 3))
+            ]
+        elif feature.type_ == vision.Feature.Type.TEXT_DETECTION:
+            response.text_annotations = [vision.EntityAnnotation(description="stub", locale="en")]
+        elif feature.type_ == vision.Feature.Type.IMAGE_PROPERTIES:
+            colors = rng.sample(COLORS, 3)
+            response.image_properties_annotation = vision.ImageProperties(dominant_colors=vision.DominantColorsAnnotation(
+                colors=[vision.ColorInfo(color={"red": r, "green": g, "blue": b}, score=score, pixel_fraction=score)
+                        for (r, g, b), score in zip(colors, (0.5, 0.3, 0.2))]
+            ))
+    return response
+
+class StubVisionServer:
+    """
+    gRPC server implementing ImageAnnotator.BatchAnnotateImages. Counts
+    calls in `rpcs` and annotated images in `images`.
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0.3, error_rate: float = 0.0, max_workers: int = 256):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rpcs = 0
+        self.images = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stub-vision"))
+        self._server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(SERVICE, {
+            "BatchAnnotateImages": grpc.unary_unary_rpc_method_handler(
+                self._batch_annotate_images,
+                request_deserializer=vision.BatchAnnotateImagesRequest.deserialize,
+                response_serializer=vision.BatchAnnotateImagesResponse.serialize,
+            ),
+        })])
+        self.port = self._server.add_insecure_port(f"127.0.0.1:{port}")
+
+    @property
+    def endpoint(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def _batch_annotate_images(self, request, context):
+        with self._lock:
+            self.rpcs += 1
+            self.images += len(request.requests)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(self.latency)
+        if failed:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "stub vision: injected failure")
+        return vision.BatchAnnotateImagesResponse(responses=[
+            stub_annotations(image_request.image.content, image_request.features)
+            for image_request in request.requests
+        ])
+
+    def start(self) -> 'StubVisionServer':
+        self._server.start()
+        return self
+
+    def wait(self):
+        self._server.wait_for_termination()
+
+    def stop(self):
+        self._server.stop(grace=None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stub Vision annotator")
+    parser.add_argument("--port", type=int, default=8902)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds before each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls failed with UNAVAILABLE")
+    args = parser.parse_args()
+
+    server = StubVisionServer(args.port, args.latency, args.error_rate).start()
+    print(f"Stub Vision annotator on {server.endpoint} ({args.latency * 1000:.0f} ms latency, "
+          f"{args.error_rate:.0%} errors)")
+    server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,689 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from hash_index import HammingIndex
+from logs import ContextThreadPoolExecutor, get_logger
+
+log = get_logger(__name__)
+
+def content_hash(data: bytes) -> str:
+    """
+    Compute a stable content hash for a blob of bytes.
+
+    Args:
+        data: Raw bytes (e.g. an uploaded image)
+
+    Returns:
+        Hex digest identifying the content
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache with LRU eviction and an optional TTL.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of entries kept before evicting the least recently used
+            ttl: Seconds an entry stays valid, or None to keep entries until evicted
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a key, returning None on a miss or an expired entry.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at is not None and time.time() > expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Store a value, evicting the least recently used entries if the cache is full.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters for this cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class SQLiteCache:
+    """
+    On-disk cache backed by SQLite, storing JSON-serializable values.
+    Safe to share between threads and between processes on the same host.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: Optional[float] = None):
+        """
+        Initialize the cache, creating the database file if needed.
+
+        Args:
+            path: Path to the SQLite database file
+            max_entries: Maximum number of rows kept before evicting the least recently used
+            ttl: Seconds an entry stays valid, or None to keep entries until evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        # Guards the counters only; SQLite does its own locking for the data
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a key, returning None on a miss or an expired entry.
+        """
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """
+        Look up a key along with its expiry time.
+
+        Returns:
+            Tuple of (value, expires_at or None), or None on a miss or an expired entry
+        """
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        value, expires_at = row
+        if expires_at is not None and now > expires_at:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            conn.commit()
+            with self._lock:
+                self.misses += 1
+            return None
+
+        conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        with self._lock:
+            self.hits += 1
+        return json.loads(value), expires_at
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Store a value, evicting the least recently used rows if the cache is full.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), expires_at, now)
+        )
+
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            overflow = count - self.max_entries
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (overflow,)
+            )
+            with self._lock:
+                self.evictions += overflow
+        conn.commit()
+
+    def delete(self, key: str):
+        conn = self._connection()
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        conn.commit()
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM cache")
+        conn.commit()
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters for this cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class TieredCache:
+    """
+    Two-level cache: an in-process LRU tier in front of an optional on-disk tier.
+    Disk hits are promoted into the memory tier for no longer than they have
+    left on disk.
+    """
+
+    def __init__(self, memory: LRUCache, disk: Optional[SQLiteCache] = None):
+        """
+        Initialize the tiered cache.
+
+        Args:
+            memory: In-process tier consulted first
+            disk: Optional on-disk tier consulted on a memory miss
+        """
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        if self.disk is not None:
+            entry = self.disk.get_entry(key)
+            if entry is not None:
+                value, expires_at = entry
+                ttl = self.memory.ttl
+                if expires_at is not None:
+                    remaining = max(expires_at - time.time(), 0)
+                    ttl = remaining if ttl is None else min(ttl, remaining)
+                self.memory.set(key, value, ttl=ttl)
+                return value
+
+        return None
+
+    def set(self, key: str, value: Any):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def delete(self, key: str):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters for each tier.
+        """
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None
+        }
+
+
+class StaleWhileRevalidateCache:
+    """
+    Read-through cache that keeps serving an expired entry for a grace period
+    while a single background refresh replaces it.
+
+    Entries are fresh for `ttl` seconds, then stale (served, and refreshed in
+    the background) for another `stale_ttl` seconds, then gone.
+    """
+
+    def __init__(self, backend: Union[LRUCache, SQLiteCache], ttl: float, stale_ttl: float = 0):
+        """
+        Initialize the cache.
+
+        Args:
+            backend: Storage for entries; SQLiteCache lets worker processes share them
+            ttl: Seconds an entry is served without refreshing
+            stale_ttl: Extra seconds an expired entry is served while it is refreshed
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._refreshing = set()
+        # Async refresh tasks, held so the event loop can't collect them mid-flight
+        self._refresh_tasks = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get_or_load(self, key: str, loader: Callable[[], Any],
+                    cacheable: Callable[[Any], bool] = lambda value: True) -> Any:
+        """
+        Return the cached value for a key, loading it on a miss.
+
+        Args:
+            key: Cache key
+            loader: Function producing the value
+            cacheable: Whether a loaded value should be stored (e.g. skip error results)
+
+        Returns:
+            Cached or freshly loaded value
+        """
+        found, value, stale = self._lookup(key)
+        if found:
+            if stale:
+                self._refresh_async(key, loader, cacheable)
+            return value
+
+        value = loader()
+        if cacheable(value):
+            self._store(key, value)
+        return value
+
+    async def get_or_load_async(self, key: str, loader: Callable[[], Awaitable[Any]],
+                                cacheable: Callable[[Any], bool] = lambda value: True) -> Any:
+        """
+        Coroutine version of get_or_load for an async loader. Stale entries are
+        refreshed in a task on the running event loop.
+        """
+        found, value, stale = self._lookup(key)
+        if found:
+            if stale and self._start_refresh(key):
+                task = asyncio.ensure_future(self._refresh_task(key, loader, cacheable))
+                self._refresh_tasks.add(task)
+                task.add_done_callback(self._refresh_tasks.discard)
+            return value
+
+        value = await loader()
+        if cacheable(value):
+            self._store(key, value)
+        return value
+
+    def _lookup(self, key: str) -> Tuple[bool, Any, bool]:
+        """
+        Look up a key and count the outcome.
+
+        Returns:
+            Tuple of (found, value, stale)
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return False, None, False
+
+        stale = time.time() - entry["stored_at"] >= self.ttl
+        with self._lock:
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.fresh_hits += 1
+        return True, entry["value"], stale
+
+    async def _refresh_task(self, key: str, loader: Callable[[], Awaitable[Any]], cacheable: Callable[[Any], bool]):
+        try:
+            value = await loader()
+            if cacheable(value):
+                self._store(key, value)
+            with self._lock:
+                self.refreshes += 1
+        except Exception as e:
+            log.warning("cache.refresh_failed", key=key, error=str(e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key: str, value: Any):
+        self.backend.set(key, {"value": value, "stored_at": time.time()}, ttl=self.ttl + self.stale_ttl)
+
+    def _start_refresh(self, key: str) -> bool:
+        """
+        Mark a key as refreshing, returning False if a refresh is already running.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def _refresh_async(self, key: str, loader: Callable[[], Any], cacheable: Callable[[Any], bool]):
+        """
+        Reload a stale key in the background unless a refresh for it is already running.
+        """
+        with self._lock:
+            # Worker threads don't survive fork, so each process builds its own pool
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ContextThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+                self._pid = os.getpid()
+                self._refreshing = set()
+        if not self._start_refresh(key):
+            return
+
+        def refresh():
+            try:
+                value = loader()
+                if cacheable(value):
+                    self._store(key, value)
+                with self._lock:
+                    self.refreshes += 1
+            except Exception as e:
+                log.warning("cache.refresh_failed", key=key, error=str(e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(refresh)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit counters, where stale hits count as hits.
+        """
+        lookups = self.fresh_hits + self.stale_hits + self.misses
+        return {
+            "fresh_hits": self.fresh_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hit_ratio": (self.fresh_hits + self.stale_hits) / lookups if lookups else 0.0,
+            "backend": self.backend.stats()
+        }
+
+
+# How a mood's cached pool is served: successive windows, a random sample, or always the top tracks
+ROTATION_MODES = ('rotate', 'shuffle', 'off')
+
+class RecommendationCache:
+    """
+    Recommended tracks shared by every image that maps to the same quantized mood.
+
+    Recommendations depend on the image only through the mood: energy,
+    valence, tempo and the seed genres (hue bin, saturation and labels
+    reach the result only through the genres and tempo). Energy and
+    valence are bucketed by their step and tempo by its own, so images
+    whose moods fall in the same buckets share one Spotify search or
+    catalog lookup.
+
+    Each mood keeps a pool of several requests' worth of tracks. With
+    rotation 'rotate' successive hits get successive windows of the pool,
+    with 'shuffle' a random sample, so repeat visitors still see variety.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl: float = 3600, energy_step: float = 0.1,
+                 valence_step: float = 0.1, tempo_step: float = 10, pool_size: int = 30,
+                 rotation: str = 'rotate'):
+        """
+        Initialize the cache.
+
+        Args:
+            max_entries: Maximum number of moods kept before evicting the least recently used
+            ttl: Seconds a mood's pool is served before it is fetched again
+            energy_step: Width of an energy bucket
+            valence_step: Width of a valence bucket
+            tempo_step: Width of a tempo bucket in BPM
+            pool_size: Tracks fetched and kept per mood
+            rotation: One of ROTATION_MODES
+        """
+        if rotation not in ROTATION_MODES:
+            raise ValueError(f"rotation must be one of {', '.join(ROTATION_MODES)}")
+        self.memory = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.energy_step = energy_step
+        self.valence_step = valence_step
+        self.tempo_step = tempo_step
+        self.pool_size = pool_size
+        self.rotation = rotation
+
+    def signature(self, mood: Dict[str, Any]) -> str:
+        """
+        Cache key for a mood from derive_mood: its genres and bucketed targets.
+        """
+        return (f"{','.join(mood['valid_genres'])}"
+                f"|e{round(mood['energy'] / self.energy_step)}"
+                f"|v{round(mood['valence'] / self.valence_step)}"
+                f"|t{round(mood['tempo'] / self.tempo_step)}")
+
+    def pool_mood(self, mood: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Copy of the mood asking for a whole pool of tracks instead of one response's worth.
+        """
+        return dict(mood, params=dict(mood['params'], limit=max(self.pool_size, mood['params'].get('limit', 10))))
+
+    def lookup(self, mood: Dict[str, Any]) -> Optional[List[Any]]:
+        """
+        Serve tracks for a mood from its cached pool.
+
+        Returns:
+            The next tracks for this mood, or None if it isn't cached
+        """
+        entry = self.memory.get(self.signature(mood))
+        if entry is None:
+            return None
+        return self._serve(entry, mood['params'].get('limit', 10))
+
+    def store(self, mood: Dict[str, Any], tracks: List[Any]) -> List[Any]:
+        """
+        Keep a freshly fetched pool for a mood and serve the first tracks from it.
+        Empty results are not cached, so the next request tries again.
+
+        Returns:
+            Tracks for this response
+        """
+        if not tracks:
+            return tracks
+        entry = (tuple(tracks), count())
+        self.memory.set(self.signature(mood), entry)
+        return self._serve(entry, mood['params'].get('limit', 10))
+
+    def _serve(self, entry: Tuple[Tuple[Any, ...], count], limit: int) -> List[Any]:
+        pool, served = entry
+        limit = min(limit, len(pool))
+        if self.rotation == 'shuffle':
+            return random.sample(pool, limit)
+        if self.rotation == 'off':
+            return list(pool[:limit])
+        # next() on the counter is atomic, so concurrent hits get different windows
+        start = next(served) * limit % len(pool)
+        return [pool[(start + offset) % len(pool)] for offset in range(limit)]
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.memory.stats()
+        stats["rotation"] = self.rotation
+        return stats
+
+def build_search_cache() -> StaleWhileRevalidateCache:
+    """
+    Build the Spotify search result cache from environment configuration.
+
+    Environment variables:
+        SEARCH_CACHE_SIZE: Max entries in the in-process backend (default 2048)
+        SEARCH_CACHE_TTL: Seconds a search result is served as fresh (default 3600)
+        SEARCH_CACHE_STALE_TTL: Extra seconds it is served while refreshing (default 86400)
+        SEARCH_CACHE_DB: Path to a SQLite file shared by all workers (default in-process)
+
+    Returns:
+        StaleWhileRevalidateCache for Spotify search results
+    """
+    ttl = float(os.getenv('SEARCH_CACHE_TTL', 3600))
+    stale_ttl = float(os.getenv('SEARCH_CACHE_STALE_TTL', 86400))
+    size = int(os.getenv('SEARCH_CACHE_SIZE', 2048))
+
+    db_path = os.getenv('SEARCH_CACHE_DB')
+    if db_path:
+        backend = SQLiteCache(db_path, max_entries=size)
+    else:
+        backend = LRUCache(max_entries=size)
+
+    return StaleWhileRevalidateCache(backend, ttl=ttl, stale_ttl=stale_ttl)
+
+
+def build_analysis_cache() -> TieredCache:
+    """
+    Build the image analysis cache from environment configuration.
+
+    Environment variables:
+        ANALYSIS_CACHE_SIZE: Max entries in the in-process tier (default 512)
+        ANALYSIS_CACHE_TTL: Seconds an analysis stays valid (default 86400)
+        ANALYSIS_CACHE_DB: Path to a SQLite file enabling the on-disk tier (default off)
+        ANALYSIS_CACHE_DB_SIZE: Max entries in the on-disk tier (default 10000)
+
+    Returns:
+        TieredCache for analyze_image results keyed by content hash
+    """
+    ttl = float(os.getenv('ANALYSIS_CACHE_TTL', 86400))
+    memory = LRUCache(max_entries=int(os.getenv('ANALYSIS_CACHE_SIZE', 512)), ttl=ttl)
+
+    disk = None
+    db_path = os.getenv('ANALYSIS_CACHE_DB')
+    if db_path:
+        disk = SQLiteCache(db_path, max_entries=int(os.getenv('ANALYSIS_CACHE_DB_SIZE', 10000)), ttl=ttl)
+
+    return TieredCache(memory, disk)
+
+def build_near_duplicate_index() -> Optional[HammingIndex]:
+    """
+    Build the perceptual hash index of analyzed images from environment configuration.
+
+    Environment variables:
+        NEAR_DUPLICATE_DISTANCE: Max differing bits of the 64-bit hash for an upload
+            to reuse another image's analysis (default 6, negative disables)
+        NEAR_DUPLICATE_INDEX_SIZE: Max hashes kept (default 100000)
+
+    Returns:
+        HammingIndex mapping perceptual hashes to content hashes, or None if disabled
+    """
+    max_distance = int(os.getenv('NEAR_DUPLICATE_DISTANCE', 6))
+    if max_distance < 0:
+        return None
+    return HammingIndex(max_distance=max_distance,
+                        max_entries=int(os.getenv('NEAR_DUPLICATE_INDEX_SIZE', 100000)))
+
+def build_recommendation_cache() -> Optional[RecommendationCache]:
+    """
+    Build the quantized mood recommendation cache from environment configuration.
+
+    Environment variables:
+        MOOD_CACHE_SIZE: Max moods kept (default 2048, 0 disables)
+        MOOD_CACHE_TTL: Seconds a mood's tracks are reused (default 3600)
+        MOOD_CACHE_ENERGY_STEP / MOOD_CACHE_VALENCE_STEP: Bucket widths (default 0.1)
+        MOOD_CACHE_TEMPO_STEP: Tempo bucket width in BPM (default 10)
+        MOOD_CACHE_POOL: Tracks kept per mood (default 30)
+        MOOD_CACHE_ROTATION: rotate, shuffle or off (default rotate)
+
+    Returns:
+        RecommendationCache, or None if disabled
+    """
+    size = int(os.getenv('MOOD_CACHE_SIZE', 2048))
+    if size <= 0:
+        return None
+    return RecommendationCache(
+        max_entries=size,
+        ttl=float(os.getenv('MOOD_CACHE_TTL', 3600)),
+        energy_step=float(os.getenv('MOOD_CACHE_ENERGY_STEP', 0.1)),
+        valence_step=float(os.getenv('MOOD_CACHE_VALENCE_STEP', 0.1)),
+        tempo_step=float(os.getenv('MOOD_CACHE_TEMPO_STEP', 10)),
+        pool_size=int(os.getenv('MOOD_CACHE_POOL', 30)),
+        rotation=os.getenv('MOOD_CACHE_ROTATION', 'rotate')
+    )
+
+def build_last_recommendations_cache() -> Optional[LRUCache]:
+    """
+    Build the cache of the last recommendations made for each image from
+    environment configuration. /api/analyze/stream sends them first for images
+    it has seen before.
+
+    Environment variables:
+        LAST_RECOMMENDATIONS_SIZE: Max images kept (default 1024, 0 disables)
+        LAST_RECOMMENDATIONS_TTL: Seconds a result is kept (default 86400)
+
+    Returns:
+        LRUCache keyed by content hash and analysis variant, or None if disabled
+    """
+    size = int(os.getenv('LAST_RECOMMENDATIONS_SIZE', 1024))
+    if size <= 0:
+        return None
+    return LRUCache(max_entries=size, ttl=float(os.getenv('LAST_RECOMMENDATIONS_TTL', 86400)))
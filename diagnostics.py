@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import Dict, Any, Optional
+from spotify_client import SpotifyClient
+from logs import get_logger
+
+log = get_logger(__name__)
+
+class SpotifyDiagnostics:
+    """
+    Runs connectivity probes against the Spotify API off the request path.
+    Probes run on demand or on a schedule, and the last result is cached.
+    """
+
+    def __init__(self, spotify_client: SpotifyClient):
+        """
+        Initialize the diagnostics runner.
+
+        Args:
+            spotify_client: Initialized SpotifyClient instance to probe
+        """
+        self.spotify_client = spotify_client
+        self._last_result = None
+        self._run_lock = threading.Lock()
+        self._scheduler = None
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run all probes now and cache the result. Concurrent callers share one run.
+
+        Returns:
+            Dictionary describing the outcome of each probe
+        """
+        if not self._run_lock.acquire(blocking=False):
+            # Another thread is probing; wait for it and reuse its result
+            with self._run_lock:
+                return self._last_result
+
+        try:
+            started = time.time()
+            result = {
+                "checked_at": started,
+                "token": self._probe(self._probe_token),
+                "genres": self._probe(self._probe_genres),
+                "search": self._probe(self._probe_search),
+            }
+            result["status"] = "ok" if all(result[name]["ok"] for name in ("token", "genres", "search")) else "degraded"
+            result["duration_ms"] = round((time.time() - started) * 1000, 1)
+            result["pool"] = self.spotify_client.pool_stats()
+
+            self._last_result = result
+            return result
+        finally:
+            self._run_lock.release()
+
+    def last_result(self) -> Optional[Dict[str, Any]]:
+        """
+        Return the result of the most recent run, or None if no run has finished.
+        """
+        return self._last_result
+
+    def start(self, interval: float):
+        """
+        Run the probes every `interval` seconds on a daemon thread.
+
+        Args:
+            interval: Seconds between runs
+        """
+        if self._scheduler is not None and self._scheduler.is_alive():
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.run()
+                except Exception as e:
+                    log.warning("diagnostics.run_failed", error=str(e))
+                time.sleep(interval)
+
+        self._scheduler = threading.Thread(target=loop, name="spotify-diagnostics", daemon=True)
+        self._scheduler.start()
+
+    def _probe(self, probe) -> Dict[str, Any]:
+        """
+        Time a single probe and capture its outcome instead of raising.
+        """
+        started = time.time()
+        try:
+            details = probe()
+            outcome = {"ok": True}
+            outcome.update(details)
+        except Exception as e:
+            outcome = {"ok": False, "error": str(e)}
+        outcome["duration_ms"] = round((time.time() - started) * 1000, 1)
+        return outcome
+
+    def _probe_token(self) -> Dict[str, Any]:
+        token = self.spotify_client._ensure_token()
+        return {
+            "token_obtained": bool(token),
+            "expires_in": round(self.spotify_client.token_expiry - time.time())
+        }
+
+    def _probe_genres(self) -> Dict[str, Any]:
+        # Goes to the network, unlike the cached get_available_genre_seeds()
+        genres = self.spotify_client.debug_list_genres()
+        if not genres:
+            raise RuntimeError("No genres returned")
+        return {
+            "genres_count": len(genres),
+            "sample_genres": genres[:5]
+        }
+
+    def _probe_search(self) -> Dict[str, Any]:
+        # Bypasses the search cache, which would keep answering while Spotify is down
+        tracks = self.spotify_client.search_tracks("pop", limit=2, use_cache=False)
+        return {
+            "recommendations_working": len(tracks) > 0,
+            "sample_tracks": [track.name for track in tracks]
+        }
@@ -0,0 +1,6 @@
+# Gunicorn configuration, picked up automatically by `gunicorn app:app`
+
+def post_fork(server, worker):
+    """Open the Vision client in each worker before it accepts requests"""
+    from image_analyzer import get_analyzer
+    get_analyzer().warm_up()
@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict
+from itertools import combinations
+from math import comb
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+def _choose_bands(bits: int, max_distance: int, entries: int) -> int:
+    """
+    Band count with the cheapest estimated lookup for an index of this size.
+
+    A lookup costs one dict probe per bit-flip variant of each band value,
+    plus a distance check (counted as a few probes) for every hash in the
+    probed buckets, of which a full index of random hashes holds
+    entries / 2 ** band_width.
+    """
+    def cost(bands: int) -> float:
+        width = bits // bands
+        probes = sum(comb(width, flips) for flips in range(max_distance // bands + 1))
+        return bands * probes * (1 + 4 * entries / 2 ** width)
+    return min(range(1, bits // 4 + 1), key=cost)
+
+class HammingIndex:
+    """
+    Index of fixed-width hashes answering "closest stored hash within
+    max_distance bits" without scanning every entry.
+
+    Uses multi-index hashing: each hash is split into `bands` bit ranges
+    and every range gets its own table. Two hashes within max_distance
+    bits must agree to within max_distance // bands bits on at least one
+    band (pigeonhole), so a lookup only probes the buckets of the query's
+    band values and their few bit-flip neighbours, then verifies the
+    candidates. Fewer, wider bands mean more bit-flip probes but emptier
+    buckets; the band count is picked for the expected size of the index,
+    so lookups grow far slower than the index does.
+
+    Entries beyond max_entries are evicted oldest first. Safe to share
+    between threads.
+    """
+
+    def __init__(self, max_distance: int = 6, max_entries: int = 100000, bits: int = 64, bands: Optional[int] = None):
+        """
+        Initialize the index.
+
+        Args:
+            max_distance: Largest hamming distance counted as a match
+            max_entries: Maximum number of hashes kept before evicting the oldest
+            bits: Width of the stored hashes
+            bands: Number of bit ranges the hashes are split into, sized for max_entries by default
+        """
+        if max_distance < 0:
+            raise ValueError("max_distance must be non-negative")
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.bits = bits
+        if bands is None:
+            bands = _choose_bands(bits, max_distance, max_entries)
+        self.bands = min(max(bands, 1), bits)
+
+        # Band widths differ by at most one bit when bits isn't a multiple of bands
+        self._bands = []
+        shift = 0
+        for band in range(self.bands):
+            width = bits // self.bands + (1 if band < bits % self.bands else 0)
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+
+        # XOR masks for every value within max_distance // bands flips of a band value
+        band_radius = max_distance // self.bands
+        self._probes = []
+        for _, mask in self._bands:
+            width = mask.bit_length()
+            probes = [0]
+            for flips in range(1, min(band_radius, width) + 1):
+                for positions in combinations(range(width), flips):
+                    probes.append(sum(1 << position for position in positions))
+            self._probes.append(probes)
+
+        self._entries: "OrderedDict[int, Any]" = OrderedDict()
+        self._tables: List[Dict[int, Set[int]]] = [{} for _ in self._bands]
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._matches = 0
+        self._candidates = 0
+
+    def add(self, value: int, key: Any):
+        """
+        Store a hash, replacing the key of an identical hash already stored.
+
+        Args:
+            value: Hash to index
+            key: Whatever the hash identifies (e.g. a cache key)
+        """
+        with self._lock:
+            if value in self._entries:
+                self._entries.move_to_end(value)
+                self._entries[value] = key
+                return
+
+            self._entries[value] = key
+            for (shift, mask), table in zip(self._bands, self._tables):
+                table.setdefault((value >> shift) & mask, set()).add(value)
+
+            while len(self._entries) > self.max_entries:
+                oldest, _ = self._entries.popitem(last=False)
+                self._unlink(oldest)
+
+    def nearest(self, value: int) -> Optional[Tuple[Any, int]]:
+        """
+        Find the stored hash closest to value, if it is within max_distance.
+
+        Args:
+            value: Hash to look up
+
+        Returns:
+            Tuple of (key, distance), or None if nothing is close enough
+        """
+        with self._lock:
+            self._lookups += 1
+            best = None
+            best_distance = self.max_distance + 1
+            seen = set()
+            for (shift, mask), table, probes in zip(self._bands, self._tables, self._probes):
+                band_value = (value >> shift) & mask
+                for probe in probes:
+                    bucket = table.get(band_value ^ probe)
+                    if not bucket:
+                        continue
+                    for candidate in bucket:
+                        if candidate in seen:
+                            continue
+                        seen.add(candidate)
+                        distance = hamming_distance(value, candidate)
+                        if distance < best_distance:
+                            best, best_distance = candidate, distance
+                if best_distance == 0:
+                    break
+
+            self._candidates += len(seen)
+            if best is None:
+                return None
+            self._matches += 1
+            return self._entries[best], best_distance
+
+    def remove(self, value: int):
+        with self._lock:
+            if value in self._entries:
+                del self._entries[value]
+                self._unlink(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for table in self._tables:
+                table.clear()
+
+    def _unlink(self, value: int):
+        for (shift, mask), table in zip(self._bands, self._tables):
+            band_value = (value >> shift) & mask
+            bucket = table.get(band_value)
+            if bucket is not None:
+                bucket.discard(value)
+                if not bucket:
+                    del table[band_value]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "lookups": self._lookups,
+                "matches": self._matches,
+                "match_ratio": self._matches / self._lookups if self._lookups else 0.0,
+                "avg_candidates": self._candidates / self._lookups if self._lookups else 0.0
+            }
@@ -1,18 +1,263 @@
+import asyncio
 import os
-from typing import Dict, Any, List
+import threading
+import time
+from typing import Dict, Any, List, BinaryIO, Union
 from PIL import Image
+import grpc
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import (
+    ImageAnnotatorGrpcAsyncIOTransport, ImageAnnotatorGrpcTransport)
 from google.oauth2 import service_account
 import json
 import io
 import colorsys
+from local_features import difference_hash, extract_local_features
+from logs import get_logger
+from metrics import ERRORS, STAGE_SECONDS
 
-def analyze_image(image_path: str) -> Dict[str, Any]:
+_CREDENTIALS_SECONDS = STAGE_SECONDS.labels("vision_credentials")
+_VISION_RPC_SECONDS = STAGE_SECONDS.labels("vision_rpc")
+_VISION_ERRORS = ERRORS.labels("vision", "rpc")
+
+log = get_logger(__name__)
+
+class ImageAnalyzer:
+    """
+    Process-wide holder for Google Cloud credentials and the Vision client.
+    The credentials and client (and its gRPC channel) are created lazily on
+    first use and reused for the lifetime of the worker process.
+    """
+    
+    def __init__(self):
+        self._credentials = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._async_client = None
+        self._async_loop = None
+    
+    def _load_credentials(self):
+        """
+        Load service account credentials from env or file.
+        
+        Returns:
+            Google service account credentials
+        """
+        credentials_json = os.getenv('GOOGLE_CLOUD_CREDENTIALS')
+        if credentials_json:
+            # Create credentials from JSON string in env variable
+            service_account_info = json.loads(credentials_json)
+            return service_account.Credentials.from_service_account_info(service_account_info)
+        
+        # Fall back to credentials file
+        credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+        if not credentials_path or not os.path.exists(credentials_path):
+            raise ValueError("Google Cloud credentials not found. Please set GOOGLE_CLOUD_CREDENTIALS environment variable.")
+        return service_account.Credentials.from_service_account_file(credentials_path)
+    
+    def _new_client(self, asynchronous: bool):
+        """
+        Create a sync or asyncio Vision client.
+        
+        VISION_API_ENDPOINT (host:port) replaces Google's endpoint; with
+        VISION_API_INSECURE=True it is reached over a plaintext channel without
+        credentials, for local stand-ins such as benchmarks/stub_vision.py.
+        """
+        endpoint = os.getenv('VISION_API_ENDPOINT')
+        if endpoint and os.getenv('VISION_API_INSECURE', 'False') == 'True':
+            if asynchronous:
+                transport = ImageAnnotatorGrpcAsyncIOTransport(channel=grpc.aio.insecure_channel(endpoint))
+                return vision.ImageAnnotatorAsyncClient(transport=transport)
+            transport = ImageAnnotatorGrpcTransport(channel=grpc.insecure_channel(endpoint))
+            return vision.ImageAnnotatorClient(transport=transport)
+        
+        if self._credentials is None:
+            with _CREDENTIALS_SECONDS.time():
+                self._credentials = self._load_credentials()
+        client_options = {"api_endpoint": endpoint} if endpoint else None
+        client_class = vision.ImageAnnotatorAsyncClient if asynchronous else vision.ImageAnnotatorClient
+        return client_class(credentials=self._credentials, client_options=client_options)
+    
+    @property
+    def client(self) -> vision.ImageAnnotatorClient:
+        """
+        Return the shared Vision client, creating it on first use in this process.
+        """
+        # gRPC channels do not survive fork, so a client inherited from the
+        # parent (e.g. gunicorn --preload) is discarded and rebuilt
+        if self._client is not None and self._pid == os.getpid():
+            return self._client
+        
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._new_client(asynchronous=False)
+                self._pid = os.getpid()
+            return self._client
+    
+    @property
+    def async_client(self) -> vision.ImageAnnotatorAsyncClient:
+        """
+        Return the asyncio Vision client for the running event loop, creating it on first use.
+        """
+        # grpc.aio channels are bound to the loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = self._new_client(asynchronous=True)
+            self._async_loop = loop
+        return self._async_client
+    
+    def reset(self):
+        """
+        Drop the clients so the next call opens a fresh channel. Credentials are kept.
+        """
+        self._client = None
+        self._pid = None
+        self._async_client = None
+        self._async_loop = None
+        # The lock may have been held by another thread at fork time
+        self._lock = threading.Lock()
+    
+    def warm_up(self) -> bool:
+        """
+        Load credentials and open the Vision client ahead of the first request.
+        
+        Returns:
+            True if the client is ready, False if credentials are missing or invalid
+        """
+        try:
+            self.client
+            return True
+        except Exception as e:
+            log.warning("vision.warm_up_failed", error=str(e))
+            return False
+
+_analyzer = ImageAnalyzer()
+
+# Forked workers must not reuse the parent's gRPC channel
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_analyzer.reset)
+
+def get_analyzer() -> ImageAnalyzer:
+    """
+    Return the process-wide ImageAnalyzer.
+    """
+    return _analyzer
+
+# An image given as a file path, its encoded bytes, or a readable binary buffer
+ImageSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
+
+def read_image_source(source: ImageSource) -> bytes:
+    """
+    Return the encoded bytes of an image source without copying bytes input.
+    
+    Args:
+        source: File path, encoded bytes, or readable binary buffer
+        
+    Returns:
+        Encoded image bytes
+    """
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, (bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, str):
+        with io.open(source, 'rb') as image_file:
+            return image_file.read()
+    
+    # Buffer: read from the start in case it was already consumed
+    if source.seekable():
+        source.seek(0)
+    return source.read()
+
+# Where dominant colors come from:
+#   vision     - Vision's IMAGE_PROPERTIES annotation
+#   local      - local k-means; IMAGE_PROPERTIES is dropped from the Vision request
+#   local_only - local k-means and no Vision call at all (colour-only fast path)
+COLOR_MODES = ('vision', 'local', 'local_only')
+
+# Which Vision annotations are requested (IMAGE_PROPERTIES is added in 'vision' color mode):
+#   fast     - labels only; emotions and texts come back empty
+#   standard - labels and faces, everything the recommender uses
+#   full     - labels, faces and text
+#   adaptive - labels first, then a FACE_DETECTION call only if the labels suggest people
+VISION_PROFILES = ('fast', 'standard', 'full', 'adaptive')
+DEFAULT_VISION_PROFILE = 'standard'
+
+# Label descriptions (lowercased) that make the adaptive profile look for faces
+PEOPLE_LABELS = frozenset({
+    "person", "people", "face", "facial expression", "smile", "selfie", "portrait",
+    "head", "cheek", "chin", "forehead", "lip", "eyebrow", "eyelash", "nose", "jaw",
+    "hairstyle", "child", "toddler", "baby", "girl", "boy", "man", "woman", "crowd",
+    "team", "family", "friendship", "bride", "groom", "gesture", "happy", "fun"
+})
+
+def analysis_variant(color_mode: str, vision_profile: str) -> str:
+    """
+    Identify which kind of features an analysis produced, for cache keys.
+    """
+    if color_mode == 'local_only':
+        return color_mode
+    return f"{color_mode}:{vision_profile}"
+
+class VisionUsage:
+    """
+    Per-profile counters of Vision annotation calls: images annotated,
+    RPCs sent, billable units (one per feature per image) and latency.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = {}
+    
+    def record(self, profile: str, seconds: float, units: int, images: int = 1, rpcs: int = 1):
+        """
+        Record one annotate call.
+        
+        Args:
+            profile: Vision profile the call used
+            seconds: Wall time of the call, including any follow-up RPC
+            units: Billable feature units requested
+            images: Images annotated by the call
+            rpcs: Vision requests the call sent
+        """
+        with self._lock:
+            usage = self._profiles.setdefault(profile, {
+                "calls": 0, "images": 0, "rpcs": 0, "units": 0, "seconds": 0.0, "max_seconds": 0.0
+            })
+            usage["calls"] += 1
+            usage["images"] += images
+            usage["rpcs"] += rpcs
+            usage["units"] += units
+            usage["seconds"] += seconds
+            usage["max_seconds"] = max(usage["max_seconds"], seconds)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                profile: {
+                    "calls": usage["calls"],
+                    "images": usage["images"],
+                    "rpcs": usage["rpcs"],
+                    "units": usage["units"],
+                    "units_per_image": round(usage["units"] / usage["images"], 2),
+                    "avg_latency_ms": round(usage["seconds"] / usage["calls"] * 1000, 1),
+                    "max_latency_ms": round(usage["max_seconds"] * 1000, 1)
+                }
+                for profile, usage in self._profiles.items()
+            }
+
+vision_usage = VisionUsage()
+
+def analyze_image(image_source: ImageSource, color_mode: str = 'vision',
+                  vision_profile: str = DEFAULT_VISION_PROFILE) -> Dict[str, Any]:
     """
     Analyze an image using Google Cloud Vision API and extract relevant features.
     
     Args:
-        image_path: Path to the image file
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        color_mode: One of COLOR_MODES
+        vision_profile: One of VISION_PROFILES
         
     Returns:
         Dictionary containing extracted features:
@@ -22,42 +267,259 @@ def analyze_image(image_path: str) -> Dict[str, Any]:
             - texts: List of extracted text
     """
     
-    # Get credentials from env or file
-    credentials_json = os.getenv('GOOGLE_CLOUD_CREDENTIALS')
-    if credentials_json:
-        # Create credentials from JSON string in env variable
-        service_account_info = json.loads(credentials_json)
-        credentials = service_account.Credentials.from_service_account_info(service_account_info)
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f"Unknown color mode: {color_mode}")
+    
+    # Load image into memory once; Vision and PIL share the same bytes
+    content = read_image_source(image_source)
+    
+    if color_mode == 'local_only':
+        features = empty_annotations()
     else:
-        # Fall back to credentials file
-        credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-        if not credentials_path or not os.path.exists(credentials_path):
-            raise ValueError("Google Cloud credentials not found. Please set GOOGLE_CLOUD_CREDENTIALS environment variable.")
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        features = annotate_image_content(content, include_image_properties=(color_mode == 'vision'),
+                                          profile=vision_profile)
+    features.update(get_local_features(content, dominant_colors=(color_mode != 'vision')))
     
-    # Initialize client
-    client = vision.ImageAnnotatorClient(credentials=credentials)
+    return features
+
+async def analyze_image_async(image_source: ImageSource, color_mode: str = 'vision',
+                              vision_profile: str = DEFAULT_VISION_PROFILE) -> Dict[str, Any]:
+    """
+    Coroutine version of analyze_image. The Vision call goes through the
+    asyncio client while the local PIL work runs on a worker thread.
     
-    # Load image into memory
-    with io.open(image_path, 'rb') as image_file:
-        content = image_file.read()
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        color_mode: One of COLOR_MODES
+        vision_profile: One of VISION_PROFILES
+        
+    Returns:
+        Same dictionary as analyze_image
+    """
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f"Unknown color mode: {color_mode}")
     
-    image = vision.Image(content=content)
+    content = read_image_source(image_source)
+    
+    local = asyncio.to_thread(get_local_features, content, color_mode != 'vision')
+    if color_mode == 'local_only':
+        features = empty_annotations()
+        features.update(await local)
+        return features
+    
+    features, local_features = await asyncio.gather(
+        annotate_image_content_async(content, include_image_properties=(color_mode == 'vision'),
+                                     profile=vision_profile),
+        local
+    )
+    features.update(local_features)
+    return features
+
+def empty_annotations() -> Dict[str, Any]:
+    """
+    Return the Vision part of the features as if nothing was detected.
+    """
+    return {
+        "dominant_colors": [],
+        "labels": [],
+        "emotions": {
+            "joy": 0,
+            "sorrow": 0,
+            "anger": 0,
+            "surprise": 0
+        },
+        "texts": []
+    }
+
+def annotate_image_content(content: bytes, include_image_properties: bool = True,
+                           profile: str = DEFAULT_VISION_PROFILE) -> Dict[str, Any]:
+    """
+    Run the Google Cloud Vision part of the analysis on raw image bytes.
     
-    # Request features from Vision API
-    features = [
-        {"type_": vision.Feature.Type.IMAGE_PROPERTIES},
-        {"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 10},
-        {"type_": vision.Feature.Type.FACE_DETECTION},
-        {"type_": vision.Feature.Type.TEXT_DETECTION},
-    ]
+    Args:
+        content: Encoded image bytes
+        include_image_properties: Request IMAGE_PROPERTIES for dominant colors
+        profile: One of VISION_PROFILES
+        
+    Returns:
+        Dictionary with dominant_colors, labels, emotions and texts
+    """
+    # Reuse the process-wide Vision client
+    client = get_analyzer().client
+    
+    image = vision.Image(content=content)
+    features = _requested_features(include_image_properties, profile)
+    started = time.perf_counter()
     
     # Make API request
-    response = client.annotate_image({
+    response = _vision_call(client.annotate_image, request={
         "image": image,
         "features": features,
     })
+    result = parse_annotation_response(response)
+    units, rpcs = len(features), 1
+    
+    if profile == 'adaptive' and mentions_people(result["labels"]):
+        face_response = _vision_call(client.annotate_image, request={"image": image, "features": [_FACE_DETECTION]})
+        result["emotions"] = parse_annotation_response(face_response)["emotions"]
+        units, rpcs = units + 1, rpcs + 1
+    
+    vision_usage.record(profile, time.perf_counter() - started, units, rpcs=rpcs)
+    return result
+
+async def annotate_image_content_async(content: bytes, include_image_properties: bool = True,
+                                       profile: str = DEFAULT_VISION_PROFILE) -> Dict[str, Any]:
+    """
+    Coroutine version of annotate_image_content using the asyncio Vision client.
+    
+    Args:
+        content: Encoded image bytes
+        include_image_properties: Request IMAGE_PROPERTIES for dominant colors
+        profile: One of VISION_PROFILES
+        
+    Returns:
+        Dictionary with dominant_colors, labels, emotions and texts
+    """
+    client = get_analyzer().async_client
+    
+    image = vision.Image(content=content)
+    features = _requested_features(include_image_properties, profile)
+    started = time.perf_counter()
+    
+    # The async client has no annotate_image helper; a one-image batch is the same RPC
+    batch_response = await _vision_call_async(client.batch_annotate_images, requests=[{
+        "image": image,
+        "features": features,
+    }])
+    result = parse_annotation_response(batch_response.responses[0])
+    units, rpcs = len(features), 1
+    
+    if profile == 'adaptive' and mentions_people(result["labels"]):
+        face_response = await _vision_call_async(client.batch_annotate_images, requests=[{
+            "image": image,
+            "features": [_FACE_DETECTION],
+        }])
+        result["emotions"] = parse_annotation_response(face_response.responses[0])["emotions"]
+        units, rpcs = units + 1, rpcs + 1
+    
+    vision_usage.record(profile, time.perf_counter() - started, units, rpcs=rpcs)
+    return result
+
+# Maximum number of images Vision accepts in one batch_annotate_images call
+VISION_BATCH_LIMIT = 16
+
+def annotate_images_batch(contents: List[bytes], include_image_properties: bool = True,
+                          profile: str = DEFAULT_VISION_PROFILE) -> List[Dict[str, Any]]:
+    """
+    Run the Google Cloud Vision part of the analysis on many images,
+    sending up to VISION_BATCH_LIMIT images per RPC.
     
+    Args:
+        contents: Encoded image bytes, one entry per image
+        include_image_properties: Request IMAGE_PROPERTIES for dominant colors
+        profile: One of VISION_PROFILES; adaptive sends one follow-up batch
+            for the images whose labels suggest people
+        
+    Returns:
+        One dictionary per image, in input order, with dominant_colors, labels,
+        emotions and texts, or with a single "error" key if Vision rejected that image
+    """
+    client = get_analyzer().client
+    features = _requested_features(include_image_properties, profile)
+    started = time.perf_counter()
+    rpcs = 0
+    
+    results = []
+    for start in range(0, len(contents), VISION_BATCH_LIMIT):
+        chunk = contents[start:start + VISION_BATCH_LIMIT]
+        batch_response = _vision_call(client.batch_annotate_images, requests=[
+            {"image": vision.Image(content=content), "features": features}
+            for content in chunk
+        ])
+        rpcs += 1
+        
+        for response in batch_response.responses:
+            if response.error.code:
+                results.append({"error": response.error.message})
+            else:
+                results.append(parse_annotation_response(response))
+    units = len(features) * len(contents)
+    
+    if profile == 'adaptive':
+        with_people = [index for index, result in enumerate(results)
+                       if "error" not in result and mentions_people(result["labels"])]
+        for start in range(0, len(with_people), VISION_BATCH_LIMIT):
+            chunk = with_people[start:start + VISION_BATCH_LIMIT]
+            batch_response = _vision_call(client.batch_annotate_images, requests=[
+                {"image": vision.Image(content=contents[index]), "features": [_FACE_DETECTION]}
+                for index in chunk
+            ])
+            rpcs += 1
+            # Faces are an extra; a failed follow-up keeps the neutral emotions
+            for index, response in zip(chunk, batch_response.responses):
+                if not response.error.code:
+                    results[index]["emotions"] = parse_annotation_response(response)["emotions"]
+        units += len(with_people)
+    
+    vision_usage.record(profile, time.perf_counter() - started, units, images=len(contents), rpcs=rpcs)
+    return results
+
+_FACE_DETECTION = {"type_": vision.Feature.Type.FACE_DETECTION}
+
+def _vision_call(method, **kwargs):
+    """
+    Send one Vision RPC, recording its latency and failures.
+    """
+    with _VISION_RPC_SECONDS.time():
+        try:
+            return method(**kwargs)
+        except Exception:
+            _VISION_ERRORS.inc()
+            raise
+
+async def _vision_call_async(method, **kwargs):
+    """
+    Await one asyncio Vision RPC, recording its latency and failures.
+    """
+    with _VISION_RPC_SECONDS.time():
+        try:
+            return await method(**kwargs)
+        except Exception:
+            _VISION_ERRORS.inc()
+            raise
+
+def _requested_features(include_image_properties: bool, profile: str = DEFAULT_VISION_PROFILE) -> List[Dict[str, Any]]:
+    """
+    Build the list of Vision features to request for a profile.
+    """
+    if profile not in VISION_PROFILES:
+        raise ValueError(f"Unknown Vision profile: {profile}")
+    
+    features = [{"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 10}]
+    if profile in ('standard', 'full'):
+        features.append(_FACE_DETECTION)
+    if profile == 'full':
+        features.append({"type_": vision.Feature.Type.TEXT_DETECTION})
+    if include_image_properties:
+        features.insert(0, {"type_": vision.Feature.Type.IMAGE_PROPERTIES})
+    return features
+
+def mentions_people(labels: List[Dict[str, Any]]) -> bool:
+    """
+    Check whether Vision labels suggest there are people in the image.
+    """
+    return any(label["description"].lower() in PEOPLE_LABELS for label in labels)
+
+def parse_annotation_response(response: vision.AnnotateImageResponse) -> Dict[str, Any]:
+    """
+    Convert a Vision annotation response into the feature dictionary.
+    
+    Args:
+        response: Vision AnnotateImageResponse for one image
+        
+    Returns:
+        Dictionary with dominant_colors, labels, emotions and texts
+    """
     # Extract dominant colors
     dominant_colors = []
     if response.image_properties_annotation:
@@ -109,21 +571,40 @@ def analyze_image(image_path: str) -> Dict[str, Any]:
                 "locale": text.locale if hasattr(text, 'locale') else None
             })
     
-    # Get basic image properties
-    image_obj = Image.open(image_path)
-    width, height = image_obj.size
-    brightness = get_average_brightness(image_obj)
-    
     return {
         "dominant_colors": dominant_colors,
         "labels": labels,
         "emotions": emotions,
-        "texts": texts,
-        "width": width,
-        "height": height,
-        "brightness": brightness
+        "texts": texts
     }
 
+def get_local_features(image_source: ImageSource, dominant_colors: bool = False) -> Dict[str, Any]:
+    """
+    Compute the image properties that don't need the Vision API.
+    
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        dominant_colors: Also extract dominant colors locally instead of via Vision
+        
+    Returns:
+        Dictionary with width, height, brightness, contrast, color_histogram
+        and, if requested, dominant_colors
+    """
+    # Decodes at reduced resolution and computes all statistics in one pass
+    return extract_local_features(image_source, dominant_colors=dominant_colors)
+
+def get_perceptual_hash(image_source: ImageSource) -> int:
+    """
+    Compute the 64-bit perceptual hash used to find near-duplicate uploads.
+    
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        
+    Returns:
+        Difference hash as an unsigned integer
+    """
+    return difference_hash(image_source)
+
 def get_average_brightness(image: Image.Image) -> float:
     """
     Calculate the average brightness of an image on a scale of 0 to 1.
@@ -0,0 +1,205 @@
+import colorsys
+import io
+from typing import Dict, Any, List, Tuple, Union, BinaryIO
+import numpy as np
+from PIL import Image, ImageOps
+from metrics import STAGE_SECONDS
+
+# Longest side of the downsampled copy used for local statistics
+DEFAULT_MAX_SIDE = 256
+
+# Bins per RGB channel in the coarse colour histogram (4 x 4 x 4 = 64 bins)
+HISTOGRAM_BINS = 4
+
+# Number of clusters and iterations for local dominant-color extraction
+DOMINANT_COLOR_COUNT = 5
+KMEANS_ITERATIONS = 8
+
+# Pixels sampled for k-means; the downsampled image is strided down to about this many
+KMEANS_SAMPLE_SIZE = 4096
+
+# Rows and bits per row of the difference hash (8 x 8 = 64 bits)
+HASH_SIZE = 8
+
+# Longest side decoded for the difference hash; libjpeg's 1/8 draft scale gets close
+HASH_DECODE_SIDE = 64
+
+_DECODE_SECONDS = STAGE_SECONDS.labels("decode")
+_STATISTICS_SECONDS = STAGE_SECONDS.labels("statistics")
+_DOMINANT_COLORS_SECONDS = STAGE_SECONDS.labels("dominant_colors")
+_PERCEPTUAL_HASH_SECONDS = STAGE_SECONDS.labels("perceptual_hash")
+
+# ITU-R 601-2 luma weights, the same ones PIL uses for convert('L')
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+def open_reduced(image_source: Union[str, bytes, BinaryIO], max_side: int = DEFAULT_MAX_SIDE) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Decode an image at reduced resolution.
+
+    JPEGs are decoded with draft(), which lets libjpeg scale by 1/2, 1/4 or
+    1/8 during decoding so the full-resolution bitmap is never materialized.
+    Other formats are decoded normally and then thumbnailed.
+
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        max_side: Longest side of the returned image
+
+    Returns:
+        Tuple of (downsampled RGB image, original (width, height))
+    """
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        image_source = io.BytesIO(image_source)
+
+    image = Image.open(image_source)
+    original_size = image.size
+
+    # No-op for formats without reduced decoding support
+    image.draft('RGB', (max_side, max_side))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+
+    return image, original_size
+
+def compute_statistics(image: Image.Image) -> Dict[str, Any]:
+    """
+    Compute brightness, contrast and a coarse colour histogram in one pass.
+
+    Args:
+        image: RGB PIL Image, ideally already downsampled
+
+    Returns:
+        Dictionary with brightness and contrast (0.0 to 1.0) and a normalized
+        64-bin RGB colour histogram
+    """
+    pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+
+    luma = pixels @ LUMA_WEIGHTS
+    brightness = float(luma.mean()) / 255
+    contrast = float(luma.std()) / 255
+
+    # Quantize each channel to HISTOGRAM_BINS levels and index the 3D bin
+    shift = 8 - int(np.log2(HISTOGRAM_BINS))
+    quantized = (pixels >> shift).astype(np.intp)
+    bin_index = (quantized[:, 0] * HISTOGRAM_BINS + quantized[:, 1]) * HISTOGRAM_BINS + quantized[:, 2]
+    histogram = np.bincount(bin_index, minlength=HISTOGRAM_BINS ** 3) / len(bin_index)
+
+    return {
+        "brightness": brightness,
+        "contrast": contrast,
+        "color_histogram": [round(float(value), 4) for value in histogram]
+    }
+
+def extract_dominant_colors(image: Image.Image, count: int = DOMINANT_COLOR_COUNT) -> List[Dict[str, Any]]:
+    """
+    Find the dominant colors of an image with vectorized k-means.
+
+    Centroids start at the most populated cells of the coarse RGB histogram,
+    so results are deterministic. The output matches the structure that
+    analyze_image builds from Vision's IMAGE_PROPERTIES annotation.
+
+    Args:
+        image: RGB PIL Image, ideally already downsampled
+        count: Number of colors to return
+
+    Returns:
+        List of colors with rgb, hsv, score and pixel_fraction, most common first
+    """
+    pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+    step = max(len(pixels) // KMEANS_SAMPLE_SIZE, 1)
+    samples = pixels[::step].astype(np.float32)
+
+    # Seed centroids from the most populated histogram cells
+    shift = 8 - int(np.log2(HISTOGRAM_BINS))
+    quantized = samples.astype(np.intp) >> shift
+    bin_index = (quantized[:, 0] * HISTOGRAM_BINS + quantized[:, 1]) * HISTOGRAM_BINS + quantized[:, 2]
+    populated = np.argsort(np.bincount(bin_index, minlength=HISTOGRAM_BINS ** 3))[::-1]
+    populated = populated[:count]
+    centroids = np.stack([samples[bin_index == cell].mean(axis=0) for cell in populated
+                          if np.any(bin_index == cell)])
+
+    for _ in range(KMEANS_ITERATIONS):
+        distances = ((samples[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+        assignment = distances.argmin(axis=1)
+        sizes = np.bincount(assignment, minlength=len(centroids))
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, samples)
+        occupied = sizes > 0
+        updated = centroids.copy()
+        updated[occupied] = sums[occupied] / sizes[occupied, None]
+        if np.allclose(updated, centroids, atol=0.5):
+            break
+        centroids = updated
+
+    distances = ((samples[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+    sizes = np.bincount(distances.argmin(axis=1), minlength=len(centroids))
+    fractions = sizes / len(samples)
+
+    dominant_colors = []
+    for index in np.argsort(fractions)[::-1]:
+        if fractions[index] == 0:
+            continue
+        r, g, b = (int(round(float(channel))) for channel in centroids[index])
+        h, s, v = colorsys.rgb_to_hsv(r/255, g/255, b/255)
+        dominant_colors.append({
+            "rgb": {"r": r, "g": g, "b": b},
+            "hsv": {"h": h, "s": s, "v": v},
+            "score": float(fractions[index]),
+            "pixel_fraction": float(fractions[index])
+        })
+
+    return dominant_colors
+
+def extract_local_features(image_source: Union[str, bytes, BinaryIO], max_side: int = DEFAULT_MAX_SIDE,
+                           dominant_colors: bool = False) -> Dict[str, Any]:
+    """
+    Compute all local image features from a single downsampled decode.
+
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        max_side: Longest side of the downsampled copy
+        dominant_colors: Also extract dominant colors locally
+
+    Returns:
+        Dictionary with width and height of the original image, brightness,
+        contrast, color_histogram and, if requested, dominant_colors
+    """
+    with _DECODE_SECONDS.time():
+        image, (width, height) = open_reduced(image_source, max_side)
+
+    features = {
+        "width": width,
+        "height": height
+    }
+    with _STATISTICS_SECONDS.time():
+        features.update(compute_statistics(image))
+    if dominant_colors:
+        with _DOMINANT_COLORS_SECONDS.time():
+            features["dominant_colors"] = extract_dominant_colors(image)
+    return features
+
+def difference_hash(image_source: Union[str, bytes, BinaryIO], hash_size: int = HASH_SIZE) -> int:
+    """
+    Compute a perceptual difference hash (dHash) of an image.
+
+    The image is decoded at low resolution, turned upright per its EXIF
+    orientation, shrunk to (hash_size + 1) x hash_size grey pixels and each
+    bit records whether a pixel is brighter than its right neighbour.
+    Re-encoding, resizing and stripping metadata barely change the result,
+    so copies of one photo land within a few bits of each other.
+
+    Args:
+        image_source: Path to the image file, its encoded bytes, or a binary buffer
+        hash_size: Bits per row; the hash has hash_size ** 2 bits
+
+    Returns:
+        Hash as an unsigned integer
+    """
+    with _PERCEPTUAL_HASH_SECONDS.time():
+        image, _ = open_reduced(image_source, max_side=HASH_DECODE_SIDE)
+        image = ImageOps.exif_transpose(image)
+        gray = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+
+        pixels = np.asarray(gray, dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
@@ -0,0 +1,256 @@
+"""
+Structured logging for the request path.
+
+Modules log named events with keyword fields instead of printing:
+
+    log = get_logger(__name__)
+    log.warning("spotify.search_failed", query=search_query, error=str(e))
+
+Each record is written as one JSON object per line (LOG_FORMAT=text gives
+key=value lines for local runs) and carries the id of the request it was
+logged for.
+
+Logging must not slow down a request, so the calling thread only checks
+the level and sampling rate and builds the record. Records go onto a
+bounded queue and a listener thread formats and writes them; when the
+queue is full the record is dropped and counted rather than waited on.
+Field values given as zero-argument callables are only evaluated if the
+event is emitted, so debug dumps of large values cost nothing while DEBUG
+is off. Busy events can be sampled with LOG_SAMPLE_RATES; sampled records
+carry their sample_rate so counts can be scaled back up.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from itertools import count
+from typing import Any, Dict, Optional
+
+# Id of the request being handled, set by the web app for every request
+REQUEST_ID: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Accepted form of a caller-supplied X-Request-ID header
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+def bind_request_id(incoming: Optional[str] = None) -> str:
+    """
+    Set the request id for the current context.
+
+    Args:
+        incoming: X-Request-ID sent by the caller, kept if it is well formed
+
+    Returns:
+        The request id now in effect
+    """
+    request_id = incoming if incoming and _REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+    REQUEST_ID.set(request_id)
+    return request_id
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that runs each task in a copy of the submitting
+    thread's context, so work done on behalf of a request logs its id.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    """
+    Parse "event=rate,..." (e.g. "spotify.search_skipped=0.01"); "*" sets the default rate.
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, _, rate = item.partition("=")
+        value = float(rate)
+        if not 0 <= value <= 1:
+            raise ValueError(f"Sample rate for {event} must be between 0 and 1")
+        rates[event.strip()] = value
+    return rates
+
+# Fraction of each event's records kept; events not listed use "*" (default 1)
+_sample_rates: Dict[str, float] = {}
+
+class EventLogger:
+    """
+    Wrapper around a logging.Logger that logs named events with fields.
+    """
+
+    __slots__ = ("_logger",)
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def enabled_for(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, event: str, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields):
+        """Log at ERROR with the exception being handled"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def log(self, level: int, event: str, **fields):
+        self._log(level, event, fields)
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any], exc_info: bool = False):
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = _sample_rates.get(event, _sample_rates.get("*", 1.0))
+        if rate < 1.0:
+            if random.random() >= rate:
+                return
+            fields["sample_rate"] = rate
+        for name, value in fields.items():
+            if callable(value):
+                fields[name] = value()
+        # stacklevel points the record at the caller of debug()/info()/...
+        self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(logging.getLogger(name))
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: time, level, logger, event, request_id and the event's fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))}.{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        entry.update(getattr(record, "fields", {}))
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        if exc_text:
+            entry["exc"] = exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """
+    Human-readable key=value lines for local runs.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [self.formatTime(record), record.levelname, record.name, record.getMessage()]
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            parts.append(f"request_id={request_id}")
+        parts.extend(f"{name}={value!r}" for name, value in getattr(record, "fields", {}).items())
+        line = " ".join(parts)
+        exc_text = record.exc_text or (self.formatException(record.exc_info) if record.exc_info else None)
+        return f"{line}\n{exc_text}" if exc_text else line
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that stamps the request id and drops records when the
+    queue is full instead of blocking or raising.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self._dropped = count()
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Runs in the thread that logged, where the request context is current
+        record.request_id = REQUEST_ID.get()
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Render the traceback before its frames move on
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped = next(self._dropped) + 1
+
+_CHATTY_LIBRARIES = ("PIL", "urllib3", "httpx", "httpcore", "grpc")
+
+_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_output: Optional[logging.Handler] = None
+
+def configure_logging():
+    """
+    Route the root logger through the queue to stdout. Safe to call more than once.
+
+    Reads LOG_LEVEL (default INFO), LOG_FORMAT (json or text),
+    LOG_SAMPLE_RATES and LOG_QUEUE_SIZE (records buffered before dropping).
+    """
+    global _handler, _output
+    if _handler is not None:
+        return
+
+    _sample_rates.update(parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', '')))
+
+    _output = logging.StreamHandler(sys.stdout)
+    _output.setFormatter(TextFormatter() if os.getenv('LOG_FORMAT', 'json') == 'text' else JsonFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+
+    root = logging.getLogger()
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    root.addHandler(_handler)
+    # Libraries' own per-request output (httpx logs every call at INFO, PIL
+    # every EXIF tag at DEBUG) would swamp the app's events
+    for name in _CHATTY_LIBRARIES:
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
+    _start_listener()
+
+    atexit.register(_stop_listener)
+    # The listener thread doesn't survive fork (gunicorn --preload), so each
+    # child gets a fresh queue and its own listener
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+def _start_listener():
+    global _listener
+    _listener = logging.handlers.QueueListener(_handler.queue, _output, respect_handler_level=True)
+    _listener.start()
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def _restart_after_fork():
+    _handler.queue = queue.Queue(maxsize=_handler.queue.maxsize)
+    _start_listener()
+
+def log_stats() -> Dict[str, Any]:
+    """
+    Report records waiting in the queue and records dropped because it was full.
+    """
+    if _handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
@@ -0,0 +1,248 @@
+import json
+import os
+from bisect import bisect_right
+from collections import deque
+from functools import lru_cache
+from typing import Dict, Any, List, Sequence
+import numpy as np
+
+# Default location of the mapping weights, overridable with MOOD_MAPPINGS_PATH
+DEFAULT_MAPPINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mood_mappings.json')
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton that finds every keyword occurring as a substring
+    of a text in a single pass over the text.
+    """
+
+    def __init__(self, keywords: Sequence[str]):
+        """
+        Build the automaton.
+
+        Args:
+            keywords: Keywords to search for; matches are reported by index
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for index, keyword in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(index)
+
+        # Breadth-first pass to set failure links and inherit their outputs
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(char, 0)
+                # Children of the root fail back to the root, not to themselves
+                self._fail[next_state] = candidate if candidate != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> List[int]:
+        """
+        Find which keywords occur in a text.
+
+        Args:
+            text: Text to scan
+
+        Returns:
+            Sorted indices of the keywords found
+        """
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state]:
+                found.update(self._output[state])
+        return sorted(found)
+
+class MoodMappingEngine:
+    """
+    Maps image features to target audio features and candidate genres.
+
+    Everything derived from the mapping config is compiled once: hue bins
+    become a sorted table searched with bisect, and label keywords become an
+    Aho-Corasick automaton, so mapping a feature dict does no per-call setup.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Compile the engine from a mapping config.
+
+        Args:
+            config: Parsed mood mapping config (see mood_mappings.json)
+        """
+        hue_bins = sorted(config["hue_bins"], key=lambda hue_bin: hue_bin["start"])
+        self.hue_starts = [hue_bin["start"] for hue_bin in hue_bins]
+        self.hue_genres = [tuple(hue_bin["genres"]) for hue_bin in hue_bins]
+        self.hue_tempos = [hue_bin["tempo"] for hue_bin in hue_bins]
+        self._hue_starts_array = np.array(self.hue_starts, dtype=np.float64)
+        self._hue_tempos_array = np.array(self.hue_tempos, dtype=np.float64)
+
+        intensity = config["intensity"]
+        self.saturation_threshold = intensity["saturation_threshold"]
+        self.intensity_genres = frozenset(intensity["genres"])
+
+        valence = config["valence"]
+        self.valence_base = valence["base"]
+        self.joy_weight = valence["joy_weight"]
+        self.sorrow_weight = valence["sorrow_weight"]
+
+        self.label_keywords = list(config["label_genres"].keys())
+        self.label_genres = [tuple(config["label_genres"][keyword]) for keyword in self.label_keywords]
+        self._automaton = KeywordAutomaton(self.label_keywords)
+        # Vision label descriptions come from a limited vocabulary, so each
+        # distinct description only goes through the automaton once
+        self._genres_for_description = lru_cache(maxsize=8192)(self._scan_description)
+
+        self.default_genres = list(config["default_genres"])
+        self.max_seed_genres = config["max_seed_genres"]
+
+    @classmethod
+    def from_file(cls, path: str) -> 'MoodMappingEngine':
+        """
+        Load and compile an engine from a JSON config file.
+        """
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def hue_bin(self, hue: float) -> int:
+        """
+        Return the index of the hue bin containing a hue in [0, 1).
+        """
+        return max(bisect_right(self.hue_starts, hue) - 1, 0)
+
+    def genres_for_labels(self, labels: List[Dict[str, Any]]) -> List[str]:
+        """
+        Collect the genres mapped to every keyword found in the label descriptions.
+
+        Args:
+            labels: Vision labels with a description
+
+        Returns:
+            Genres in label order, then keyword order, with repeats
+        """
+        genres = []
+        for label in labels:
+            genres.extend(self._genres_for_description(label.get('description', '').lower()))
+        return genres
+
+    def _scan_description(self, description: str) -> tuple:
+        """
+        Return the genres for every keyword found in one lowercased description.
+        """
+        genres = []
+        for keyword_index in self._automaton.search(description):
+            genres.extend(self.label_genres[keyword_index])
+        return tuple(genres)
+
+    def map_features(self, image_features: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Map one image's features to target energy, valence, tempo and seed genres.
+
+        Args:
+            image_features: Dictionary containing features extracted from the image
+
+        Returns:
+            Dictionary with energy, valence, tempo and genres (not yet checked
+            against the Spotify genre catalog)
+        """
+        colors = image_features.get('dominant_colors', [])
+        emotions = image_features.get('emotions', {})
+
+        # Map image brightness to energy, emotions to valence
+        energy = image_features.get('brightness', 0.5)
+        valence = self.valence_base
+        if emotions:
+            valence = (self.valence_base
+                       + emotions.get('joy', 0) * self.joy_weight
+                       - emotions.get('sorrow', 0) * self.sorrow_weight)
+            valence = max(0.0, min(1.0, valence))
+
+        # Map the main color to tempo and genres
+        tempo = 0
+        genres = []
+        if colors:
+            hsv = colors[0].get('hsv', {})
+            bin_index = self.hue_bin(hsv.get('h', 0))
+            genres.extend(self.hue_genres[bin_index])
+            tempo += self.hue_tempos[bin_index]
+
+            # Saturation affects intensity - higher saturation = more intense genres
+            if hsv.get('s', 0) > self.saturation_threshold:
+                genres = [g for g in genres if g in self.intensity_genres] or genres
+
+            # Value (brightness) affects energy
+            energy = hsv.get('v', 0)
+
+        genres.extend(self.genres_for_labels(image_features.get('labels', [])))
+
+        # Dedupe keeping first-seen order (max 5 seeds for the Spotify API)
+        unique_genres = list(dict.fromkeys(genres))[:self.max_seed_genres]
+        if not unique_genres:
+            unique_genres = list(self.default_genres)
+
+        return {
+            'energy': energy,
+            'valence': valence,
+            'tempo': tempo,
+            'genres': unique_genres
+        }
+
+    def score_batch(self, features_list: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        """
+        Compute target energy, valence and tempo for many images at once.
+
+        Args:
+            features_list: Feature dictionaries, one per image
+
+        Returns:
+            Dictionary of arrays (energy, valence, tempo, hue_bin) aligned with
+            features_list; hue_bin is -1 for images without dominant colors
+        """
+        count = len(features_list)
+        has_color = np.zeros(count, dtype=bool)
+        hsv = np.zeros((count, 3), dtype=np.float64)
+        brightness = np.empty(count, dtype=np.float64)
+        joy = np.zeros(count, dtype=np.float64)
+        sorrow = np.zeros(count, dtype=np.float64)
+
+        for i, image_features in enumerate(features_list):
+            brightness[i] = image_features.get('brightness', 0.5)
+            colors = image_features.get('dominant_colors')
+            if colors:
+                color = colors[0].get('hsv', {})
+                has_color[i] = True
+                hsv[i] = (color.get('h', 0), color.get('s', 0), color.get('v', 0))
+            emotions = image_features.get('emotions')
+            if emotions:
+                joy[i] = emotions.get('joy', 0)
+                sorrow[i] = emotions.get('sorrow', 0)
+
+        bins = np.maximum(np.searchsorted(self._hue_starts_array, hsv[:, 0], side='right') - 1, 0)
+        bins = np.where(has_color, bins, -1)
+
+        return {
+            'energy': np.where(has_color, hsv[:, 2], brightness),
+            'valence': np.clip(self.valence_base + joy * self.joy_weight - sorrow * self.sorrow_weight, 0.0, 1.0),
+            'tempo': np.where(has_color, self._hue_tempos_array[np.maximum(bins, 0)], 0.0),
+            'hue_bin': bins
+        }
+
+# Compiled once at import and shared by every request
+ENGINE = MoodMappingEngine.from_file(os.getenv('MOOD_MAPPINGS_PATH', DEFAULT_MAPPINGS_PATH))
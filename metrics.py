@@ -0,0 +1,447 @@
+"""
+In-process counters and latency histograms, rendered in the Prometheus
+text exposition format for /api/metrics.
+
+Recording must not slow down the request path, so every metric keeps one
+shard of counts per thread. A thread only ever writes its own shard and
+never takes a lock; a scrape sums the shards. When a thread ends its
+counts are folded into a retired total, so thread-per-request servers
+don't accumulate shards. Values that other components already count
+(cache hit ratios, Spotify scheduler counters, Vision usage) are read at
+scrape time through collectors instead of being counted twice.
+"""
+import bisect
+import re
+import threading
+import time
+import weakref
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from urllib.parse import urlparse
+from logs import get_logger, log_stats
+
+log = get_logger(__name__)
+
+# Upper bounds in seconds; covers local PIL work (ms) up to slow Vision/Spotify calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Percentiles reported alongside each histogram, estimated from its buckets
+QUANTILES = (0.5, 0.95, 0.99)
+
+PREFIX = "image_to_music_"
+
+# A metric family as rendered: samples are (name suffix, labels, value)
+MetricFamily = namedtuple("MetricFamily", ["name", "type", "documentation", "samples"])
+
+class _ThreadToken:
+    """Lives in a thread's local storage; its finalizer runs when the thread ends."""
+    __slots__ = ("__weakref__",)
+
+class _ThreadShards:
+    """
+    Per-thread lists of numbers for one metric child.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = {}
+        self._retired = [0] * size
+
+    def shard(self) -> List[float]:
+        try:
+            return self._local.values
+        except AttributeError:
+            return self._register()
+
+    def _register(self) -> List[float]:
+        # Once per thread; the lock only guards the shard list
+        values = [0] * self._size
+        token = _ThreadToken()
+        self._local.values = values
+        self._local.token = token
+        key = id(token)
+        with self._lock:
+            self._live[key] = values
+        weakref.finalize(token, self._retire, key)
+        return values
+
+    def _retire(self, key: int):
+        with self._lock:
+            values = self._live.pop(key, None)
+            if values is not None:
+                for index, value in enumerate(values):
+                    self._retired[index] += value
+
+    def totals(self) -> List[float]:
+        with self._lock:
+            totals = list(self._retired)
+            for values in self._live.values():
+                for index, value in enumerate(values):
+                    totals[index] += value
+        return totals
+
+class _Timer:
+    """Context manager observing the elapsed time into a histogram child."""
+    __slots__ = ("_child", "_started")
+
+    def __init__(self, child: '_HistogramChild'):
+        self._child = child
+
+    def __enter__(self) -> '_Timer':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._started)
+
+class _CounterChild:
+    __slots__ = ("_shards",)
+
+    def __init__(self):
+        self._shards = _ThreadShards(1)
+
+    def inc(self, amount: float = 1):
+        self._shards.shard()[0] += amount
+
+    def value(self) -> float:
+        return self._shards.totals()[0]
+
+class _HistogramChild:
+    __slots__ = ("_buckets", "_shards")
+
+    def __init__(self, buckets: Sequence[float]):
+        self._buckets = buckets
+        # One count per bucket, one for +Inf, then the running sum
+        self._shards = _ThreadShards(len(buckets) + 2)
+
+    def observe(self, value: float):
+        values = self._shards.shard()
+        values[bisect.bisect_left(self._buckets, value)] += 1
+        values[-1] += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[float], float]:
+        """
+        Returns:
+            Tuple of (count per bucket including +Inf, sum of observed values)
+        """
+        totals = self._shards.totals()
+        return totals[:-1], totals[-1]
+
+def estimate_quantile(buckets: Sequence[float], counts: Sequence[float], quantile: float) -> float:
+    """
+    Estimate a quantile from bucket counts by interpolating inside the bucket
+    it falls in, as Prometheus' histogram_quantile does. Values past the last
+    bound are reported as that bound.
+    """
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = quantile * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if index == len(buckets):
+                return buckets[-1]
+            lower = buckets[index - 1] if index else 0.0
+            return lower + (buckets[index] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        """
+        Return the child for these label values, in labelnames order.
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> MetricFamily:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """
+    Monotonic count, e.g. errors by source.
+    """
+    type = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def collect(self) -> MetricFamily:
+        samples = [("", dict(zip(self.labelnames, values)), child.value())
+                   for values, child in list(self._children.items())]
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+class Histogram(_Metric):
+    """
+    Distribution of durations in seconds, with cumulative buckets, sum,
+    count and estimated p50/p95/p99.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: 'Registry' = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def collect(self) -> MetricFamily:
+        samples = []
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+    def collect_quantiles(self) -> MetricFamily:
+        samples = []
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            counts, _ = child.snapshot()
+            for quantile in QUANTILES:
+                samples.append(("", dict(labels, quantile=str(quantile)),
+                                estimate_quantile(self.buckets, counts, quantile)))
+        return MetricFamily(f"{self.name}_quantile", "gauge",
+                            f"{self.documentation} (percentiles estimated from the buckets)", samples)
+
+class Registry:
+    """
+    Metrics and scrape-time collectors rendered together by /api/metrics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        """
+        Add a function returning metric families built at scrape time.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[MetricFamily]:
+        families = []
+        for metric in list(self._metrics):
+            families.append(metric.collect())
+            if isinstance(metric, Histogram):
+                families.append(metric.collect_quantiles())
+        for collector in list(self._collectors):
+            try:
+                families.extend(collector())
+            except Exception as e:
+                log.warning("metrics.collector_failed", error=str(e))
+        return families
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for family in self.collect():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for suffix, labels, value in family.samples:
+                lines.append(f"{family.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+REGISTRY = Registry()
+
+# Stages of image analysis and recommendation, e.g. vision_rpc, decode, search
+STAGE_SECONDS = Histogram(f"{PREFIX}stage_duration_seconds",
+                          "Time spent in each analysis and recommendation stage", ["stage"])
+
+# Every HTTP request to the Spotify Web API or accounts service, retries included
+SPOTIFY_REQUEST_SECONDS = Histogram(f"{PREFIX}spotify_request_duration_seconds",
+                                    "Spotify HTTP requests by endpoint and response status",
+                                    ["endpoint", "status"])
+
+HTTP_REQUEST_SECONDS = Histogram(f"{PREFIX}http_request_duration_seconds",
+                                 "Requests served by this app by route, method and status",
+                                 ["route", "method", "status"])
+
+ERRORS = Counter(f"{PREFIX}errors_total", "Errors by where they happened and what kind they were",
+                 ["source", "kind"])
+
+# Spotify ids are 22 base62 characters
+_SPOTIFY_ID = re.compile(r"^[0-9A-Za-z]{22}$")
+
+def spotify_endpoint(url: str) -> str:
+    """
+    Label for a Spotify URL: its path below /v1 or /api, with ids replaced.
+    """
+    segments = [segment for segment in urlparse(url).path.split("/") if segment]
+    if segments and segments[0] in ("v1", "api"):
+        segments = segments[1:]
+    return "/".join("{id}" if _SPOTIFY_ID.match(segment) else segment for segment in segments)
+
+def cache_families(caches: Dict[str, Dict[str, Any]]) -> List[MetricFamily]:
+    """
+    Metric families for caches, given each cache's stats() by name.
+
+    Understands the stats of LRUCache/SQLiteCache (hits), StaleWhileRevalidateCache
+    (fresh and stale hits, entries from its backend) and HammingIndex (matches).
+    """
+    lookups, ratios, entries = [], [], []
+    for name, stats in caches.items():
+        if "fresh_hits" in stats:
+            hits, misses = stats["fresh_hits"] + stats["stale_hits"], stats["misses"]
+            size = stats["backend"]["entries"]
+        elif "matches" in stats:
+            hits, misses = stats["matches"], stats["lookups"] - stats["matches"]
+            size = stats["entries"]
+        else:
+            hits, misses, size = stats["hits"], stats["misses"], stats["entries"]
+        lookups.append(("", {"cache": name, "result": "hit"}, hits))
+        lookups.append(("", {"cache": name, "result": "miss"}, misses))
+        ratios.append(("", {"cache": name}, hits / (hits + misses) if hits + misses else 0.0))
+        entries.append(("", {"cache": name}, size))
+    return [
+        MetricFamily(f"{PREFIX}cache_lookups_total", "counter", "Cache lookups by result", lookups),
+        MetricFamily(f"{PREFIX}cache_hit_ratio", "gauge", "Share of cache lookups that hit", ratios),
+        MetricFamily(f"{PREFIX}cache_entries", "gauge", "Entries currently held by each cache", entries),
+    ]
+
+def spotify_families(scheduler_stats: Dict[str, Any]) -> List[MetricFamily]:
+    """
+    Metric families for a Spotify client's scheduler_stats().
+    """
+    circuit = scheduler_stats["circuit"]
+    return [
+        MetricFamily(f"{PREFIX}spotify_scheduler_events_total", "counter",
+                     "Spotify calls throttled (429), retried, short-circuited by the breaker "
+                     "or dropped past the search budget",
+                     [("", {"event": event}, scheduler_stats[event])
+                      for event in ("throttled", "retried", "short_circuited", "searches_dropped")]),
+        MetricFamily(f"{PREFIX}spotify_rate_limit_wait_seconds_total", "counter",
+                     "Time spent waiting for the Spotify rate limiter",
+                     [("", {}, scheduler_stats["rate_limit_wait_seconds"])]),
+        MetricFamily(f"{PREFIX}spotify_circuit_open", "gauge",
+                     "1 while the Spotify circuit breaker is open",
+                     [("", {}, 1 if circuit["state"] == "open" else 0)]),
+    ]
+
+def vision_families(usage: Dict[str, Dict[str, Any]]) -> List[MetricFamily]:
+    """
+    Metric families for VisionUsage.stats().
+    """
+    return [
+        MetricFamily(f"{PREFIX}vision_units_total", "counter",
+                     "Billable Vision feature units requested per profile",
+                     [("", {"profile": profile}, stats["units"]) for profile, stats in usage.items()]),
+        MetricFamily(f"{PREFIX}vision_images_total", "counter",
+                     "Images annotated by Vision per profile",
+                     [("", {"profile": profile}, stats["images"]) for profile, stats in usage.items()]),
+    ]
+
+def logging_families(stats: Dict[str, Any]) -> List[MetricFamily]:
+    """
+    Metric families for logs.log_stats().
+    """
+    return [
+        MetricFamily(f"{PREFIX}log_records_dropped_total", "counter",
+                     "Log records dropped because the log queue was full", [("", {}, stats["dropped"])]),
+        MetricFamily(f"{PREFIX}log_queue_depth", "gauge",
+                     "Log records waiting to be written", [("", {}, stats["queued"])]),
+    ]
+
+def component_collector(analysis_cache, spotify_client, near_duplicate_index=None,
+                        vision_usage=None, recommendation_cache=None,
+                        last_recommendations=None) -> Callable[[], List[MetricFamily]]:
+    """
+    Build a collector reporting the app's caches, Spotify scheduler and Vision usage.
+
+    Args:
+        analysis_cache: TieredCache of image features
+        spotify_client: SpotifyClient or AsyncSpotifyClient
+        near_duplicate_index: Optional HammingIndex of perceptual hashes
+        vision_usage: Optional VisionUsage
+        recommendation_cache: Optional RecommendationCache
+        last_recommendations: Optional LRUCache of the last recommendations per image
+
+    Returns:
+        Function to pass to Registry.register_collector
+    """
+    def collect() -> List[MetricFamily]:
+        caches = {"analysis_memory": analysis_cache.memory.stats()}
+        if analysis_cache.disk is not None:
+            caches["analysis_disk"] = analysis_cache.disk.stats()
+        caches["spotify_search"] = spotify_client.search_cache.stats()
+        caches["track_store"] = spotify_client.track_store.stats()
+        if near_duplicate_index is not None:
+            caches["near_duplicate"] = near_duplicate_index.stats()
+        if recommendation_cache is not None:
+            caches["recommendations"] = recommendation_cache.stats()
+        if last_recommendations is not None:
+            caches["last_recommendations"] = last_recommendations.stats()
+
+        families = cache_families(caches)
+        families.extend(spotify_families(spotify_client.scheduler_stats()))
+        if vision_usage is not None:
+            families.extend(vision_families(vision_usage.stats()))
+        return families
+    return collect
+
+# The log queue is process-wide, so it is reported whichever app is running
+REGISTRY.register_collector(lambda: logging_families(log_stats()))
@@ -1,168 +1,192 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Union
+from cache import RecommendationCache
 from spotify_client import SpotifyClient
+from track_store import Track
+from mapping_engine import ENGINE
+from track_catalog import TrackCatalog
+from metrics import ERRORS, STAGE_SECONDS
+from logs import get_logger
 
-def get_music_recommendations(image_features: Dict[str, Any], spotify_client: SpotifyClient) -> List[Dict[str, Any]]:
+log = get_logger(__name__)
+
+_GENRE_FETCH_SECONDS = STAGE_SECONDS.labels("genre_fetch")
+_MAPPING_SECONDS = STAGE_SECONDS.labels("mapping")
+_CATALOG_SECONDS = STAGE_SECONDS.labels("catalog")
+_SEARCH_SECONDS = STAGE_SECONDS.labels("search")
+
+def get_music_recommendations(image_features: Dict[str, Any], spotify_client: SpotifyClient,
+                              track_catalog: Optional[TrackCatalog] = None,
+                              recommendation_cache: Optional[RecommendationCache] = None) -> List[Dict[str, Any]]:
     """
     Generate music recommendations based on image features.
     
     Args:
         image_features: Dictionary containing features extracted from the image
         spotify_client: Initialized SpotifyClient instance
+        track_catalog: Optional local catalog tried before Spotify search
+        recommendation_cache: Optional cache of tracks shared by images with the same quantized mood
         
     Returns:
         List of recommended tracks with their details
     """
-    # Get valid genres from Spotify
-    try:
-        available_genres = spotify_client.get_available_genre_seeds()
-        print(f"Available Spotify genres: {available_genres[:10]}...")  # Print first 10 for debugging
-    except Exception as e:
-        print(f"Warning: Couldn't get available genres: {e}")
-        available_genres = []  # Use a default fallback list
-    
-    # Extract relevant features
-    colors = image_features.get('dominant_colors', [])
-    labels = image_features.get('labels', [])
-    emotions = image_features.get('emotions', {})
-    brightness = image_features.get('brightness', 0.5)
-    
-    # Define mappings
-    
-    # Map image brightness to audio features
-    energy = brightness
-    valence = 0.5  # Default neutral valence (happiness)
+    mood = derive_mood(image_features, spotify_client)
     
-    # Adjust valence based on detected emotions
-    if emotions:
-        joy_level = emotions.get('joy', 0)
-        sadness_level = emotions.get('sorrow', 0)
+    tracks = recommendation_cache.lookup(mood) if recommendation_cache is not None else None
+    if tracks is None:
+        # A cache miss fetches a whole pool for the mood
+        query_mood = recommendation_cache.pool_mood(mood) if recommendation_cache is not None else mood
+        
+        # The local catalog matches the targets directly and needs no network
+        tracks = recommend_from_catalog(query_mood, track_catalog)
         
-        # Joy increases valence, sadness decreases it
-        valence = 0.5 + (joy_level * 0.1) - (sadness_level * 0.1)
+        if not tracks:
+            # Get recommendations from Spotify
+            with _SEARCH_SECONDS.time():
+                tracks = spotify_client.get_recommendations_via_search(**query_mood['params'])
         
-        # Clamp values between 0 and 1
-        valence = max(0.0, min(1.0, valence))
+        if recommendation_cache is not None:
+            tracks = recommendation_cache.store(mood, tracks)
     
-    # Map color to audio features and genres
-    tempo = 0
-    genres = []
+    return finalize_recommendations(tracks, mood, image_features)
+
+def recommend_from_catalog(mood: Dict[str, Any], track_catalog: Optional[TrackCatalog]) -> List[Dict[str, Any]]:
+    """
+    Find the catalog tracks nearest to the mood's target audio features.
     
-    if colors:
-        main_color = colors[0]
-        hue = main_color.get('hsv', {}).get('h', 0)
-        saturation = main_color.get('hsv', {}).get('s', 0)
-        value = main_color.get('hsv', {}).get('v', 0)
-        
-        # Map hue to genres
-        if 0 <= hue < 0.05 or hue >= 0.95:  # Red
-            genres.extend(['rock', 'metal', 'punk'])
-            tempo += 150
-        elif 0.05 <= hue < 0.17:  # Orange
-            genres.extend(['pop', 'reggae', 'latin'])
-            tempo += 110
-        elif 0.17 <= hue < 0.33:  # Yellow
-            genres.extend(['pop', 'dance', 'happy'])
-            tempo += 120
-        elif 0.33 <= hue < 0.5:  # Green
-            genres.extend(['chill', 'ambient', 'acoustic'])
-            tempo += 95
-        elif 0.5 <= hue < 0.66:  # Blue
-            genres.extend(['jazz', 'blues', 'r-n-b'])
-            tempo += 85
-        elif 0.66 <= hue < 0.83:  # Indigo/Purple
-            genres.extend(['electronic', 'edm', 'synth'])
-            tempo += 130
-        else:  # Violet/Pink
-            genres.extend(['pop', 'dance', 'disco'])
-            tempo += 120
-        
-        # Saturation affects intensity - higher saturation = more intense genres
-        if saturation > 0.7:
-            intensity_genres = ['electronic', 'rock', 'metal', 'edm']
-            genres = [g for g in genres if g in intensity_genres] or genres
+    Args:
+        mood: Result of derive_mood for the image
+        track_catalog: Local track catalog, or None if not configured
         
-        # Value (brightness) affects energy
-        energy = value
+    Returns:
+        List of track objects, empty if there is no catalog or the lookup failed
+    """
+    if track_catalog is None:
+        return []
     
-    # Add genres based on detected objects/scenes
-    genre_mappings = {
-        'beach': ['reggae', 'surf rock', 'tropical house'],
-        'mountain': ['folk', 'ambient', 'acoustic'],
-        'city': ['hip hop', 'r&b', 'electronic'],
-        'forest': ['folk', 'acoustic', 'ambient'],
-        'night': ['electronic', 'chill', 'lo-fi'],
-        'sunset': ['indie', 'chill', 'ambient'],
-        'concert': ['rock', 'live', 'pop'],
-        'party': ['dance', 'pop', 'hip hop'],
-        'nature': ['acoustic', 'folk', 'ambient'],
-        'food': ['jazz', 'lounge', 'bossa nova'],
-        'person': ['pop', 'r&b', 'soul'],
-        'animal': ['folk', 'classical', 'world'],
-        'water': ['ambient', 'chill', 'electronic'],
-        'sky': ['ambient', 'classical', 'post-rock'],
-    }
+    try:
+        with _CATALOG_SECONDS.time():
+            return track_catalog.recommend(
+                mood['energy'],
+                mood['valence'],
+                mood['tempo'],
+                genres=mood['genres'],
+                limit=mood['params'].get('limit', 10)
+            )
+    except Exception as e:
+        ERRORS.labels("recommender", "catalog").inc()
+        log.warning("recommend.catalog_failed", error=str(e))
+        return []
+
+def derive_mood(image_features: Dict[str, Any], spotify_client: SpotifyClient) -> Dict[str, Any]:
+    """
+    Map image features to target audio features, genres and Spotify search params.
     
-    for label in labels:
-        description = label.get('description', '').lower()
-        for key, mapped_genres in genre_mappings.items():
-            if key in description:
-                genres.extend(mapped_genres)
+    Args:
+        image_features: Dictionary containing features extracted from the image
+        spotify_client: Initialized SpotifyClient instance (for the genre catalog)
+        
+    Returns:
+        Dictionary with energy, valence, tempo, genres (candidates), valid_genres
+        (candidates known to Spotify) and params
+    """
+    # Get valid genres from Spotify (cached on the client)
+    try:
+        with _GENRE_FETCH_SECONDS.time():
+            available_genres = spotify_client.get_available_genre_seeds()
+    except Exception as e:
+        ERRORS.labels("recommender", "genres").inc()
+        log.warning("recommend.genres_unavailable", error=str(e))
+        available_genres = frozenset()  # Use a default fallback set
     
-    # Get seed genres (max 5 for Spotify API)
-    unique_genres = list(set(genres))[:5]
+    return mood_for_genres(image_features, available_genres)
+
+def mood_for_genres(image_features: Dict[str, Any], available_genres: frozenset) -> Dict[str, Any]:
+    """
+    Map image features to a mood given an already fetched genre catalog.
+    Used directly by callers that get the catalog asynchronously.
     
-    # If no genres were identified, use some defaults
-    if not unique_genres:
-        unique_genres = ['pop', 'rock', 'electronic']
+    Args:
+        image_features: Dictionary containing features extracted from the image
+        available_genres: Genre seeds known to Spotify
+        
+    Returns:
+        Same dictionary as derive_mood
+    """
+    # Map features to targets with the engine compiled at import
+    with _MAPPING_SECONDS.time():
+        mapped = ENGINE.map_features(image_features)
+    energy = mapped['energy']
+    valence = mapped['valence']
+    tempo = mapped['tempo']
+    unique_genres = mapped['genres']
     
     # Filter genres to ensure they're valid
     valid_genres = [genre for genre in unique_genres if genre in available_genres]
     if not valid_genres:
         valid_genres = ["pop"]  # Fallback to a safe genre
     
-    # Ensure we have valid genre strings
-    print(f"Valid genres before: {valid_genres}")  # Debugging
-
     # Ensure we have complete genre strings, not individual characters
     if valid_genres and isinstance(valid_genres[0], str) and len(valid_genres[0]) == 1:
         # We have individual characters instead of genre names
         valid_genres = ["pop"]  # Fall back to a reliable genre
 
-    print(f"Valid genres after: {valid_genres}")  # Debugging
-
-    # At the top, after getting available_genres:
-    print("\n===== TESTING SPOTIFY CONNECTION =====")
-    test_genres = spotify_client.debug_list_genres()
-    print("======================================\n")
+    log.debug("recommend.mood", energy=energy, valence=valence, tempo=tempo,
+              candidate_genres=unique_genres, valid_genres=valid_genres, available_genres=len(available_genres))
 
     # Replace the params section with:
     params = {
-        'seed_genres': 'pop',  # Start with a reasonable default
+        'seed_genres': valid_genres,  # Each one is searched, best match first
         'target_energy': energy,
         'target_valence': valence,
         'limit': 10
     }
 
-    # Just to be safe, ensure seed_genres is a valid genre
-    if test_genres and 'pop' not in test_genres and test_genres:
+    # Just to be safe, ensure seed_genres are valid (the pop fallback may not be)
+    if available_genres and not available_genres.issuperset(valid_genres):
         # Use first available genre if pop is not available
-        params['seed_genres'] = test_genres[0]
-        print(f"Using {params['seed_genres']} as fallback genre")
+        params['seed_genres'] = [min(available_genres)]
+        log.debug("recommend.seed_genre_fallback", seed_genre=params['seed_genres'][0])
 
     # Add tempo if it was determined
     if tempo > 0:
         params['target_tempo'] = tempo
 
-    # Before get_recommendations call
-    print("DEBUG - Final params being sent to Spotify:", params)
-    print("DEBUG - seed_genres type:", type(params['seed_genres']))
-    print("DEBUG - seed_genres value:", params['seed_genres'])
+    return {
+        'energy': energy,
+        'valence': valence,
+        'tempo': tempo,
+        'genres': unique_genres,
+        'valid_genres': valid_genres,
+        'params': params
+    }
 
-    # Get recommendations from Spotify
-    tracks = spotify_client.get_recommendations_via_search(**params)
+def finalize_recommendations(tracks: List[Union[Track, Dict[str, Any]]], mood: Dict[str, Any],
+                             image_features: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Serialize tracks for the response with match factors attached, or build
+    fallback tracks if there are none.
+    
+    Tracks may be shared with other requests (the track store, catalog
+    lookups), so each one is copied into a fresh dict here rather than modified.
+    
+    Args:
+        tracks: Tracks from Spotify (Track) or the local catalog (dict) for the mood's params
+        mood: Result of derive_mood for the image
+        image_features: Dictionary containing features extracted from the image
+        
+    Returns:
+        List of recommended tracks with their details
+    """
+    energy = mood['energy']
+    valence = mood['valence']
+    tempo = mood['tempo']
+    valid_genres = mood['valid_genres']
     
     # Add image analysis context to the response
+    recommendations = []
     for track in tracks:
+        track = track.to_dict() if isinstance(track, Track) else dict(track)
+        recommendations.append(track)
         track['match_factors'] = {
             'energy': energy,
             'valence': valence,
@@ -172,18 +196,9 @@ def get_music_recommendations(image_features: Dict[str, Any], spotify_client: Sp
         if tempo > 0:
             track['match_factors']['tempo'] = tempo
     
-    # Test with minimal parameters
-    try:
-        print("\n===== TESTING SPOTIFY MINIMAL PARAMS =====")
-        minimal_tracks = spotify_client.get_recommendations(seed_genres="pop", limit=5)
-        print(f"Got {len(minimal_tracks)} tracks with minimal params")
-        print("=========================================\n")
-    except Exception as e:
-        print(f"Error with minimal params: {e}")
-
     # If no tracks were returned from Spotify, use hardcoded fallback recommendations
-    if not tracks:
-        print("No tracks returned from Spotify API, using fallback recommendations")
+    if not recommendations:
+        log.info("recommend.fallback_tracks", genres=valid_genres)
         
         # Create fallback tracks based on the detected emotions
         fallback_tracks = []
@@ -236,4 +251,4 @@ def get_music_recommendations(image_features: Dict[str, Any], spotify_client: Sp
         
         return fallback_tracks
     
-    return tracks 
\ No newline at end of file
+    return recommendations 
\ No newline at end of file
@@ -0,0 +1,536 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+from cache import LRUCache, RecommendationCache, TieredCache, content_hash
+from hash_index import HammingIndex
+from image_analyzer import (COLOR_MODES, DEFAULT_VISION_PROFILE, VISION_BATCH_LIMIT, VISION_PROFILES,
+                            analysis_variant, annotate_image_content, annotate_images_batch,
+                            empty_annotations, get_local_features, get_perceptual_hash)
+from logs import ContextThreadPoolExecutor, get_logger
+from metrics import ERRORS
+from music_recommender import derive_mood, finalize_recommendations, get_music_recommendations, recommend_from_catalog
+from spotify_client import SpotifyClient, rank_search_results
+from track_catalog import TrackCatalog
+
+log = get_logger(__name__)
+
+class StageTimeoutError(Exception):
+    """
+    Raised when a pipeline stage does not finish within its time budget.
+    """
+
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"Stage '{stage}' did not finish within {timeout:.1f}s")
+        self.stage = stage
+        self.timeout = timeout
+
+def lookup_near_duplicate(index: HammingIndex, analysis_cache: TieredCache, content: bytes,
+                          variant: str) -> Tuple[Optional[int], Optional[Dict[str, Any]], Optional[int], Optional[str]]:
+    """
+    Look for cached features of an earlier upload that looks the same as this one.
+
+    Args:
+        index: Perceptual hashes of analyzed images mapped to their content hashes
+        analysis_cache: Cache of image features keyed by content hash and analysis variant
+        content: Encoded image bytes
+        variant: analysis_variant() the features must have been computed with
+
+    Returns:
+        Tuple of (perceptual hash of content, features of the near duplicate,
+        hamming distance to it, its content hash); the last three are None
+        without a usable match
+    """
+    try:
+        perceptual_hash = get_perceptual_hash(content)
+    except Exception:
+        # Undecodable uploads are reported by the local stage
+        return None, None, None, None
+
+    match = index.nearest(perceptual_hash)
+    if match is None:
+        return perceptual_hash, None, None, None
+    image_hash, distance = match
+    # The index outlives cache entries, so the match may have been evicted
+    image_features = analysis_cache.get(f"{image_hash}:{variant}")
+    if image_features is None:
+        return perceptual_hash, None, None, None
+    return perceptual_hash, image_features, distance, image_hash
+
+class AnalyzePipeline:
+    """
+    Runs the /api/analyze work as a concurrent pipeline.
+
+    The Vision call, the local PIL work and the genre catalog fetch don't
+    depend on each other, so they run side by side on a thread pool. The
+    recommendation search starts as soon as the image features are ready.
+    Each stage has its own timeout and the whole run has a total deadline.
+
+    With a near-duplicate index, an upload that misses the exact cache but
+    is perceptually the same as an analyzed image (re-encoded, resized,
+    metadata stripped) reuses that image's features instead of calling Vision.
+    """
+
+    def __init__(self, spotify_client: SpotifyClient, analysis_cache: TieredCache,
+                 max_workers: int = 8,
+                 stage_timeouts: Optional[Dict[str, float]] = None,
+                 total_deadline: float = 25, color_mode: str = 'vision',
+                 track_catalog: Optional[TrackCatalog] = None,
+                 near_duplicate_index: Optional[HammingIndex] = None,
+                 vision_profile: str = DEFAULT_VISION_PROFILE,
+                 recommendation_cache: Optional[RecommendationCache] = None,
+                 last_recommendations: Optional[LRUCache] = None):
+        """
+        Initialize the pipeline.
+
+        Args:
+            spotify_client: Initialized SpotifyClient instance
+            analysis_cache: Cache of image features keyed by content hash
+            max_workers: Size of the thread pool shared by all requests
+            stage_timeouts: Seconds allowed per stage (vision, local, recommend)
+            total_deadline: Seconds allowed for the whole run
+            color_mode: Default source of dominant colors, one of COLOR_MODES
+            track_catalog: Optional local catalog tried before Spotify search
+            near_duplicate_index: Optional perceptual hash index for near-duplicate cache hits
+            vision_profile: Default set of Vision annotations, one of VISION_PROFILES
+            recommendation_cache: Optional cache of tracks shared by images with the same quantized mood
+            last_recommendations: Optional cache of the last recommendations per image, replayed by stream()
+        """
+        self.spotify_client = spotify_client
+        self.analysis_cache = analysis_cache
+        self.max_workers = max_workers
+        self.stage_timeouts = {
+            "vision": 15,
+            "local": 10,
+            "recommend": 15,
+        }
+        self.stage_timeouts.update(stage_timeouts or {})
+        self.total_deadline = total_deadline
+        self.color_mode = color_mode
+        self.track_catalog = track_catalog
+        self.near_duplicate_index = near_duplicate_index
+        self.vision_profile = vision_profile
+        self.recommendation_cache = recommendation_cache
+        self.last_recommendations = last_recommendations
+        self._executor = None
+        self._pid = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # Worker threads don't survive fork, so each process builds its own pool.
+        # Stages run in the submitting request's context so their logs carry its id
+        if self._executor is None or self._pid != os.getpid():
+            with self._executor_lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ContextThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analyze")
+                    self._pid = os.getpid()
+        return self._executor
+
+    def run(self, content: bytes, debug: bool = False, color_mode: Optional[str] = None,
+            vision_profile: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Analyze an uploaded image and recommend music for it.
+
+        Args:
+            content: Encoded image bytes, shared by the Vision and PIL stages
+            debug: Include per-stage timings in the result
+            color_mode: Source of dominant colors for this run, defaults to the pipeline's
+            vision_profile: Vision annotations for this run, defaults to the pipeline's
+
+        Returns:
+            Dictionary with image_features, recommendations and, in debug mode, timings
+        """
+        color_mode = color_mode or self.color_mode
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode: {color_mode}")
+        vision_profile = vision_profile or self.vision_profile
+        if vision_profile not in VISION_PROFILES:
+            raise ValueError(f"Unknown Vision profile: {vision_profile}")
+        variant = analysis_variant(color_mode, vision_profile)
+
+        started = time.perf_counter()
+        deadline = started + self.total_deadline
+        timings = {}
+
+        image_features = recommendations = None
+        for event in self._events(content, variant, color_mode, vision_profile, started, deadline, timings,
+                                  previous=False):
+            if event["event"] == "features":
+                image_features = event["image_features"]
+            else:
+                recommendations = event["recommendations"]
+
+        result = {
+            "image_features": image_features,
+            "recommendations": recommendations
+        }
+        if debug:
+            timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            # Copy so a still-running background stage can't change it mid-serialization
+            result["timings"] = dict(timings)
+        return result
+
+    def stream(self, content: bytes, debug: bool = False, color_mode: Optional[str] = None,
+               vision_profile: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Analyze an uploaded image like run(), yielding events as each part is ready.
+
+        Events, in order:
+            features         - cached features at once; otherwise the local features
+                               ("partial": true) as soon as the local stage finishes,
+                               then the full set once Vision has answered
+            recommendations  - for cached features, the recommendations last made for
+                               the image or its near duplicate ("cached": true), if
+                               still kept, then fresh ones
+            done             - end of stream, with timings in debug mode
+            error            - a stage failed or timed out; nothing follows
+
+        Args:
+            content: Encoded image bytes
+            debug: Include per-stage timings in the done event
+            color_mode: Source of dominant colors for this run, defaults to the pipeline's
+            vision_profile: Vision annotations for this run, defaults to the pipeline's
+
+        Yields:
+            Event dictionaries with an "event" key
+        """
+        color_mode = color_mode or self.color_mode
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode: {color_mode}")
+        vision_profile = vision_profile or self.vision_profile
+        if vision_profile not in VISION_PROFILES:
+            raise ValueError(f"Unknown Vision profile: {vision_profile}")
+        variant = analysis_variant(color_mode, vision_profile)
+
+        started = time.perf_counter()
+        deadline = started + self.total_deadline
+        timings = {}
+
+        try:
+            yield from self._events(content, variant, color_mode, vision_profile, started, deadline, timings,
+                                    previous=True)
+        except StageTimeoutError as e:
+            yield {"event": "error", "stage": e.stage, "error": str(e)}
+            return
+        except Exception as e:
+            ERRORS.labels("api", "analyze_stream").inc()
+            log.exception("api.analyze_stream_failed")
+            yield {"event": "error", "error": str(e)}
+            return
+
+        done = {"event": "done"}
+        if debug:
+            timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            done["timings"] = dict(timings)
+        yield done
+
+    def _events(self, content: bytes, variant: str, color_mode: str, vision_profile: str,
+                started: float, deadline: float, timings: Dict[str, Any],
+                previous: bool) -> Iterator[Dict[str, Any]]:
+        """
+        Run the stages for one image, yielding the features and recommendations
+        events of stream() as they become ready. run() consumes the same events
+        and keeps the last of each. Stage failures and timeouts are raised.
+
+        Args:
+            previous: Also yield the last recommendations kept for a cached image
+        """
+        image_hash = content_hash(content)
+        perceptual_hash, image_features, source_hash = self._cached_features(content, image_hash, variant, timings)
+
+        if image_features is not None:
+            yield {"event": "features", "partial": False, "cached": True, "image_features": image_features}
+            if previous and self.last_recommendations is not None:
+                last = self.last_recommendations.get(f"{source_hash}:{variant}")
+                if last is not None:
+                    yield {"event": "recommendations", "cached": True, "recommendations": last}
+        else:
+            local_colors = color_mode != 'vision'
+
+            # Independent stages run concurrently
+            vision_future = None
+            if color_mode != 'local_only':
+                vision_future = self.executor.submit(self._timed, timings, "vision", started,
+                                                     annotate_image_content, content, not local_colors,
+                                                     vision_profile)
+            local_future = self.executor.submit(self._timed, timings, "local", started,
+                                                get_local_features, content, local_colors)
+            self.executor.submit(self._timed, timings, "genres", started,
+                                 self.spotify_client.get_available_genre_seeds)
+
+            # Local decoding usually beats the Vision round trip, so its
+            # brightness (and colors in local modes) go out first
+            local_features = self._wait(local_future, "local", deadline)
+            if vision_future is not None:
+                yield {"event": "features", "partial": True, "cached": False, "image_features": local_features}
+                image_features = self._wait(vision_future, "vision", deadline)
+            else:
+                image_features = empty_annotations()
+            image_features.update(local_features)
+            self._store_features(image_hash, perceptual_hash, variant, image_features)
+            yield {"event": "features", "partial": False, "cached": False, "image_features": image_features}
+
+        # The genre catalog is cached on the client, so the recommender
+        # doesn't wait on the genres stage unless it is still loading
+        recommend_future = self.executor.submit(self._timed, timings, "recommend", started,
+                                                get_music_recommendations, image_features,
+                                                self.spotify_client, self.track_catalog,
+                                                self.recommendation_cache)
+        recommendations = self._wait(recommend_future, "recommend", deadline)
+        if self.last_recommendations is not None:
+            # Under the features' own image too, so its near duplicates find them
+            for key_hash in {image_hash, source_hash}:
+                self.last_recommendations.set(f"{key_hash}:{variant}", recommendations)
+        yield {"event": "recommendations", "cached": False, "recommendations": recommendations}
+
+    def run_batch(self, contents: List[bytes], debug: bool = False, color_mode: Optional[str] = None,
+                  vision_profile: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Analyze many uploaded images and recommend music for each of them.
+
+        Identical images are analyzed once. Cache misses go to Vision in
+        batch_annotate_images chunks of up to VISION_BATCH_LIMIT, while the
+        local PIL work runs in parallel. Images whose moods produce the same
+        Spotify search query share one search call.
+
+        Args:
+            contents: Encoded image bytes, one entry per uploaded image
+            debug: Include timings in the result
+            color_mode: Source of dominant colors for this run, defaults to the pipeline's
+            vision_profile: Vision annotations for this run, defaults to the pipeline's
+
+        Returns:
+            Dictionary with per-image results in input order and batch stats
+        """
+        color_mode = color_mode or self.color_mode
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode: {color_mode}")
+        vision_profile = vision_profile or self.vision_profile
+        if vision_profile not in VISION_PROFILES:
+            raise ValueError(f"Unknown Vision profile: {vision_profile}")
+        variant = analysis_variant(color_mode, vision_profile)
+
+        started = time.perf_counter()
+        deadline = started + self.total_deadline
+        timings = {}
+
+        # Dedupe identical uploads by content hash, keeping first-seen order
+        hashes = [content_hash(content) for content in contents]
+        unique_contents = {}
+        for image_hash, content in zip(hashes, contents):
+            unique_contents.setdefault(image_hash, content)
+
+        features_by_hash = {}
+        errors_by_hash = {}
+        perceptual_hashes = {}
+        near_duplicates = 0
+        misses = []
+        for image_hash in unique_contents:
+            cached = self.analysis_cache.get(f"{image_hash}:{variant}")
+            if cached is None and self.near_duplicate_index is not None:
+                perceptual_hashes[image_hash], cached, _, _ = lookup_near_duplicate(
+                    self.near_duplicate_index, self.analysis_cache, unique_contents[image_hash], variant)
+                if cached is not None:
+                    near_duplicates += 1
+                    self.analysis_cache.set(f"{image_hash}:{variant}", cached)
+            if cached is not None:
+                features_by_hash[image_hash] = cached
+            else:
+                misses.append(image_hash)
+
+        vision_requests = 0
+        if misses:
+            local_colors = color_mode != 'vision'
+            self.executor.submit(self.spotify_client.get_available_genre_seeds)
+
+            # Local decoding runs per image while Vision gets whole chunks
+            local_futures = {
+                image_hash: self.executor.submit(get_local_features, unique_contents[image_hash], local_colors)
+                for image_hash in misses
+            }
+            vision_futures = []
+            if color_mode != 'local_only':
+                for start in range(0, len(misses), VISION_BATCH_LIMIT):
+                    chunk = misses[start:start + VISION_BATCH_LIMIT]
+                    future = self.executor.submit(self._timed, timings, f"vision_batch_{len(vision_futures)}",
+                                                  started, annotate_images_batch,
+                                                  [unique_contents[image_hash] for image_hash in chunk],
+                                                  not local_colors, vision_profile)
+                    vision_futures.append((chunk, future))
+            vision_requests = len(vision_futures)
+
+            annotations = {}
+            for chunk, future in vision_futures:
+                try:
+                    annotations.update(zip(chunk, self._wait(future, "vision", deadline)))
+                except StageTimeoutError:
+                    raise
+                except Exception as e:
+                    # A failed batch call only fails the images in its own chunk
+                    log.warning("pipeline.vision_batch_failed", images=len(chunk), error=str(e))
+                    annotations.update((image_hash, {"error": str(e)}) for image_hash in chunk)
+
+            for image_hash in misses:
+                annotation = annotations[image_hash] if vision_futures else empty_annotations()
+                if "error" in annotation:
+                    errors_by_hash[image_hash] = annotation["error"]
+                    continue
+
+                try:
+                    annotation.update(self._wait(local_futures[image_hash], "local", deadline))
+                except StageTimeoutError:
+                    raise
+                except Exception as e:
+                    errors_by_hash[image_hash] = str(e)
+                    continue
+
+                features_by_hash[image_hash] = annotation
+                self._store_features(image_hash, perceptual_hashes.get(image_hash), variant, annotation)
+            timings["analysis_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        # Moods already in the recommendation cache and catalog matches need
+        # no network; the rest fan out over search queries, and images whose
+        # moods share a query share its Spotify call
+        cache = self.recommendation_cache
+        moods = {}
+        cached_tracks = {}
+        catalog_tracks = {}
+        queries = {}
+        for image_hash, image_features in features_by_hash.items():
+            mood = derive_mood(image_features, self.spotify_client)
+            moods[image_hash] = mood
+            tracks = cache.lookup(mood) if cache is not None else None
+            if tracks is not None:
+                cached_tracks[image_hash] = tracks
+                continue
+            query_mood = cache.pool_mood(mood) if cache is not None else mood
+            tracks = recommend_from_catalog(query_mood, self.track_catalog)
+            if tracks:
+                catalog_tracks[image_hash] = cache.store(mood, tracks) if cache is not None else tracks
+                continue
+            limit = query_mood['params'].get('limit', 10)
+            queries[image_hash] = (limit, [((query, limit), weight) for query, weight
+                                           in self.spotify_client.build_search_queries(**query_mood['params'])])
+
+        # Each image's best-matching search is waited for, the others only within the search budget
+        searches = list(dict.fromkeys(search for _, image_searches in queries.values() for search, _ in image_searches))
+        tracks_by_search = {}
+        if searches:
+            search_future = self.executor.submit(self.spotify_client.search_all, searches,
+                                                 [image_searches[0][0] for _, image_searches in queries.values()])
+            tracks_by_search = self._wait(search_future, "recommend", deadline)
+        timings["recommend_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+        stored_moods = set()
+        results = []
+        for index, image_hash in enumerate(hashes):
+            if image_hash in errors_by_hash:
+                results.append({
+                    "index": index,
+                    "image_hash": image_hash,
+                    "success": False,
+                    "error": errors_by_hash[image_hash]
+                })
+                continue
+
+            mood = moods[image_hash]
+            if image_hash in cached_tracks:
+                tracks = cached_tracks[image_hash]
+            elif image_hash in catalog_tracks:
+                tracks = catalog_tracks[image_hash]
+            else:
+                # finalize_recommendations copies shared tracks, so each image gets its own match factors
+                limit, image_searches = queries[image_hash]
+                tracks = rank_search_results([(weight, tracks_by_search[search]) for search, weight in image_searches
+                                              if search in tracks_by_search], limit)
+                if cache is not None:
+                    # Later images of a mood stored in this batch are served from its pool
+                    signature = cache.signature(mood)
+                    served = cache.lookup(mood) if signature in stored_moods else None
+                    tracks = served if served is not None else cache.store(mood, tracks)
+                    stored_moods.add(signature)
+            results.append({
+                "index": index,
+                "image_hash": image_hash,
+                "success": True,
+                "image_features": features_by_hash[image_hash],
+                "recommendations": finalize_recommendations(tracks, mood, features_by_hash[image_hash])
+            })
+
+        result = {
+            "results": results,
+            "stats": {
+                "images": len(contents),
+                "unique_images": len(unique_contents),
+                "cache_hits": len(unique_contents) - len(misses),
+                "near_duplicate_hits": near_duplicates,
+                "vision_requests": vision_requests,
+                "mood_cache_hits": len(cached_tracks),
+                "catalog_matches": len(catalog_tracks),
+                "spotify_searches": len(searches)
+            }
+        }
+        if debug:
+            timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            result["timings"] = dict(timings)
+        return result
+
+    def _cached_features(self, content: bytes, image_hash: str, variant: str,
+                         timings: Dict[str, Any]) -> Tuple[Optional[int], Optional[Dict[str, Any]], str]:
+        """
+        Look up features by exact content hash, then by perceptual near duplicate.
+
+        Returns:
+            Tuple of (perceptual hash if one was computed, cached features or None,
+            content hash of the image the features belong to)
+        """
+        # Results differ per color mode and Vision profile, so both are part of the key
+        cache_key = f"{image_hash}:{variant}"
+        image_features = self.analysis_cache.get(cache_key)
+        timings["cache"] = {"hit": image_features is not None}
+        if image_features is not None or self.near_duplicate_index is None:
+            return None, image_features, image_hash
+
+        perceptual_hash, image_features, distance, source_hash = lookup_near_duplicate(
+            self.near_duplicate_index, self.analysis_cache, content, variant)
+        if image_features is None:
+            return perceptual_hash, None, image_hash
+        timings["cache"] = {"hit": True, "near_duplicate_distance": distance}
+        # Exact repeats of this upload then hit without hashing again
+        self.analysis_cache.set(cache_key, image_features)
+        return perceptual_hash, image_features, source_hash
+
+    def _store_features(self, image_hash: str, perceptual_hash: Optional[int], variant: str,
+                        image_features: Dict[str, Any]):
+        self.analysis_cache.set(f"{image_hash}:{variant}", image_features)
+        if perceptual_hash is not None:
+            self.near_duplicate_index.add(perceptual_hash, image_hash)
+
+    def _wait(self, future, stage: str, deadline: float):
+        """
+        Wait for a stage, bounded by its own timeout and the total deadline.
+        """
+        timeout = min(self.stage_timeouts[stage], max(deadline - time.perf_counter(), 0))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            ERRORS.labels("pipeline", f"{stage}_timeout").inc()
+            log.warning("pipeline.stage_timeout", stage=stage, timeout=timeout)
+            raise StageTimeoutError(stage, timeout)
+
+    @staticmethod
+    def _timed(timings: Dict[str, Any], stage: str, started: float, func, *args):
+        """
+        Run a stage and record when it started and how long it took.
+        """
+        stage_start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings[stage] = {
+                "start_ms": round((stage_start - started) * 1000, 1),
+                "duration_ms": round((time.perf_counter() - stage_start) * 1000, 1)
+            }
@@ -0,0 +1,193 @@
+import random
+import threading
+import time
+from typing import Dict, Any, Optional
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+    """
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"Circuit open, next attempt allowed in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of outgoing requests.
+
+    Callers reserve a token under the lock and sleep outside it, so waiting
+    threads are released in order at the configured rate. Async callers use
+    reserve() and await the returned delay themselves.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Initialize the bucket, starting full.
+
+        Args:
+            rate: Tokens added per second, 0 or less for no limit
+            burst: Maximum number of tokens held
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take one token without waiting for it.
+
+        Returns:
+            Seconds the caller must wait before using the token
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Tokens may go negative: that is the queue of callers already waiting
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self) -> float:
+        """
+        Take one token, sleeping until it is available.
+
+        Returns:
+            Seconds spent waiting
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures so callers fail fast instead of piling
+    more requests onto a struggling or throttling API. After reset_timeout a
+    single trial request is let through; its outcome closes or reopens it.
+    A trial that ends without an outcome (an unexpected error, cancellation)
+    must be handed back with release_trial() so another request can be the trial.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        Initialize the breaker, closed.
+
+        Args:
+            failure_threshold: Consecutive failures that open the circuit
+            reset_timeout: Seconds the circuit stays open before a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._open_until == 0:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half-open"
+
+    def retry_in(self) -> float:
+        """
+        Seconds until the circuit lets a request through, 0 if it would now.
+        """
+        if self._open_until == 0:
+            return 0.0
+        return max(self._open_until - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """
+        Check whether a request may be sent now.
+        """
+        return self.acquire() is not None
+
+    def acquire(self) -> Optional[bool]:
+        """
+        Check whether a request may be sent now, taking the trial slot if the circuit is half-open.
+
+        Returns:
+            None if the request must not be sent, True if it is the trial
+            request, False if the circuit is closed
+        """
+        with self._lock:
+            if self._open_until == 0:
+                return False
+            if time.monotonic() < self._open_until or self._trial_in_flight:
+                return None
+            self._trial_in_flight = True
+            return True
+
+    def release_trial(self):
+        """
+        Hand back the trial slot; a no-op once the trial's outcome is recorded.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+            self._trial_in_flight = False
+
+    def record_failure(self, open_for: Optional[float] = None):
+        """
+        Record a failed request.
+
+        Args:
+            open_for: Open the circuit for at least this many seconds regardless
+                of the failure count (e.g. a long Retry-After)
+        """
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if open_for is not None or self._failures >= self.failure_threshold or self._open_until:
+                duration = max(open_for or 0, self.reset_timeout)
+                self._open_until = time.monotonic() + duration
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_in": round(self.retry_in(), 2)
+        }
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """
+    Delay before retry number `attempt` (0-based): full-jitter exponential
+    backoff, but never shorter than the server's Retry-After.
+
+    Args:
+        attempt: Number of retries already made
+        base: Delay scale in seconds
+        cap: Maximum delay in seconds
+        retry_after: Seconds the server asked us to wait, if it said
+
+    Returns:
+        Seconds to sleep
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given in seconds; Spotify does not send HTTP dates.
+    """
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
@@ -1,7 +1,89 @@
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import os
+import threading
 import time
-from typing import Dict, Any, List, Optional
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from cache import LRUCache, StaleWhileRevalidateCache
+from track_store import Track, TrackStore, track_chunks
+from rate_limit import TokenBucket, CircuitBreaker, CircuitOpenError, backoff_delay, parse_retry_after
+from metrics import ERRORS, SPOTIFY_REQUEST_SECONDS, spotify_endpoint
+from logs import ContextThreadPoolExecutor, get_logger
+
+log = get_logger(__name__)
+
+# Default API locations, overridable per client (e.g. to point at a local stub)
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SPOTIFY_ACCOUNTS_URL = "https://accounts.spotify.com/api"
+
+# Share of a merged search result's score that comes from track popularity;
+# the rest is how well the searches that found it match the mood
+POPULARITY_WEIGHT = 0.3
+
+def mood_terms(energy: float, valence: float) -> List[Tuple[str, float]]:
+    """
+    Search qualifiers for the energy and valence targets, each weighted by
+    how strongly the target calls for it. Middling targets get none.
+    """
+    terms = []
+    if valence > 0.7:
+        terms.append(("happy", valence))
+    elif valence < 0.3:
+        terms.append(("sad", 1 - valence))
+    
+    if energy > 0.7:
+        terms.append(("energetic", energy))
+    elif energy < 0.3:
+        terms.append(("calm", 1 - energy))
+    return terms
+
+def rank_search_results(results: List[Tuple[float, List[Track]]], limit: int) -> List[Track]:
+    """
+    Merge the results of several weighted searches into one ranked list.
+    
+    Tracks are deduped by id. A track's relevance is the weight of every
+    search that found it, discounted by how far down that search's results
+    it came, relative to the total weight of the searches that returned
+    anything; its score blends that with popularity by POPULARITY_WEIGHT.
+    
+    Args:
+        results: (weight, tracks) per search, best-matching search first
+        limit: Maximum number of tracks to return
+        
+    Returns:
+        Tracks by descending score, ties in the order they were first found
+    """
+    answered = sum(weight for weight, tracks in results if tracks)
+    if not answered:
+        return []
+    
+    found = {}
+    relevance = {}
+    for weight, tracks in results:
+        for rank, track in enumerate(tracks):
+            found.setdefault(track.id, track)
+            relevance[track.id] = relevance.get(track.id, 0.0) + weight * (1 - 0.5 * rank / len(tracks))
+    
+    def score(track_id: str) -> float:
+        return ((1 - POPULARITY_WEIGHT) * relevance[track_id] / answered
+                + POPULARITY_WEIGHT * found[track_id].popularity / 100)
+    
+    return [found[track_id] for track_id in sorted(found, key=score, reverse=True)[:limit]]
+
+# Live clients, held weakly so short-lived ones (diagnostics probes,
+# benchmarks) can still be freed; one fork hook resets them all
+_clients = weakref.WeakSet()
+
+def _reset_clients_after_fork():
+    for client in list(_clients):
+        client._after_fork()
+
+# Forked workers must not share the parent's sockets, locks or threads
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
 
 class SpotifyClient:
     """
@@ -9,71 +91,454 @@ class SpotifyClient:
     Handles authentication and provides methods for searching and getting recommendations.
     """
     
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str, pool_size: int = 10,
+                 connect_timeout: float = 3.05, read_timeout: float = 10,
+                 genre_ttl: float = 86400, search_cache: Optional[StaleWhileRevalidateCache] = None,
+                 rate_limit: float = 10, rate_burst: int = 20, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_cap: float = 8,
+                 breaker_threshold: int = 5, breaker_reset: float = 30,
+                 api_url: str = SPOTIFY_API_URL, accounts_url: str = SPOTIFY_ACCOUNTS_URL,
+                 track_store: Optional[TrackStore] = None, search_fanout: int = 4,
+                 search_budget: float = 1.5):
         """
         Initialize the Spotify client with credentials.
         
         Args:
             client_id: Spotify API client ID
             client_secret: Spotify API client secret
+            pool_size: Maximum number of kept-alive connections per host
+            connect_timeout: Seconds to wait for a connection to be established
+            read_timeout: Seconds to wait for a response once connected
+            genre_ttl: Seconds before the cached genre seed catalog is refreshed
+            search_cache: Cache for search results, in-process with a 1 hour TTL by default
+            rate_limit: Requests per second allowed across all threads
+            rate_burst: Requests that may be sent at once before rate_limit applies
+            max_retries: Retries for 429, 5xx and connection errors
+            backoff_base: Scale of the jittered exponential backoff in seconds
+            backoff_cap: Longest wait between retries; a longer Retry-After opens the circuit instead
+            breaker_threshold: Consecutive failures that open the circuit breaker
+            breaker_reset: Seconds the circuit stays open before a trial request
+            api_url: Base URL of the Web API
+            accounts_url: Base URL of the accounts service that issues tokens
+            track_store: Store of parsed tracks by id, created per client by default
+            search_fanout: Most searches run for one set of recommendation params
+            search_budget: Seconds to wait for searches beyond the best-matching one
         """
         self.client_id = client_id
         self.client_secret = client_secret
+        self.api_url = api_url.rstrip("/")
+        self.accounts_url = accounts_url.rstrip("/")
         self.token = None
         self.token_expiry = 0
+        self._token_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_margin = 300  # Refresh in the background 5 minutes before expiry
+        self._refresh_thread_lock = threading.Lock()
+        
+        self.genre_ttl = genre_ttl
+        self._genre_seeds = frozenset()
+        self._genre_fetched_at = 0
+        self._genre_attempted_at = 0
+        self._genre_retry_interval = 60
+        self._genre_lock = threading.Lock()
+        
+        self.search_cache = search_cache or StaleWhileRevalidateCache(
+            LRUCache(max_entries=2048), ttl=3600, stale_ttl=86400)
+        self.track_store = track_store or TrackStore()
+        self.search_fanout = max(search_fanout, 1)
+        self.search_budget = search_budget
+        self._search_executor = None
+        self._search_executor_lock = threading.Lock()
+        
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = self._create_session()
+        self._stats_lock = threading.Lock()
+        self._requests_total = 0
+        self._requests_in_flight = 0
+        
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._throttled = 0
+        self._retried = 0
+        self._short_circuited = 0
+        self._rate_limit_wait = 0.0
+        self._searches_dropped = 0
+        
+        _clients.add(self)
     
-    def _get_auth_token(self) -> str:
+    def _after_fork(self):
+        """
+        Reset per-process state in a freshly forked worker.
+        """
+        self._token_lock = threading.Lock()
+        self._refresh_thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._genre_lock = threading.Lock()
+        self._search_executor_lock = threading.Lock()
+        self._refresh_thread = None
+        self._search_executor = None
+        self.session = self._create_session()
+        self.rate_limiter = TokenBucket(self.rate_limiter.rate, self.rate_limiter.burst)
+        self.breaker = CircuitBreaker(self.breaker.failure_threshold, self.breaker.reset_timeout)
+    
+    def _create_session(self) -> requests.Session:
+        """
+        Create a pooled session that keeps connections to Spotify alive between calls.
+        
+        Returns:
+            Configured requests.Session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+    
+    def _request(self, method: str, url: str, use_breaker: bool = True, **kwargs) -> requests.Response:
+        """
+        Send an HTTP request through the pooled session.
+        
+        Requests wait for the shared rate limiter before going out. 429s, 5xx
+        responses and connection errors are retried with jittered exponential
+        backoff that honours Retry-After, and failures feed the circuit breaker,
+        which makes calls fail fast while it is open.
+        
+        Args:
+            method: HTTP method (GET, POST, etc.)
+            url: Full request URL
+            use_breaker: Whether to ask the circuit breaker before sending; off for a
+                token refresh made on behalf of a request it already let through
+            **kwargs: Extra arguments passed to requests (headers, params, data, json)
+            
+        Returns:
+            The HTTP response (the last one if retries ran out)
+            
+        Raises:
+            CircuitOpenError: If the circuit breaker is open
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        
+        attempt = 0
+        while True:
+            trial = self.breaker.acquire() if use_breaker else False
+            if trial is None:
+                with self._stats_lock:
+                    self._short_circuited += 1
+                raise CircuitOpenError(self.breaker.retry_in())
+            
+            try:
+                self._wait_for_rate_limit()
+                
+                try:
+                    response = self._send(method, url, **kwargs)
+                except requests.RequestException as e:
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries or not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                        raise
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                else:
+                    # The token was revoked or expired early: refresh once and retry.
+                    # This request already holds the breaker's permission (maybe the
+                    # half-open trial), so the refresh doesn't ask for it again
+                    headers = kwargs.get("headers") or {}
+                    authorization = headers.get("Authorization", "")
+                    if response.status_code == 401 and authorization.startswith("Bearer "):
+                        self._invalidate_token(authorization[len("Bearer "):])
+                        token = self._ensure_token(use_breaker=False)
+                        kwargs["headers"] = dict(headers, Authorization=f"Bearer {token}")
+                        self._wait_for_rate_limit()
+                        response = self._send(method, url, **kwargs)
+                    
+                    if response.status_code != 429 and response.status_code < 500:
+                        self.breaker.record_success()
+                        return response
+                    
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if response.status_code == 429:
+                        with self._stats_lock:
+                            self._throttled += 1
+                        # Sleeping that long would outlast the request deadline, so
+                        # stop calling Spotify until the window is over instead
+                        if retry_after is not None and retry_after > self.backoff_cap:
+                            self.breaker.record_failure(open_for=retry_after)
+                            return response
+                    
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries:
+                        return response
+                    delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap, retry_after)
+            finally:
+                # Whatever ended the attempt, a trial without a recorded outcome
+                # must not keep the circuit shut for good
+                if trial:
+                    self.breaker.release_trial()
+            
+            attempt += 1
+            with self._stats_lock:
+                self._retried += 1
+            time.sleep(delay)
+    
+    def _wait_for_rate_limit(self):
+        """
+        Take a token from the shared rate limiter, counting the time spent waiting.
+        """
+        waited = self.rate_limiter.acquire()
+        if waited:
+            with self._stats_lock:
+                self._rate_limit_wait += waited
+    
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a single HTTP request through the pooled session, tracking pool
+        usage and recording its latency by endpoint and status.
+        """
+        with self._stats_lock:
+            self._requests_total += 1
+            self._requests_in_flight += 1
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            SPOTIFY_REQUEST_SECONDS.labels(spotify_endpoint(url), status).observe(time.perf_counter() - started)
+            with self._stats_lock:
+                self._requests_in_flight -= 1
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """
+        Report connection pool usage for each host this client has talked to.
+        
+        Returns:
+            Dictionary with request counters and per-host pool details
+        """
+        hosts = {}
+        adapter = self.session.get_adapter("https://")
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests_sent": pool.num_requests,
+                "idle_connections": pool.pool.qsize() if pool.pool is not None else 0,
+                "max_size": self.pool_size
+            }
+        
+        return {
+            "requests_total": self._requests_total,
+            "requests_in_flight": self._requests_in_flight,
+            "hosts": hosts
+        }
+    
+    def scheduler_stats(self) -> Dict[str, Any]:
+        """
+        Report rate limiting, retry and circuit breaker counters.
+        
+        Returns:
+            Dictionary with throttled (429s received), retried and short_circuited
+            call counts, searches_dropped past the search budget, total seconds
+            spent waiting for the rate limiter, and the circuit breaker state
+        """
+        return {
+            "throttled": self._throttled,
+            "retried": self._retried,
+            "short_circuited": self._short_circuited,
+            "searches_dropped": self._searches_dropped,
+            "rate_limit_wait_seconds": round(self._rate_limit_wait, 3),
+            "circuit": self.breaker.stats()
+        }
+    
+    def circuit_open(self) -> bool:
+        """
+        Whether calls to Spotify are currently being short-circuited.
+        """
+        return self.breaker.state == "open"
+    
+    def _get_auth_token(self, use_breaker: bool = True) -> str:
         """
         Get a new auth token from Spotify using client credentials flow.
         
+        Args:
+            use_breaker: Passed on to _request
+            
         Returns:
             Bearer token for API requests
         """
+        token, expiry = self._fetch_token(use_breaker)
+        self.token_expiry = expiry
+        self.token = token
+        
+        self._start_background_refresh()
+        
+        return self.token
+    
+    def _fetch_token(self, use_breaker: bool = True) -> Tuple[str, float]:
+        """
+        Request a new token from the accounts service without storing it.
+        
+        Args:
+            use_breaker: Passed on to _request
+            
+        Returns:
+            The bearer token and the time it expires
+        """
         auth_string = f"{self.client_id}:{self.client_secret}"
         auth_bytes = auth_string.encode("utf-8")
         auth_base64 = base64.b64encode(auth_bytes).decode("utf-8")
         
-        url = "https://accounts.spotify.com/api/token"
+        url = f"{self.accounts_url}/token"
         headers = {
             "Authorization": f"Basic {auth_base64}",
             "Content-Type": "application/x-www-form-urlencoded"
         }
         data = {"grant_type": "client_credentials"}
         
-        response = requests.post(url, headers=headers, data=data)
+        response = self._request("POST", url, use_breaker=use_breaker, headers=headers, data=data)
         response.raise_for_status()
         
         json_result = response.json()
-        self.token = json_result["access_token"]
-        self.token_expiry = time.time() + json_result["expires_in"]
-        
-        return self.token
+        return json_result["access_token"], time.time() + json_result["expires_in"]
     
-    def _ensure_token(self) -> str:
+    def _ensure_token(self, use_breaker: bool = True) -> str:
         """
         Ensure we have a valid token, refreshing if necessary.
         
+        Only one thread refreshes at a time. While the current token is still
+        valid, other threads keep using it instead of waiting for the refresh.
+        
+        Args:
+            use_breaker: Passed on to _request for the token call
+            
         Returns:
             Valid bearer token
         """
-        if self.token is None or time.time() > self.token_expiry - 60:
-            return self._get_auth_token()
-        return self.token
+        token = self.token
+        now = time.time()
+        if token is not None and now < self.token_expiry - 60:
+            # A forked worker inherits the token but not the refresh thread
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._start_background_refresh()
+            return token
+        
+        if token is not None and now < self.token_expiry:
+            # Close to expiry but still usable: refresh only if nobody else is
+            if self._token_lock.acquire(blocking=False):
+                try:
+                    if self.token == token:
+                        self._get_auth_token(use_breaker)
+                except Exception as e:
+                    log.warning("spotify.token_refresh_failed", error=str(e))
+                finally:
+                    self._token_lock.release()
+            return self.token or token
+        
+        # No usable token: wait for whichever thread is fetching one
+        with self._token_lock:
+            if self.token is None or time.time() >= self.token_expiry - 60:
+                return self._get_auth_token(use_breaker)
+            return self.token
+    
+    def _invalidate_token(self, token: str):
+        """
+        Forget a token the API rejected, unless another thread already replaced it.
+        
+        Args:
+            token: The bearer token that got a 401
+        """
+        with self._token_lock:
+            if self.token == token:
+                self.token = None
+                self.token_expiry = 0
+    
+    def _start_background_refresh(self):
+        """
+        Start the daemon thread that renews the token before it expires,
+        so request threads never have to wait on the token endpoint.
+        """
+        with self._refresh_thread_lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_loop,
+                name="spotify-token-refresh",
+                daemon=True
+            )
+            self._refresh_thread.start()
+    
+    def _refresh_loop(self):
+        """
+        Sleep until the refresh margin before expiry, then renew the token.
+        """
+        while True:
+            delay = self.token_expiry - self._refresh_margin - time.time()
+            time.sleep(max(delay, 1))
+            
+            if time.time() < self.token_expiry - self._refresh_margin:
+                continue
+            
+            # Fetch without the lock so request threads that need it (near
+            # expiry or after a 401) aren't held up by a slow token endpoint
+            try:
+                token, expiry = self._fetch_token()
+            except Exception as e:
+                log.warning("spotify.token_refresh_failed", background=True, error=str(e))
+                time.sleep(5)
+                continue
+            
+            with self._token_lock:
+                # A request thread may have stored a newer token meanwhile
+                if expiry > self.token_expiry:
+                    self.token_expiry = expiry
+                    self.token = token
+    
+    @staticmethod
+    def _search_cache_key(query: str, limit: int) -> str:
+        """
+        Build the search cache key; Spotify ignores case and repeated whitespace in queries.
+        Cached values are track ids, resolved through the track store.
+        """
+        return f"search-ids:{' '.join(query.lower().split())}:{int(limit)}"
     
-    def search_tracks(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+    def search_tracks(self, query: str, limit: int = 10, use_cache: bool = True) -> List[Track]:
         """
-        Search for tracks on Spotify.
+        Search for tracks on Spotify, serving repeated queries from the search cache.
         
         Args:
             query: Search query string
             limit: Maximum number of results to return
+            use_cache: Whether to serve and store the results through the search cache
             
         Returns:
-            List of track objects
+            List of tracks
+        """
+        if not use_cache:
+            return self.get_tracks(self._search_track_ids(query, limit))
+        
+        track_ids = self.search_cache.get_or_load(
+            self._search_cache_key(query, limit),
+            lambda: self._search_track_ids(query, limit)
+        )
+        return self.get_tracks(track_ids)
+    
+    def _search_track_ids(self, query: str, limit: int) -> List[str]:
+        """
+        Run a search, adding the tracks found to the track store.
+        
+        Returns:
+            Ids of the tracks found, in result order
         """
         token = self._ensure_token()
         
-        url = "https://api.spotify.com/v1/search"
+        url = f"{self.api_url}/search"
         headers = {"Authorization": f"Bearer {token}"}
         params = {
             "q": query,
@@ -81,62 +546,176 @@ class SpotifyClient:
             "limit": limit
         }
         
-        response = requests.get(url, headers=headers, params=params)
+        response = self._request("GET", url, headers=headers, params=params)
         response.raise_for_status()
         
-        json_result = response.json()
-        tracks = []
+        return self._store_tracks(response.json().get("tracks", {}).get("items", []))
+    
+    def _store_tracks(self, items: List[Dict[str, Any]]) -> List[str]:
+        """
+        Parse API track objects into the track store.
         
-        for item in json_result.get("tracks", {}).get("items", []):
-            track = self._parse_track(item)
-            if track:
-                tracks.append(track)
+        Returns:
+            Ids of the parsed tracks, in order
+        """
+        tracks = [track for track in map(Track.from_api, items) if track is not None]
+        self.track_store.put_many(tracks)
+        return [track.id for track in tracks]
+    
+    def get_tracks(self, track_ids: List[str]) -> List[Track]:
+        """
+        Resolve track ids through the track store, fetching the missing ones
+        in bulk from GET /v1/tracks, TRACKS_PER_REQUEST ids per call.
         
-        return tracks
+        Args:
+            track_ids: Spotify track ids
+            
+        Returns:
+            Tracks in the order of track_ids, skipping ids Spotify doesn't know
+        """
+        found, missing = self.track_store.get_many(track_ids)
+        if missing:
+            token = self._ensure_token()
+            for chunk in track_chunks(missing):
+                response = self._request("GET", f"{self.api_url}/tracks",
+                                         headers={"Authorization": f"Bearer {token}"},
+                                         params={"ids": ",".join(chunk)})
+                response.raise_for_status()
+                tracks = [track for track in map(Track.from_api, response.json().get("tracks", []))
+                          if track is not None]
+                self.track_store.put_many(tracks)
+                found.update((track.id, track) for track in tracks)
+        
+        return [found[track_id] for track_id in track_ids if track_id in found]
     
-    def get_recommendations_via_search(self, **params):
+    @property
+    def search_executor(self) -> ThreadPoolExecutor:
+        """
+        Return the thread pool concurrent searches run on, creating it on first use.
+        """
+        if self._search_executor is None:
+            with self._search_executor_lock:
+                if self._search_executor is None:
+                    self._search_executor = ContextThreadPoolExecutor(max_workers=self.pool_size,
+                                                                      thread_name_prefix="spotify-search")
+        return self._search_executor
+    
+    def get_recommendations_via_search(self, **params) -> List[Track]:
         """
         Alternative implementation that uses search API instead of recommendations
         since the recommendations endpoint is returning 404 errors.
-        """
-        token = self._ensure_token()
         
-        # Extract parameters we might use
-        seed_genres = params.get('seed_genres', 'pop')
-        energy = params.get('target_energy', 0.5)
-        valence = params.get('target_valence', 0.5)
-        limit = params.get('limit', 10)
+        Runs one search per seed genre and mood qualifier at once (see
+        build_search_queries and search_all) and merges them with rank_search_results.
         
-        # Construct a search query based on the genre
-        if isinstance(seed_genres, list):
-            # If it's a list, take the first one
-            search_term = seed_genres[0] if seed_genres else 'pop'
-        else:
-            # If it's a string, use as is
-            search_term = seed_genres
+        Args:
+            **params: Recommendation params (seed_genres, target_energy, target_valence, limit)
+            
+        Returns:
+            Up to limit tracks, best match first
+        """
+        limit = params.get('limit', 10)
+        queries = self.build_search_queries(**params)
+        searches = [(query, limit) for query, _ in queries]
+        results = self.search_all(searches, required=searches[:1])
+        return rank_search_results(
+            [(weight, results[search]) for (_, weight), search in zip(queries, searches) if search in results],
+            limit)
+    
+    def build_search_queries(self, **params) -> List[Tuple[str, float]]:
+        """
+        Build the searches get_recommendations_via_search runs for these params:
+        each seed genre with each mood qualifier (or alone if the mood is
+        middling), weighted by the qualifier's strength and the genre's rank.
         
-        # Create mood descriptors based on energy and valence
-        mood_terms = []
-        if valence > 0.7:
-            mood_terms.append("happy")
-        elif valence < 0.3:
-            mood_terms.append("sad")
+        Args:
+            **params: Recommendation params (seed_genres, target_energy, target_valence)
+            
+        Returns:
+            Up to search_fanout (query, weight) pairs, best match first
+        """
+        seed_genres = params.get('seed_genres') or 'pop'
+        if isinstance(seed_genres, str):
+            # Comma-separated, as the recommendations endpoint takes them
+            seed_genres = [genre.strip() for genre in seed_genres.split(',') if genre.strip()] or ['pop']
+        
+        terms = mood_terms(params.get('target_energy', 0.5), params.get('target_valence', 0.5)) or [("", 1.0)]
+        queries = [
+            (f"{term} {genre}".strip(), weight / (1 + 0.5 * position))
+            for position, genre in enumerate(seed_genres)
+            for term, weight in terms
+        ]
+        # Stable, so equal weights keep genre order
+        queries.sort(key=lambda query: query[1], reverse=True)
+        return queries[:self.search_fanout]
+    
+    def search_all(self, searches: Iterable[Tuple[str, int]],
+                   required: Iterable[Tuple[str, int]] = ()) -> Dict[Tuple[str, int], List[Track]]:
+        """
+        Run recommendation searches concurrently over the pooled session.
         
-        if energy > 0.7:
-            mood_terms.append("energetic")
-        elif energy < 0.3:
-            mood_terms.append("calm")
+        Searches in required are waited for however long they take; the
+        rest only until search_budget seconds have passed. Later ones are
+        dropped from the result, though they still finish in the background
+        and fill the search cache for the next request that needs them.
         
-        # Add random mood qualifier if we have one
-        search_query = search_term
-        if mood_terms:
-            import random
-            search_query = f"{random.choice(mood_terms)} {search_term}"
+        Args:
+            searches: (query, limit) pairs, duplicates run once
+            required: Searches to wait for regardless of the budget
+            
+        Returns:
+            Tracks for each search that finished in time
+        """
+        searches = list(dict.fromkeys(searches))
+        if len(searches) == 1:
+            return {searches[0]: self.search_for_recommendations(*searches[0])}
+        
+        futures = {search: self.search_executor.submit(self.search_for_recommendations, *search)
+                   for search in searches}
+        wait(futures.values(), timeout=self.search_budget)
+        wait([futures[search] for search in required])
+        
+        results = {search: future.result() for search, future in futures.items() if future.done()}
+        dropped = len(futures) - len(results)
+        if dropped:
+            with self._stats_lock:
+                self._searches_dropped += dropped
+            log.debug("spotify.searches_dropped", dropped=dropped, searches=len(futures), budget=self.search_budget)
+        return results
+    
+    def search_for_recommendations(self, search_query: str, limit: int = 10) -> List[Track]:
+        """
+        Run a recommendation search query, returning no tracks instead of raising on API errors.
+        Results share the search cache with search_tracks; empty results are not cached.
         
-        print(f"Using search query: '{search_query}' instead of recommendations")
+        Args:
+            search_query: Query built by build_search_queries
+            limit: Maximum number of results to return
+            
+        Returns:
+            List of tracks
+        """
+        try:
+            track_ids = self.search_cache.get_or_load(
+                self._search_cache_key(search_query, limit),
+                lambda: self._search_recommendation_ids(search_query, limit),
+                cacheable=bool
+            )
+            return self.get_tracks(track_ids)
+        except CircuitOpenError as e:
+            ERRORS.labels("spotify", "circuit_open").inc()
+            log.warning("spotify.search_skipped", query=search_query, reason=str(e))
+            return []
+        except Exception as e:
+            ERRORS.labels("spotify", "search").inc()
+            log.warning("spotify.tracks_failed", query=search_query, error=str(e))
+            return []
+    
+    def _search_recommendation_ids(self, search_query: str, limit: int) -> List[str]:
+        token = self._ensure_token()
         
         # Use the search API which we know is working
-        url = "https://api.spotify.com/v1/search"
+        url = f"{self.api_url}/search"
         headers = {"Authorization": f"Bearer {token}"}
         search_params = {
             "q": search_query,
@@ -144,84 +723,88 @@ class SpotifyClient:
             "limit": limit
         }
         
-        print(f"Making search request to: {url}")
-        print(f"With params: {search_params}")
-        
-        response = requests.get(url, headers=headers, params=search_params)
-        print(f"Response status: {response.status_code}")
+        response = self._request("GET", url, headers=headers, params=search_params)
+        log.debug("spotify.search", query=search_query, limit=limit, status=response.status_code)
         
         try:
             response.raise_for_status()
-            json_result = response.json()
-            
-            # Extract and parse tracks from response
-            tracks = []
-            for item in json_result.get("tracks", {}).get("items", []):
-                track = self._parse_track(item)
-                if track:
-                    tracks.append(track)
-            
-            return tracks
+            return self._store_tracks(response.json().get("tracks", {}).get("items", []))
         except Exception as e:
-            print(f"Error getting search results: {e}")
-            if hasattr(response, 'text'):
-                print(f"Response text: {response.text}")
+            log.warning("spotify.search_failed", query=search_query, status=response.status_code,
+                        error=str(e), body=lambda: response.text[:500])
             return []
     
-    def _parse_track(self, track_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def get_available_genre_seeds(self) -> frozenset:
         """
-        Parse a Spotify track object into a simplified format.
+        Get the set of available genre seeds from Spotify.
+        
+        The catalog is fetched once and then served from memory. When it is
+        older than genre_ttl it is refreshed in the background while the
+        stale copy keeps being served, including when Spotify is down.
         
-        Args:
-            track_data: Raw track data from Spotify API
-            
         Returns:
-            Simplified track object with essential information
+            frozenset: Available genre seeds
         """
-        if not track_data:
-            return None
-        
-        artists = []
-        for artist in track_data.get("artists", []):
-            artists.append({
-                "name": artist.get("name", "Unknown Artist"),
-                "id": artist.get("id")
-            })
-        
-        album = track_data.get("album", {})
-        album_images = album.get("images", [])
-        album_image = album_images[0].get("url") if album_images else None
-        
-        # Extract preview URL if available
-        preview_url = track_data.get("preview_url")
-        
-        return {
-            "id": track_data.get("id"),
-            "name": track_data.get("name", "Unknown Track"),
-            "artists": artists,
-            "album": {
-                "name": album.get("name", "Unknown Album"),
-                "id": album.get("id"),
-                "image_url": album_image
-            },
-            "preview_url": preview_url,
-            "external_url": track_data.get("external_urls", {}).get("spotify"),
-            "popularity": track_data.get("popularity", 0),
-            "explicit": track_data.get("explicit", False),
-            "duration_ms": track_data.get("duration_ms", 0)
-        }
+        if self._genre_fetched_at == 0 and self._genre_attempted_at == 0:
+            # First use: nothing to serve yet, so load synchronously
+            with self._genre_lock:
+                if self._genre_attempted_at == 0:
+                    self._fetch_genre_seeds()
+        elif self._genre_seeds_stale():
+            self._refresh_genre_seeds_async()
+        
+        return self._genre_seeds
     
-    def get_available_genre_seeds(self):
+    def load_genre_seeds(self) -> frozenset:
         """
-        Get a list of available genre seeds from Spotify.
+        Fetch the genre seed catalog now, keeping the previous copy on failure.
+        Intended to run once at startup.
         
         Returns:
-            list: Available genre seeds
+            frozenset: Available genre seeds
+        """
+        with self._genre_lock:
+            self._fetch_genre_seeds()
+        return self._genre_seeds
+    
+    def _fetch_genre_seeds(self):
         """
-        endpoint = "recommendations/available-genre-seeds"
-        response = self._make_api_request(endpoint, method="GET")
+        Fetch genre seeds from Spotify into the cached catalog. Caller holds _genre_lock.
+        """
+        self._genre_attempted_at = time.time()
+        try:
+            endpoint = "recommendations/available-genre-seeds"
+            response = self._make_api_request(endpoint, method="GET")
+            self._genre_seeds = frozenset(response.get("genres", []))
+            self._genre_fetched_at = time.time()
+        except Exception as e:
+            log.warning("spotify.genre_refresh_failed", cached=len(self._genre_seeds), error=str(e))
+    
+    def _genre_seeds_stale(self) -> bool:
+        now = time.time()
+        if now - self._genre_fetched_at < self.genre_ttl:
+            return False
+        # Back off between attempts while Spotify keeps failing
+        return now - self._genre_attempted_at >= self._genre_retry_interval
+    
+    def _refresh_genre_seeds_async(self):
+        """
+        Refresh the genre catalog on a daemon thread unless a refresh is already running.
+        """
+        if not self._genre_lock.acquire(blocking=False):
+            return
+        
+        def refresh():
+            try:
+                self._fetch_genre_seeds()
+            finally:
+                self._genre_lock.release()
         
-        return response.get("genres", [])
+        try:
+            threading.Thread(target=refresh, name="spotify-genre-refresh", daemon=True).start()
+        except Exception:
+            self._genre_lock.release()
+            raise
     
     def _make_api_request(self, endpoint, method="GET", params=None, data=None):
         """
@@ -238,13 +821,13 @@ class SpotifyClient:
         """
         token = self._ensure_token()
         
-        url = f"https://api.spotify.com/v1/{endpoint}"
+        url = f"{self.api_url}/{endpoint}"
         headers = {"Authorization": f"Bearer {token}"}
         
         if method.upper() == "GET":
-            response = requests.get(url, headers=headers, params=params)
+            response = self._request("GET", url, headers=headers, params=params)
         elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, params=params, json=data)
+            response = self._request("POST", url, headers=headers, params=params, json=data)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
         
@@ -253,30 +836,22 @@ class SpotifyClient:
         return response.json()
     
     def debug_list_genres(self):
-        """Simply print all available genres for debugging"""
+        """Fetch all available genres from the API, bypassing the cached catalog, for diagnostics"""
         token = self._ensure_token()
         
         # Ensure proper URL format
-        url = "https://api.spotify.com/v1/recommendations/available-genre-seeds"
+        url = f"{self.api_url}/recommendations/available-genre-seeds"
         headers = {"Authorization": f"Bearer {token}"}
         
+        response = None
         try:
-            # Print debug info
-            print(f"Token: {token[:10]}...")
-            print(f"Making request to: {url}")
-            
-            response = requests.get(url, headers=headers)
-            print(f"Response status: {response.status_code}")
-            
+            response = self._request("GET", url, headers=headers)
             response.raise_for_status()
             genres = response.json().get("genres", [])
-            print("===== AVAILABLE SPOTIFY GENRES =====")
-            print(genres)
-            print(f"Total genres: {len(genres)}")
-            print("===================================")
+            # The full list is only rendered when DEBUG logging is on
+            log.debug("spotify.genres", count=len(genres), genres=lambda: sorted(genres))
             return genres
         except Exception as e:
-            print(f"Error getting genres: {e}")
-            if hasattr(response, 'text'):
-                print(f"Response text: {response.text}")
+            log.warning("spotify.genres_failed", status=getattr(response, 'status_code', None), error=str(e),
+                        body=lambda: response.text[:500] if response is not None else None)
             return [] 
\ No newline at end of file
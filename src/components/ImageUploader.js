@@ -1,6 +1,6 @@
 import React, { useCallback, useContext } from 'react';
 import { useDropzone } from 'react-dropzone';
-import { analyzeImage } from '../services/api';
+import { analyzeImageStream } from '../services/api';
 import { ThemeContext } from '../App';
 
 const ImageUploader = ({ setIsLoading, setError, setRecommendations, setImagePreview, setImageFeatures, resetState }) => {
@@ -40,12 +40,16 @@ const ImageUploader = ({ setIsLoading, setError, setRecommendations, setImagePre
       const formData = new FormData();
       formData.append('image', file);
       
-      // Send to backend for analysis
-      const result = await analyzeImage(formData);
-      
-      // Update state with results
-      setRecommendations(result.recommendations);
-      setImageFeatures(result.image_features);
+      // Send to backend for analysis; features arrive before recommendations,
+      // and cached results arrive first and are then replaced by fresh ones
+      await analyzeImageStream(formData, (event) => {
+        if (event.event === 'features') {
+          setImageFeatures(event.image_features);
+        } else if (event.event === 'recommendations') {
+          setRecommendations(event.recommendations);
+          setIsLoading(false);
+        }
+      });
       setIsLoading(false);
     } catch (error) {
       console.error('Error analyzing image:', error);
@@ -37,6 +37,52 @@ export const analyzeImage = async (formData) => {
   }
 };
 
+/**
+ * Sends an image to the streaming analyze endpoint and reports each event as it arrives:
+ * image features first (possibly partial or cached), then recommendations
+ * @param {FormData} formData - FormData object containing the image file
+ * @param {Function} onEvent - Called with each event object ({event: 'features' | 'recommendations' | 'done', ...})
+ * @returns {Promise<void>} - Promise resolving when the stream ends
+ */
+export const analyzeImageStream = async (formData, onEvent) => {
+  let response;
+  try {
+    response = await fetch(`${API_BASE_URL}/analyze/stream`, {
+      method: 'POST',
+      body: formData,
+      headers: { Accept: 'application/x-ndjson' },
+    });
+  } catch (error) {
+    console.error('API error:', error);
+    throw new Error('No response from server. Please check your internet connection.');
+  }
+
+  if (!response.ok) {
+    const body = await response.json().catch(() => ({}));
+    throw new Error(body.error || 'Server error occurred');
+  }
+
+  // Events are newline-delimited JSON; a chunk may end mid-line
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const event = JSON.parse(line);
+      if (event.event === 'error') {
+        throw new Error(event.error || 'Server error occurred');
+      }
+      onEvent(event);
+    }
+  }
+};
+
 /**
  * Simple health check to verify backend is running
  * @returns {Promise<boolean>} - Promise resolving to true if backend is healthy
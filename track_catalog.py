@@ -0,0 +1,282 @@
+"""
+Locally stored track catalog with an audio-feature nearest-neighbour index.
+
+The catalog is built offline from a dump of tracks with their audio features
+and stored as a directory of NumPy arrays that are memory-mapped at load time:
+
+    ids.npy          (N,)   S22      Spotify track ids
+    features.npy     (N, 3) float32  energy, valence, tempo
+    genres.npy       (N,)   int16    index into genres.json
+    offsets.npy      (N,)   int64    byte offset of each track in metadata.jsonl
+    genres.json              list of genre names
+    metadata.jsonl           one simplified track object per line
+
+Build it with:
+
+    python -m track_catalog build <dump.csv|dump.jsonl> <catalog_dir>
+"""
+import argparse
+import csv
+import json
+import os
+from typing import Dict, Any, Iterator, List, Optional
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Tempo is divided by this so a 20 BPM gap weighs about as much as 0.1 of energy
+TEMPO_SCALE = 200.0
+
+# Candidates pulled from each genre's tree before merging
+CANDIDATES_PER_GENRE = 50
+
+# Accepted column names in dumps, first match wins
+COLUMN_ALIASES = {
+    "id": ("id", "track_id", "spotify_id"),
+    "name": ("name", "track_name"),
+    "artists": ("artists", "artist_name", "artist"),
+    "album": ("album", "album_name"),
+    "genre": ("genre", "track_genre"),
+    "energy": ("energy",),
+    "valence": ("valence",),
+    "tempo": ("tempo",),
+    "popularity": ("popularity",),
+    "duration_ms": ("duration_ms",),
+    "explicit": ("explicit",),
+    "preview_url": ("preview_url",),
+    "album_image_url": ("album_image_url", "image_url"),
+}
+
+class TrackCatalog:
+    """
+    Memory-mapped track catalog queried by nearest neighbour on
+    (energy, valence, tempo), with one KD-tree per genre.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Load a catalog built by build_catalog.
+
+        Args:
+            directory: Catalog directory
+        """
+        self.directory = directory
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        self.features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+        self.genre_codes = np.load(os.path.join(directory, "genres.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "genres.json")) as f:
+            self.genres = json.load(f)
+        self._genre_index = {genre: code for code, genre in enumerate(self.genres)}
+
+        self.default_tempo = float(np.median(self.features[:, 2])) if len(self.features) else 120.0
+
+        # One tree over everything plus one per genre, holding row numbers
+        scaled = self._scale(np.asarray(self.features, dtype=np.float64))
+        self._tree = cKDTree(scaled)
+        self._genre_trees = {}
+        for code in range(len(self.genres)):
+            rows = np.flatnonzero(self.genre_codes == code)
+            if len(rows):
+                self._genre_trees[code] = (cKDTree(scaled[rows]), rows)
+
+        # Positional reads need no shared file offset, so they are safe
+        # across threads and forked workers
+        metadata_path = os.path.join(directory, "metadata.jsonl")
+        self._metadata_fd = os.open(metadata_path, os.O_RDONLY)
+        self._metadata_size = os.path.getsize(metadata_path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _scale(features: np.ndarray) -> np.ndarray:
+        scaled = np.array(features, dtype=np.float64, copy=True)
+        scaled[..., 2] /= TEMPO_SCALE
+        return scaled
+
+    def nearest(self, energy: float, valence: float, tempo: float = 0,
+                genres: Optional[List[str]] = None, limit: int = 10) -> List[int]:
+        """
+        Find the rows closest to the target audio features.
+
+        Args:
+            energy: Target energy (0.0 to 1.0)
+            valence: Target valence (0.0 to 1.0)
+            tempo: Target tempo in BPM, or 0 when unknown
+            genres: Restrict to these genres if any of them are in the catalog
+            limit: Number of rows to return
+
+        Returns:
+            Row numbers ordered by distance to the target
+        """
+        target = self._scale(np.array([energy, valence, tempo or self.default_tempo]))
+
+        trees = [self._genre_trees[self._genre_index[genre]]
+                 for genre in (genres or []) if self._genre_index.get(genre) in self._genre_trees]
+        if not trees:
+            distances, rows = self._tree.query(target, k=min(limit, len(self)))
+            return [int(row) for row in np.atleast_1d(rows)]
+
+        all_distances = []
+        all_rows = []
+        for tree, tree_rows in trees:
+            k = min(max(limit, CANDIDATES_PER_GENRE), len(tree_rows))
+            distances, positions = tree.query(target, k=k)
+            all_distances.append(np.atleast_1d(distances))
+            all_rows.append(tree_rows[np.atleast_1d(positions)])
+
+        # Merge by distance; a track listed under several requested genres counts once
+        all_rows = np.concatenate(all_rows)[np.argsort(np.concatenate(all_distances), kind="stable")]
+        _, first_seen = np.unique(all_rows, return_index=True)
+        return [int(row) for row in all_rows[np.sort(first_seen)][:limit]]
+
+    def track(self, row: int) -> Dict[str, Any]:
+        """
+        Return the simplified track object for a row, in Track.to_dict() format.
+        """
+        start = int(self.offsets[row])
+        end = int(self.offsets[row + 1]) if row + 1 < len(self.offsets) else self._metadata_size
+        track = json.loads(os.pread(self._metadata_fd, end - start, start))
+
+        energy, valence, tempo = (float(value) for value in self.features[row])
+        track["audio_features"] = {"energy": energy, "valence": valence, "tempo": tempo}
+        track["genre"] = self.genres[int(self.genre_codes[row])]
+        return track
+
+    def recommend(self, energy: float, valence: float, tempo: float = 0,
+                  genres: Optional[List[str]] = None, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        Recommend catalog tracks whose audio features best match the targets.
+
+        Args:
+            energy: Target energy (0.0 to 1.0)
+            valence: Target valence (0.0 to 1.0)
+            tempo: Target tempo in BPM, or 0 when unknown
+            genres: Preferred genres
+            limit: Number of tracks to return
+
+        Returns:
+            List of track objects
+        """
+        return [self.track(row) for row in self.nearest(energy, valence, tempo, genres, limit)]
+
+def _column(row: Dict[str, Any], field: str, default=None):
+    for name in COLUMN_ALIASES[field]:
+        value = row.get(name)
+        if value not in (None, ""):
+            return value
+    return default
+
+def _read_dump(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield raw rows from a CSV or JSON-lines dump.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def _parse_artists(value) -> List[Dict[str, Any]]:
+    if isinstance(value, list):
+        return [artist if isinstance(artist, dict) else {"name": artist, "id": None} for artist in value]
+    # CSV dumps usually join artist names with ';'
+    return [{"name": name.strip(), "id": None} for name in str(value or "Unknown Artist").split(";")]
+
+def build_catalog(dump_path: str, directory: str) -> int:
+    """
+    Build a catalog directory from a dump of tracks with audio features.
+
+    Rows without an id or audio features are skipped, and repeated ids keep
+    their first occurrence.
+
+    Args:
+        dump_path: CSV or JSON-lines dump
+        directory: Output catalog directory
+
+    Returns:
+        Number of tracks written
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    ids = []
+    features = []
+    genre_codes = []
+    offsets = []
+    genres = {}
+    seen = set()
+
+    with open(os.path.join(directory, "metadata.jsonl"), "wb") as metadata:
+        for row in _read_dump(dump_path):
+            track_id = _column(row, "id")
+            try:
+                energy = float(_column(row, "energy"))
+                valence = float(_column(row, "valence"))
+                tempo = float(_column(row, "tempo"))
+            except (TypeError, ValueError):
+                continue
+            if not track_id or track_id in seen:
+                continue
+            seen.add(track_id)
+
+            genre = _column(row, "genre", "unknown")
+            genre_codes.append(genres.setdefault(genre, len(genres)))
+            ids.append(track_id)
+            features.append((energy, valence, tempo))
+
+            track = {
+                "id": track_id,
+                "name": _column(row, "name", "Unknown Track"),
+                "artists": _parse_artists(_column(row, "artists")),
+                "album": {
+                    "name": _column(row, "album", "Unknown Album"),
+                    "id": None,
+                    "image_url": _column(row, "album_image_url")
+                },
+                "preview_url": _column(row, "preview_url"),
+                "external_url": f"https://open.spotify.com/track/{track_id}",
+                "popularity": int(float(_column(row, "popularity", 0))),
+                "explicit": str(_column(row, "explicit", False)).lower() == "true",
+                "duration_ms": int(float(_column(row, "duration_ms", 0)))
+            }
+            offsets.append(metadata.tell())
+            metadata.write(json.dumps(track).encode("utf-8") + b"\n")
+
+    np.save(os.path.join(directory, "ids.npy"), np.array(ids, dtype="S22"))
+    np.save(os.path.join(directory, "features.npy"), np.array(features, dtype=np.float32).reshape(-1, 3))
+    np.save(os.path.join(directory, "genres.npy"), np.array(genre_codes, dtype=np.int16))
+    np.save(os.path.join(directory, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(directory, "genres.json"), "w") as f:
+        json.dump(sorted(genres, key=genres.get), f)
+
+    return len(ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query a local track catalog")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Build a catalog from a CSV or JSON-lines dump")
+    build.add_argument("dump")
+    build.add_argument("directory")
+
+    query = subparsers.add_parser("query", help="Print the nearest tracks for target audio features")
+    query.add_argument("directory")
+    query.add_argument("--energy", type=float, default=0.5)
+    query.add_argument("--valence", type=float, default=0.5)
+    query.add_argument("--tempo", type=float, default=0)
+    query.add_argument("--genre", action="append")
+    query.add_argument("--limit", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        count = build_catalog(args.dump, args.directory)
+        print(f"Wrote {count} tracks to {args.directory}")
+    else:
+        catalog = TrackCatalog(args.directory)
+        for track in catalog.recommend(args.energy, args.valence, args.tempo, args.genre, args.limit):
+            print(f"{track['id']}  {track['genre']:<16} {track['audio_features']}  {track['name']}")
+
+if __name__ == "__main__":
+    main()
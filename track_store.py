@@ -0,0 +1,142 @@
+import sys
+from typing import Dict, Any, List, Optional, Tuple
+from cache import LRUCache
+
+# Maximum number of ids Spotify accepts per GET /v1/tracks call
+TRACKS_PER_REQUEST = 50
+
+class Track:
+    """
+    Parsed Spotify track.
+
+    Kept in __slots__ attributes with artists as tuples, which takes a
+    fraction of the memory of the nested dicts the API response is turned
+    into. Tracks are shared between requests and never mutated; to_dict()
+    builds the JSON-ready form at the response boundary.
+    """
+
+    __slots__ = ("id", "name", "artists", "album_name", "album_id", "album_image_url",
+                 "preview_url", "external_url", "popularity", "explicit", "duration_ms")
+
+    def __init__(self, id: str, name: str, artists: Tuple[Tuple[str, Optional[str]], ...],
+                 album_name: str, album_id: Optional[str], album_image_url: Optional[str],
+                 preview_url: Optional[str], external_url: Optional[str],
+                 popularity: int, explicit: bool, duration_ms: int):
+        self.id = id
+        self.name = name
+        self.artists = artists
+        self.album_name = album_name
+        self.album_id = album_id
+        self.album_image_url = album_image_url
+        self.preview_url = preview_url
+        self.external_url = external_url
+        self.popularity = popularity
+        self.explicit = explicit
+        self.duration_ms = duration_ms
+
+    @classmethod
+    def from_api(cls, track_data: Dict[str, Any]) -> Optional['Track']:
+        """
+        Parse a track object from the Spotify API.
+
+        Args:
+            track_data: Raw track data from a search or tracks response
+
+        Returns:
+            Track, or None for an empty entry (unknown ids come back as null)
+        """
+        if not track_data or not track_data.get("id"):
+            return None
+
+        album = track_data.get("album", {})
+        album_images = album.get("images", [])
+
+        return cls(
+            # Ids repeat across every cached search that returns the track
+            id=sys.intern(track_data["id"]),
+            name=track_data.get("name", "Unknown Track"),
+            artists=tuple((artist.get("name", "Unknown Artist"), artist.get("id"))
+                          for artist in track_data.get("artists", [])),
+            album_name=album.get("name", "Unknown Album"),
+            album_id=album.get("id"),
+            album_image_url=album_images[0].get("url") if album_images else None,
+            preview_url=track_data.get("preview_url"),
+            external_url=track_data.get("external_urls", {}).get("spotify"),
+            popularity=track_data.get("popularity", 0),
+            explicit=track_data.get("explicit", False),
+            duration_ms=track_data.get("duration_ms", 0)
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Return the simplified track object sent to the frontend.
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "artists": [{"name": name, "id": artist_id} for name, artist_id in self.artists],
+            "album": {
+                "name": self.album_name,
+                "id": self.album_id,
+                "image_url": self.album_image_url
+            },
+            "preview_url": self.preview_url,
+            "external_url": self.external_url,
+            "popularity": self.popularity,
+            "explicit": self.explicit,
+            "duration_ms": self.duration_ms
+        }
+
+    def __repr__(self):
+        return f"Track({self.id!r}, {self.name!r})"
+
+class TrackStore:
+    """
+    In-process LRU store of parsed tracks keyed by Spotify id, shared by
+    every search so a popular track is parsed and held once.
+    """
+
+    def __init__(self, max_entries: int = 20000):
+        """
+        Initialize the store.
+
+        Args:
+            max_entries: Maximum number of tracks kept before evicting the least recently used
+        """
+        self._tracks = LRUCache(max_entries=max_entries)
+
+    def put_many(self, tracks: List[Track]):
+        for track in tracks:
+            self._tracks.set(track.id, track)
+
+    def get_many(self, ids: List[str]) -> Tuple[Dict[str, Track], List[str]]:
+        """
+        Look up tracks by id.
+
+        Args:
+            ids: Spotify track ids
+
+        Returns:
+            Tuple of (tracks found by id, ids not in the store in first-seen order)
+        """
+        found = {}
+        missing = []
+        for track_id in dict.fromkeys(ids):
+            track = self._tracks.get(track_id)
+            if track is None:
+                missing.append(track_id)
+            else:
+                found[track_id] = track
+        return found, missing
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._tracks.stats()
+
+def track_chunks(ids: List[str]) -> List[List[str]]:
+    """
+    Split ids into batches for GET /v1/tracks.
+    """
+    return [ids[start:start + TRACKS_PER_REQUEST] for start in range(0, len(ids), TRACKS_PER_REQUEST)]